@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+
+import modules
+import tools
+
+
+def client(args):
+    """
+    Client side, run inside the network namespace: simulate the clients and print the results as JSON.
+    """
+    results = asyncio.run(tools.dhcp_load(args.client, args.clients, args.concurrency, args.timeout, args.retries))
+    json.dump(results, sys.stdout)
+
+
+def report(c, results):
+    c.print('{!b}%d of %d clients leased in %.2fs: {!g}%.0f leases/s' % (
+        results['leased'], results['clients'], results['elapsed'], results['leased'] / results['elapsed']))
+    if results['naks'] or results['failed']:
+        c.error('{!y}%d NAKs, %d clients failed' % (results['naks'], results['failed']))
+    c.print('  DISCOVER to OFFER: %s' % (tools.format_latencies(results['offer_latencies']),))
+    c.print('  DISCOVER to ACK:   %s' % (tools.format_latencies(results['latencies']),))
+
+
+def main(argv):
+    c = tools.ColorPrint(name='DHCPBENCH')
+    dhcp = modules.DHCP()
+
+    parser = argparse.ArgumentParser(
+        description='Measure how fast the DHCP module hands out leases, with simulated clients on a veth pair whose '
+                    'other end is in a network namespace, so no network is needed.')
+    parser.add_argument('--clients', action='store', type=int, default=1000,
+                        help='Number of clients to simulate, default is 1000')
+    parser.add_argument('--concurrency', action='store', type=int, default=100,
+                        help='Number of clients talking to the server at once, default is 100')
+    parser.add_argument('--timeout', action='store', type=float, default=2.0,
+                        help='Seconds to wait for a reply before retransmitting, default is 2')
+    parser.add_argument('--retries', action='store', type=int, default=2,
+                        help='Number of retransmissions before a client gives up, default is 2')
+    parser.add_argument('--interface', action='store', type=str, default='lnbench0',
+                        help='Name of the veth interface of the server, default is "lnbench0"')
+    parser.add_argument('--netns', action='store', type=str, default='localnet-bench',
+                        help='Name of the network namespace of the clients, default is "localnet-bench"')
+    parser.add_argument('--domain', action='store', type=str, default='localdomain',
+                        help='Set the domain name for the local network, default is "localdomain"')
+    parser.add_argument('--client', action='store', type=str, default=None, help=argparse.SUPPRESS)
+    dhcp.register_args(parser)
+    args = parser.parse_args(argv)
+
+    if args.client is not None:
+        client(args)
+        return
+
+    # A /16, so that the range fits many clients
+    args.segments = [tools.Segment(args.interface, '10.199.0.1', 16, '10.199.0.10', '10.199.255.250')]
+    size = int(args.segments[0].range_end) - int(args.segments[0].range_start) + 1
+    if args.clients >= size:
+        c.error('{!r}At most %d clients can be simulated.' % (size - 1,))
+        sys.exit(200)
+    dhcp.configure(args)
+
+    runner = tools.mysubprocess('DHCPBENCH')
+    peer = args.interface + 'c'
+    runner.check_call(['ip', 'netns', 'add', args.netns])
+    supervisor = tools.Supervisor()
+    process = None
+    try:
+        with runner.batch(['ip']) as batch:
+            batch.add('link', 'add', args.interface, 'type', 'veth', 'peer', 'name', peer, 'netns', args.netns)
+        with runner.batch(['ip', '-n', args.netns]) as batch:
+            batch.add('link', 'set', 'lo', 'up')
+            batch.add('link', 'set', peer, 'up')
+        tools.start_modules([dhcp])
+        supervisor.watch(dhcp)
+
+        process = subprocess.Popen(['ip', 'netns', 'exec', args.netns, sys.executable, __file__, '--client', peer,
+                                    '--clients', str(args.clients), '--concurrency', str(args.concurrency),
+                                    '--timeout', str(args.timeout), '--retries', str(args.retries)],
+                                   stdout=subprocess.PIPE)
+        output = []
+
+        def wait():
+            output.append(process.communicate()[0])
+            supervisor.loop.call_soon_threadsafe(supervisor.loop.stop)
+
+        threading.Thread(target=wait, daemon=True).start()
+        c.print('{!b}Simulating %d clients, %d at once' % (args.clients, args.concurrency))
+        supervisor.run()
+    finally:
+        if process is not None and process.poll() is None:
+            process.terminate()
+        supervisor.close()
+        tools.stop_modules([dhcp])
+        # Deleting the namespace deletes the veth pair as well
+        runner.check_call(['ip', 'netns', 'delete', args.netns])
+
+    if process.returncode != 0 or not output or not output[0]:
+        c.error('{!r}The simulated clients failed.')
+        sys.exit(1)
+    report(c, json.loads(output[0]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
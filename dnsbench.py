@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+
+import modules
+import tools
+
+
+def load_names(args) -> list:
+    """
+    The names to replay, read from --names or generated.
+    """
+    if args.names is None:
+        # Not under a special-use domain like test., resolvers answer those locally without asking upstream
+        return ['host-%d.dnsbench.example.net' % (index,) for index in range(args.unique)]
+    with open(args.names) as f:
+        names = [line.split()[0] for line in f if line.strip() and not line.lstrip().startswith('#')]
+    if not names:
+        raise ValueError('%s lists no names' % (args.names,))
+    return names
+
+
+def client(args):
+    """
+    Client side, run inside the network namespace: send the queries and print the results as JSON.
+    """
+    results = asyncio.run(tools.dns_load(args.client, load_names(args), args.queries, args.qps, args.concurrency,
+                                         args.timeout))
+    json.dump(results, sys.stdout)
+
+
+def report(c, results, upstream_queries):
+    c.print('{!b}%d of %d queries answered in %.2fs: {!g}%.0f queries/s{!b} (target %s)' % (
+        results['answered'], results['queries'], results['elapsed'], results['answered'] / results['elapsed'],
+        '%g/s' % (results['target_qps'],) if results['target_qps'] else 'open throttle'))
+    if results['timeouts']:
+        c.error('{!y}%d queries timed out' % (results['timeouts'],))
+    c.print('  Answers:    %s' % (', '.join('%s %d' % item for item in sorted(results['rcodes'].items())),))
+    c.print('  Cache miss: %d (fetched upstream), %s' % (len(results['miss_latencies']),
+                                      tools.format_latencies(results['miss_latencies'], (50, 99, 99.9))))
+    c.print('  Cache hit:  %d, %s' % (len(results['hit_latencies']),
+                                      tools.format_latencies(results['hit_latencies'], (50, 99, 99.9))))
+    if upstream_queries is not None:
+        c.print('  Upstream:   %d queries' % (upstream_queries,))
+
+
+def main(argv):
+    c = tools.ColorPrint(name='DNSBENCH')
+    dns = modules.DNS()
+
+    parser = argparse.ArgumentParser(
+        description='Measure the resolver of the DNS module, with queries from a network namespace on the other end of '
+                    'a veth pair and a local stub as authoritative upstream for every name, so no network is needed.')
+    parser.add_argument('--queries', action='store', type=int, default=10000,
+                        help='Number of queries to send, default is 10000')
+    parser.add_argument('--names', action='store', type=str, default=None, metavar='FILE',
+                        help='Replay the names listed in FILE (one per line) in order, repeated as needed, default are '
+                             'generated names')
+    parser.add_argument('--unique', action='store', type=int, default=1000,
+                        help='Number of distinct names to generate if no --names are given, default is 1000')
+    parser.add_argument('--qps', action='store', type=float, default=0,
+                        help='Queries to send per second regardless of the answers, default is 0 for as fast as '
+                             '--concurrency allows')
+    parser.add_argument('--concurrency', action='store', type=int, default=100,
+                        help='Number of queries outstanding at once without --qps, default is 100')
+    parser.add_argument('--timeout', action='store', type=float, default=2.0,
+                        help='Seconds to wait for an answer, default is 2')
+    parser.add_argument('--upstream-delay', action='store', type=float, default=0.0, metavar='MS',
+                        help='Delay the answers of the stub upstream by MS milliseconds, e.g. to model a remote '
+                             'authoritative server, default is 0')
+    parser.add_argument('--interface', action='store', type=str, default='lndnsbench0',
+                        help='Name of the veth interface of the server, default is "lndnsbench0"')
+    parser.add_argument('--netns', action='store', type=str, default='localnet-dnsbench',
+                        help='Name of the network namespace of the clients, default is "localnet-dnsbench"')
+    parser.add_argument('--domain', action='store', type=str, default='localdomain',
+                        help='Set the domain name for the local network, default is "localdomain"')
+    parser.add_argument('--client', action='store', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--stub', action='store_true', default=False, help=argparse.SUPPRESS)
+    dns.register_args(parser)
+    args = parser.parse_args(argv)
+
+    if args.stub:
+        tools.dns_stub(delay=args.upstream_delay / 1000)
+        return
+    if args.client is not None:
+        client(args)
+        return
+
+    try:
+        load_names(args)
+    except (OSError, ValueError) as e:
+        c.error('{!r}Invalid names: %s' % (e,))
+        sys.exit(200)
+
+    segment = tools.Segment(args.interface, '10.198.0.1', 24)
+    stub = subprocess.Popen([sys.executable, __file__, '--stub', '--upstream-delay', str(args.upstream_delay)],
+                            stdout=subprocess.PIPE)
+    args.segments = [segment]
+    args.dns_upstream = [('127.0.0.1', int(stub.stdout.readline()))]
+    # The resolver only runs with an internet interface, the stub upstream is all it needs here
+    args.internet_interface = args.interface
+    dns.configure(args)
+    if not dns.enabled_user:
+        stub.terminate()
+        sys.exit(1)
+
+    runner = tools.mysubprocess('DNSBENCH')
+    peer = args.interface + 'c'
+    runner.check_call(['ip', 'netns', 'add', args.netns])
+    supervisor = tools.Supervisor()
+    process = None
+    try:
+        with runner.batch(['ip']) as batch:
+            batch.add('link', 'add', args.interface, 'type', 'veth', 'peer', 'name', peer, 'netns', args.netns)
+            batch.add('address', 'add', '%s/%d' % (segment.ip, segment.prefixlen), 'dev', args.interface)
+            batch.add('link', 'set', args.interface, 'up')
+        with runner.batch(['ip', '-n', args.netns]) as batch:
+            batch.add('link', 'set', 'lo', 'up')
+            batch.add('address', 'add', '%s/%d' % (segment.address.ip + 1, segment.prefixlen), 'dev', peer)
+            batch.add('link', 'set', peer, 'up')
+        tools.start_modules([dns])
+        supervisor.watch(dns)
+
+        names = ['--names', args.names] if args.names is not None else ['--unique', str(args.unique)]
+        process = subprocess.Popen(['ip', 'netns', 'exec', args.netns, sys.executable, __file__, '--client', segment.ip,
+                                    '--queries', str(args.queries), '--qps', str(args.qps),
+                                    '--concurrency', str(args.concurrency), '--timeout', str(args.timeout)] + names,
+                                   stdout=subprocess.PIPE)
+        output = []
+
+        def wait():
+            output.append(process.communicate()[0])
+            supervisor.loop.call_soon_threadsafe(supervisor.loop.stop)
+
+        threading.Thread(target=wait, daemon=True).start()
+        c.print('{!b}Sending %d queries for %d names to the %s resolver' % (
+            args.queries, len(load_names(args)), args.dns_backend))
+        supervisor.run()
+    finally:
+        if process is not None and process.poll() is None:
+            process.terminate()
+        supervisor.close()
+        tools.stop_modules([dns])
+        # Deleting the namespace deletes the veth pair as well
+        runner.check_call(['ip', 'netns', 'delete', args.netns])
+        stub.terminate()
+        upstream_queries = stub.communicate()[0].split()
+
+    if process.returncode != 0 or not output or not output[0]:
+        c.error('{!r}The queries failed.')
+        sys.exit(1)
+    upstream_queries = int(upstream_queries[0]) if upstream_queries else None
+    report(c, json.loads(output[0]), upstream_queries)
+    if not upstream_queries:
+        c.error('{!r}No query reached the stub upstream, the resolver answered all of them itself. The results do not '
+                'measure resolving.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,21 +1,110 @@
 #!/usr/bin/env python3
 import argparse
 import sys
-import time
 
 import modules
 import tools
 
 
+def print_status(c, modules):
+    """
+    Print the status of all modules, triggered by SIGUSR1.
+    """
+    for module in modules:
+        status = module.status()
+        color = '{!g}' if status['running'] else '{!y}'
+        c.print('%s%s{!}: %s' % (color, module.name, 'running' if status['running'] else 'stopped'))
+        for name, service in status['services'].items():
+            if 'alive' not in service:
+                # Not a daemon, e.g. the DHCP lease index
+                c.print('  {!g}%s{!} %s' % (name, ', '.join('%s %s' % item for item in service.items())))
+            elif service['alive']:
+                c.print('  {!g}%s{!} alive, pid %d, up %.0fs, %d restarts' % (
+                    name, service['pid'], service['uptime'], service['restarts']))
+            else:
+                c.print('  {!r}%s{!} dead, %d restarts' % (name, service['restarts']))
+        # Anything else a module reports, like counters, one line per entry
+        for key, value in status.items():
+            if key in ('running', 'services'):
+                continue
+            if isinstance(value, dict) and value:
+                c.print('  %s:' % (key,))
+                for name, entry in value.items():
+                    c.print('    %s: %s' % (name, entry))
+            else:
+                c.print('  %s: %s' % (key, value))
+
+
+def reload(c, modules):
+    """
+    Let all modules apply changed configuration files, triggered by SIGHUP.
+    """
+    c.print('{!b}Reloading')
+    for module in modules:
+        try:
+            module.reload()
+        except Exception as e:
+            c.error('{!r}Reloading %s failed: %s' % (module.name, e))
+
+
+def create(module_class):
+    with tools.tracer.span('%s.__init__' % (module_class.__name__,), 'module'):
+        return module_class()
+
+
+def run(c, module_list):
+    """
+    Start all modules, supervise them until interrupted and stop them again.
+    """
+    # A previous run may have crashed before stopping its modules
+    tools.recover_sysctl(tools.mysubprocess('LOCALNET'))
+
+    c.print('{!b}Running modules')
+    # start_modules rolls back a failed start itself, stopping again could only replace its exception
+    tools.start_modules(module_list)
+    supervisor = tools.Supervisor()
+    try:
+        for module in module_list:
+            supervisor.watch(module)
+        c.print('{!b}Supervising, send SIGUSR1 for status, SIGHUP to reload')
+        with tools.tracer.span('supervise', 'localnet'):
+            supervisor.run(on_status=lambda: print_status(c, module_list), on_reload=lambda: reload(c, module_list))
+
+    finally:
+        supervisor.close()
+        c.print('{!b}Stopping modules')
+        tools.stop_modules(module_list)
+
+    c.print('{!b}Cleaned up.')
+
+
 def main(argv):
     c = tools.ColorPrint(name='LOCALNET')
+
+    # --trace and --apply-plan are looked at first, so that creating the modules is traced as well, and so that
+    # applying a plan skips everything else
+    early_parser = argparse.ArgumentParser(add_help=False)
+    early_parser.add_argument('--trace', action='store', type=str, default=None)
+    early_parser.add_argument('--apply-plan', action='store', type=str, default=None)
+    early_args = early_parser.parse_known_args(argv)[0]
+    if early_args.trace is not None:
+        tools.tracer.enable(early_args.trace)
+    if early_args.apply_plan is not None:
+        c.print('{!b}Applying plan %s' % (early_args.apply_plan,))
+        run(c, modules.PlannedModule.load(early_args.apply_plan))
+        return
+
     c.print('{!b}Registering modules')
 
-    nm = modules.NM()
-    dhcp = modules.DHCP()
-    nat = modules.NAT()
-    dns = modules.DNS()
-    firewall = modules.FIREWALL()
+    nm = create(modules.NM)
+    dhcp = create(modules.DHCP)
+    nat = create(modules.NAT)
+    dns = create(modules.DNS)
+    # DNS publishes the DHCP clients by name
+    dns.dhcp = dhcp
+    firewall = create(modules.FIREWALL)
+    # The nftables firewall leaves accepting forwarded traffic to the NAT table
+    firewall.nat = nat
 
     parser = argparse.ArgumentParser(description="Helper script to create and maintain a local temporary network.")
 
@@ -32,12 +121,24 @@ def main(argv):
     parser.add_argument('--ip', action='store', type=str, default='10.10.10.1',
                         help='This computers static ip address, default is 10.10.10.1')
     parser.add_argument('--subnet', action='store', type=int, default=24,
-                        help='DHCP subnet mask as number of bits, default is 24. For now only 24,16, and 8 are'
-                             'supported.')
+                        help='DHCP subnet mask as number of bits, default is 24.')
     parser.add_argument('--iprange', action='store', type=str, default='10.10.10.100 10.10.10.200',
                         help='Set address range for DHCP, default is "10.10.10.100 10.10.10.200"')
     parser.add_argument('--domain', action='store', type=str, default='localdomain',
                         help='Set the domain name for the local network, default is "localdomain"')
+    parser.add_argument('--segment', action='append', type=tools.Segment.parse, default=[],
+                        metavar='INTERFACE:IP/BITS[:FIRST-LAST]',
+                        help='Serve another local network segment on the given interface or 802.1q subinterface '
+                             '(e.g. eth0.10, created if missing), can be repeated. The DHCP range defaults to the .100 '
+                             'to .200 addresses of the subnet.')
+    parser.add_argument('--trace', action='store', type=str, default=None, metavar='FILE',
+                        help='Record the timing of all module phases and external commands and write it to FILE as '
+                             'Chrome trace-event JSON, to be opened in chrome://tracing or Perfetto.')
+    parser.add_argument('--plan', action='store', type=str, default=None, metavar='FILE',
+                        help='Do not change anything, but write all changes that would be made (commands, config files, '
+                             'daemons and how to undo them) to FILE.')
+    parser.add_argument('--apply-plan', action='store', type=str, default=None, metavar='FILE',
+                        help='Apply a plan written by --plan as it is, all other arguments are ignored.')
 
     nm.register_args(parser)
     dhcp.register_args(parser)
@@ -55,42 +156,25 @@ def main(argv):
         c.print('{!b}Interactive mode')
         args = tools.interactive(args)
 
-    c.print('{!b}Configuring modules')
-    nm.configure(args)
-    dhcp.configure(args)
-    nat.configure(args)
-    dns.configure(args)
-    firewall.configure(args)
-
-    c.print('{!b}Running modules')
     try:
-        nm.start()
-        dhcp.start()
-        nat.start()
-        dns.start()
-        firewall.start()
+        args.segments = tools.segments(args)
+    except ValueError as e:
+        c.error('{!r}Invalid network configuration: %s' % (e,))
+        sys.exit(200)
 
-        try:
-            while True:
-                dhcp.stdout.dump()
-                dns.stdout.dump()
-                time.sleep(0.1)
-
-        except KeyboardInterrupt:
-            pass
+    module_list = [nm, dhcp, nat, dns, firewall]
 
-    finally:
-        c.print('{!b}Stopping modules')
-        firewall.stop()
-        dns.stop()
-        nat.stop()
-        dhcp.stop()
-        nm.stop()
+    c.print('{!b}Configuring modules')
+    for module in module_list:
+        with tools.tracer.span('%s.configure' % (module.name,), 'module'):
+            module.configure(args)
 
-    dhcp.stdout.dump()
-    dns.stdout.dump()
+    if args.plan is not None:
+        tools.save_plan(tools.compile_plan(module_list), args.plan)
+        c.print('{!b}Plan written to %s' % (args.plan,))
+        return
 
-    c.print('{!b}Cleaned up.')
+    run(c, module_list)
 
 
 if __name__ == '__main__':
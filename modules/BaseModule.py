@@ -1,5 +1,6 @@
 import argparse
 from abc import ABC, abstractmethod
+from typing import List
 
 
 class BaseModule(ABC):
@@ -7,6 +8,16 @@ class BaseModule(ABC):
     Abstract baseclass for all modules
     """
 
+    # Class names of modules that have to be started before and stopped after this one
+    DEPENDS: List[str] = []
+
+    @property
+    def name(self) -> str:
+        """
+        Name of the module, as used in DEPENDS.
+        """
+        return self.__class__.__name__
+
     @staticmethod
     @abstractmethod
     def register_args(parser: argparse.ArgumentParser):
@@ -25,14 +36,32 @@ class BaseModule(ABC):
     @abstractmethod
     def start(self):
         """
-        Function to start/setup.
+        Function to start/setup. Runs concurrently with modules that do not depend on each other.
+        Should set running as soon as something was applied, so that stop() can roll back a partial start.
         """
         pass
 
-    @abstractmethod
-    def status(self):
+    def services(self) -> list:
+        """
+        Long running services (e.g. tools.Daemon) of this module, that are watched by the supervisor once started.
+        """
+        return []
+
+    def reload(self):
+        """
+        Apply changed configuration files while running, triggered by SIGHUP. Runs outside of the supervisor's thread.
+        """
         pass
 
+    def status(self) -> dict:
+        """
+        Report whether the module is running and whether its services are alive.
+        """
+        return {
+            'running': self.running,
+            'services': {service.name: service.status() for service in self.services()},
+        }
+
     @abstractmethod
     def stop(self):
         """
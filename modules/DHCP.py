@@ -1,9 +1,8 @@
 import argparse
-import os
 import subprocess
 import sys
-import tempfile
 import textwrap
+import threading
 
 import tools
 from modules import BaseModule
@@ -11,33 +10,62 @@ from modules import BaseModule
 
 class DHCP(BaseModule):
     """
-    Module to configure and start dhcpd independently from system config.
+    Module to configure and start dhcpd (or the builtin DHCP server) independently from system config.
     """
+    DEPENDS = ['NM']
 
     def __init__(self):
         self.running = False
         self.c = tools.ColorPrint(name=self.__class__.__name__)
         self.subprocess = tools.mysubprocess(self.__class__.__name__)
-        self.ip = None
-        self.mask = None
-        self.range = None
+        self.segments = []
+        self.vlans_created = []
         self.domain = None
         self.pxe_file = None
-        self.local_interface = None
         self.pidfile = None
         self.configfile = None
-        self.process = None
+        self.leasefile = None
+        self.leases = None
+        self.daemon = None
+        self.backend = 'dhcpd'
+        self.snapshot = None
+        self.reservations = None
+        self.reservations_file = None
+        self.reloading = threading.Lock()
+        self.omapi = None
         self.enabled = True
+        self.dhcpd_binary = None
+        self.dhcpd_version = None
+        self.ip_binary = None
+        self.ip_version = None
 
-        # This module requires dhcpd
-        self.dhcpd_binary = tools.locate('dhcpd')
-        if self.dhcpd_binary is None:
+    @staticmethod
+    def register_args(parser: argparse.ArgumentParser):
+        parser.add_argument('--dhcp-pidfile', action='store', type=str, default='/run/dhcpd.pid',
+                            help='Set path for dhcpd pidfile, default is "/run/dhcpd.pid"')
+        parser.add_argument('--dhcp-backend', action='store', choices=['dhcpd', 'builtin'], default='dhcpd',
+                            help='Serve DHCP with ISC dhcpd or with the builtin server, default is "dhcpd"')
+        parser.add_argument('--dhcp-snapshot', action='store', type=str, default=None, metavar='FILE',
+                            help='Keep the leases of the builtin server in FILE across runs')
+        parser.add_argument('--reservations', action='store', type=str, default=None, metavar='FILE',
+                            help='Reserve fixed addresses for the hosts listed in FILE, as CSV (mac,ip[,hostname]) or '
+                                 'JSON (objects with "mac", "ip" and "hostname"). The addresses must be in a local '
+                                 'subnet, but outside of its DHCP range.')
+
+    def probe(self):
+        """
+        Locate and probe ip and, unless the builtin server is used, dhcpd, both are mandatory.
+        """
+        # This module requires dhcpd, unless serving DHCP itself
+        self.dhcpd_binary = tools.locate('dhcpd') if self.backend == 'dhcpd' else None
+        if self.backend == 'builtin':
+            self.dhcpd_version = 'builtin'
+        elif self.dhcpd_binary is None:
             self.c.error('{!r}The DHCP module requires dhcpd to be installed and on $PATH. This is mandatory.')
             self.enabled = False
         else:
             try:
-                self.dhcpd_version = self.subprocess.check_output([self.dhcpd_binary, '--version'],
-                                                                  stderr=subprocess.STDOUT).strip()
+                self.dhcpd_version = tools.probe(self.subprocess, [self.dhcpd_binary, '--version']).strip()
                 if not self.dhcpd_version:
                     self.c.error('{!r}The DHCP module could not detect dhcpd version. This is mandatory.')
                     self.enabled = False
@@ -49,98 +77,223 @@ class DHCP(BaseModule):
         if self.ip_binary is None:
             self.c.error('{!r}The DHCP module requires "ip" to be installed and on $PATH. This is mandatory.')
             self.enabled = False
-
-        try:
-            self.ip_version = self.subprocess.check_output([self.ip_binary, '-V'], stderr=subprocess.STDOUT).strip()
-
-            if not self.ip_version:
-                self.c.error('{!r}The DHCP module could not detect "ip" version. This is mandatory.')
+        else:
+            try:
+                self.ip_version = tools.probe(self.subprocess, [self.ip_binary, '-V']).strip()
+                if not self.ip_version:
+                    self.c.error('{!r}The DHCP module could not detect "ip" version. This is mandatory.')
+                    self.enabled = False
+            except:
+                self.c.error('{!r}The DHCP module could not run "ip". This is mandatory.')
                 self.enabled = False
-        except:
-            self.c.error('{!r}The DHCP module could not run "ip". This is mandatory.')
-            self.enabled = False
-
-        self.stdout = tools.ThreadOutput('DHCP')
-
-    @staticmethod
-    def register_args(parser: argparse.ArgumentParser):
-        parser.add_argument('--dhcp-pidfile', action='store', type=str, default='/run/dhcpd.pid',
-                            help='Set path for dhcpd pidfile, default is "/run/dhcpd.pid"')
 
     def configure(self, args):
-        self.ip = args.ip
-        self.mask = args.subnet
-        self.range = args.iprange
+        self.backend = args.dhcp_backend
+        self.snapshot = args.dhcp_snapshot
+        self.probe()
+        self.segments = args.segments
         self.domain = args.domain
-        self.local_interface = args.local_interface
         self.pidfile = args.dhcp_pidfile
+        self.reservations_file = args.reservations
+        if self.reservations_file is None:
+            # Empty, but reservations can still be added while running
+            self.reservations = tools.Reservations(None, self.segments)
+            return
+        try:
+            with tools.tracer.span('DHCP.reservations', 'module', path=self.reservations_file):
+                self.reservations = tools.Reservations.load(self.reservations_file, self.segments)
+        except (OSError, ValueError) as e:
+            self.c.error('{!r}Invalid reservations: %s' % (e,))
+            sys.exit(200)
+        self.c.print('{!g}Loaded %d reservations from %s' % (len(self.reservations), self.reservations_file))
 
     def start(self):
         if not self.enabled:
             self.c.error('{!r}Cannot run DHCP module. exiting.')
             sys.exit(1)
 
-        self.configfile = tempfile.mkstemp(suffix='.conf', prefix='localnet_')[1]
-
-        subnet_bytes = self.mask // 8
-        subnet0 = '.'.join(self.ip.split('.')[:subnet_bytes]) + '.0' * (4 - subnet_bytes)
-        broadcast = '.'.join(self.ip.split('.')[:subnet_bytes]) + '.255' * (4 - subnet_bytes)
-        mask = '255' + '.255' * (subnet_bytes - 1) + '.0' * (4 - subnet_bytes)
+        if self.backend == 'dhcpd':
+            self.write_config()
+        self.running = True
 
-        config = textwrap.dedent('''
-            option domain-name "{domain}";
-            default-lease-time 600;
-            max-lease-time 7200;
-            log-facility local7;
-            subnet {subnet0} netmask {subnet_mask} {{
-                range {range};
-                option broadcast-address {broadcast};
-                option routers {ip};
-                option domain-name-servers {ip};
-                default-lease-time 14400;
-                max-lease-time 28800;
-            }}
-        ''').format(
-            domain=self.domain,
-            subnet0=subnet0,
-            subnet_mask=mask,
-            range=self.range,
-            broadcast=broadcast,
-            ip=self.ip,
-        )
-        with open(self.configfile, 'w') as f:
-            f.write(config)
-
-        # Setup interface and static ip
+        # Setup interfaces and static ips, creating missing 802.1q subinterfaces
+        vlans = []
         try:
-            self.subprocess.check_call([self.ip_binary, 'link', 'set', 'up', 'dev', self.local_interface])
-            self.subprocess.check_call([self.ip_binary, 'address', 'flush', 'dev', self.local_interface])
-            self.subprocess.check_call([self.ip_binary, 'address', 'add', '%s/%d' % (self.ip, self.mask), 'dev',
-                                        self.local_interface])
+            with self.subprocess.batch([self.ip_binary]) as batch:
+                for segment in self.segments:
+                    if segment.vlan is not None and not segment.exists():
+                        parent, vlan_id = segment.vlan
+                        batch.add('link', 'add', 'link', parent, 'name', segment.interface, 'type', 'vlan', 'id',
+                                  str(vlan_id))
+                        vlans.append(segment)
+                    batch.add('link', 'set', 'up', 'dev', segment.interface)
+                    batch.add('address', 'flush', 'dev', segment.interface)
+                    batch.add('address', 'add', '%s/%d' % (segment.ip, segment.prefixlen), 'dev', segment.interface)
         except subprocess.CalledProcessError as e:
+            # The batch runs with -force, so the subinterfaces that could be created exist and are deleted on stop
+            self.vlans_created = [segment.interface for segment in vlans if segment.exists()]
             if e.returncode == 2:
                 self.c.error(
                     '{!r}The "ip" command indicated that the kernel reported an error. Did you run this script with'
                     'elevated privileges?')
                 sys.exit(100)
+            self.c.error('{!r}Setting up the local interfaces failed: %s' % (e.stderr or e,))
+            raise
+        self.vlans_created = [segment.interface for segment in vlans]
+
+        if self.backend == 'builtin':
+            self.daemon = tools.DhcpServer('DHCP', self.segments, self.domain, self.snapshot, self.subprocess,
+                                           self.reservations)
+            self.daemon.start()
+            self.leases = self.daemon.leases
+            return
 
         # Start DHCPD
-        self.process = self.subprocess.Popen(
-            [self.dhcpd_binary, '-4', '-f', '-cf', self.configfile, '-pf', self.pidfile, self.local_interface],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        self.stdout.register(self.process)
-        self.stdout.start()
-        self.running = True
+        self.daemon = tools.Daemon('DHCP', [self.dhcpd_binary, '-4', '-f', '-cf', self.configfile, '-pf', self.pidfile,
+                                            '-lf', self.leasefile]
+                                   + [segment.interface for segment in self.segments], self.subprocess)
+        self.daemon.spawn()
+
+    def write_config(self):
+        """
+        Write the dhcpd config and create its lease file.
+        """
+        self.configfile = self.subprocess.tempfile(suffix='.conf', prefix='localnet_')
+
+        config = textwrap.dedent('''
+            option domain-name "{domain}";
+            default-lease-time 600;
+            max-lease-time 7200;
+            log-facility local7;
+        ''').format(domain=self.domain)
+        # One dhcpd serves all segments, one subnet declaration each
+        for segment in self.segments:
+            config += textwrap.dedent('''
+                subnet {subnet0} netmask {subnet_mask} {{
+                    range {range};
+                    option broadcast-address {broadcast};
+                    option routers {ip};
+                    option domain-name-servers {ip};
+                    default-lease-time 14400;
+                    max-lease-time 28800;
+                }}
+            ''').format(
+                subnet0=segment.subnet0,
+                subnet_mask=segment.netmask,
+                range=segment.range,
+                broadcast=segment.broadcast,
+                ip=segment.ip,
+            )
+        # Host declarations are global, dhcpd matches their fixed address to the subnet
+        config += '\n' + ''.join(self.reservations.render())
+
+        # OMAPI on a free port with a key of our own, to change hosts and query leases while dhcpd keeps running. Not
+        # when planning: an applied plan has no use for it, and its key and port would be fixed in the plan.
+        if self.subprocess.plan is None:
+            secret = tools.Omapi.generate_secret()
+            self.omapi = tools.Omapi('127.0.0.1', tools.Omapi.free_port(), 'localnet-omapi', secret)
+            config += '\n' + tools.Omapi.config(self.omapi.key_name, secret, self.omapi.port)
+        self.subprocess.write_file(self.configfile, config)
+
+        # A lease file of our own, dhcpd requires it to exist
+        self.leasefile = self.subprocess.tempfile(suffix='.leases', prefix='localnet_')
+        self.subprocess.write_file(self.leasefile, '')
+        self.leases = tools.LeaseIndex(self.leasefile)
+
+    def add_reservation(self, mac: str, ip: str, hostname: str = None):
+        """
+        Reserve ip for mac while running. Raises ValueError if the reservation is invalid or conflicts with another one,
+        tools.OmapiError if dhcpd did not take it.
+        """
+        self.reservations.add(mac, ip, hostname)
+        if self.omapi is None:
+            # The builtin server looks reservations up as clients ask
+            return
+        mac = tools.Reservations.normalize_mac(mac)
+        try:
+            self.omapi.add_host(tools.Reservations.host_name(mac), mac, ip, hostname)
+        except tools.OmapiError:
+            self.reservations.remove(mac)
+            raise
+
+    def remove_reservation(self, mac: str) -> bool:
+        """
+        Drop the reservation of mac while running, False if there is none. Raises tools.OmapiError if dhcpd did not
+        drop it.
+        """
+        mac = tools.Reservations.normalize_mac(mac)
+        if self.reservations.lookup_mac(mac) is None:
+            return False
+        if self.omapi is not None:
+            self.omapi.remove_host(tools.Reservations.host_name(mac))
+        return self.reservations.remove(mac)
+
+    def lookup_lease(self, ip: str = None, mac: str = None):
+        """
+        The current lease of ip or mac as a tools.Lease, asking dhcpd over OMAPI. None if there is none.
+        """
+        if self.omapi is not None:
+            return self.omapi.lookup_lease(ip=ip, mac=mac)
+        if self.leases is None:
+            return None
+        return self.leases.lookup_ip(ip) if ip is not None else self.leases.lookup_mac(mac.lower())
+
+    def reload(self):
+        """
+        Read the reservations file again and apply what changed, without restarting dhcpd.
+        """
+        if not self.running or self.reservations_file is None:
+            return
+        with self.reloading:
+            try:
+                reservations = tools.Reservations.load(self.reservations_file, self.segments)
+            except (OSError, ValueError) as e:
+                self.c.error('{!r}Keeping the current reservations, %s is invalid: %s' % (self.reservations_file, e))
+                return
+            # Removed first, so that addresses and hostnames can move to another mac
+            removed = [mac for mac, entry in self.reservations.macs.items() if reservations.macs.get(mac) != entry]
+            added = [mac for mac, entry in reservations.macs.items() if self.reservations.macs.get(mac) != entry]
+            with tools.tracer.span('DHCP.reload', 'module', removed=len(removed), added=len(added)):
+                for mac in removed:
+                    self.remove_reservation(mac)
+                for mac in added:
+                    self.add_reservation(mac, *reservations.lookup_mac(mac))
+            self.c.print('{!g}Reservations reloaded, %d removed, %d added' % (len(removed), len(added)))
+
+    def services(self) -> list:
+        if self.backend == 'builtin':
+            # The builtin server maintains its lease index itself
+            return [self.daemon] if self.daemon is not None else []
+        return [service for service in (self.daemon, self.leases) if service is not None]
 
-    def status(self):
-        pass
+    def status(self) -> dict:
+        status = super().status()
+        status['reservations'] = len(self.reservations) if self.reservations is not None else 0
+        if self.omapi is not None:
+            status['omapi'] = '%s:%d' % (self.omapi.host, self.omapi.port)
+        return status
 
     def stop(self):
         if not self.enabled or not self.running:
             return
 
-        self.process.terminate()
-        self.stdout.stop()
-        self.subprocess.check_call([self.ip_binary, 'address', 'flush', 'dev', self.local_interface])
-        os.remove(self.configfile)
+        if self.daemon is not None:
+            self.daemon.stop()
+            self.daemon = None
+        with self.subprocess.batch([self.ip_binary]) as batch:
+            for segment in self.segments:
+                if segment.interface in self.vlans_created:
+                    batch.add('link', 'delete', 'dev', segment.interface)
+                else:
+                    batch.add('address', 'flush', 'dev', segment.interface)
+        self.vlans_created = []
+        if self.backend == 'dhcpd':
+            self.subprocess.remove_file(self.configfile)
+            # dhcpd keeps the previous lease file as a backup when compacting
+            self.subprocess.remove_file(self.leasefile)
+            self.subprocess.remove_file(self.leasefile + '~', missing_ok=True)
+        if self.omapi is not None:
+            self.omapi.close()
+            self.omapi = None
+        self.leases = None
         self.running = False
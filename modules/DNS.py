@@ -1,9 +1,14 @@
 import argparse
+import asyncio
+import ipaddress
 import os
 import re
 import subprocess
+import sys
 import tempfile
 import textwrap
+import threading
+import time
 
 import tools
 from modules import BaseModule
@@ -11,34 +16,99 @@ from modules import BaseModule
 
 class DNS(BaseModule):
     """
-    Module to configure and start unbound independently from system config.
+    Module to configure and start unbound (or the builtin DNS forwarder) independently from system config.
+    The active DHCP leases are published as A and PTR records under the domain, changes are pushed to the running
+    server as the leases change.
     """
+    DEPENDS = ['DHCP']
+    CONTROL_DELAY = 1.0
+    CONTROL_TIMEOUT = 5.0
 
     def __init__(self):
         self.running = False
         self.c = tools.ColorPrint(name=self.__class__.__name__)
         self.subprocess = tools.mysubprocess(self.__class__.__name__)
-        self.mask = None
-        self.ip = None
+        self.segments = []
         self.configfile = None
-        self.process = None
+        self.daemon = None
         self.enabled = True
         self.enabled_user = None
+        self.binary = None
+        self.version = None
+        self.backend = 'unbound'
+        self.upstreams = []
+        self.forwarders = []
+        self.cache_size = None
+        self.cache_file = None
+        self.warmup_file = None
+        self.warmup_names = []
+        self.domain = None
+        self.dhcp = None
+        self.records = None
+        self.configured = []
+        # The records unbound has, and those it should have, brought up to date by a worker thread
+        self.published = {}
+        self.wanted = None
+        self.pushing = False
+        self.push_lock = threading.Lock()
+        self.control_binary = None
+        self.checkconf_binary = None
+        self.profile = 'default'
+        self.libevent = False
 
-        # This module requires unbound
+    @staticmethod
+    def register_args(parser: argparse.ArgumentParser):
+        parser.add_argument('--dns-backend', action='store', choices=['unbound', 'builtin'], default='unbound',
+                            help='Serve DNS with unbound or with the builtin caching forwarder, default is "unbound"')
+        parser.add_argument('--dns-upstream', action='append', type=tools.DnsForwarder.parse_upstream, default=None,
+                            metavar='IP[:PORT]',
+                            help='Forward queries to this server instead of resolving them, can be repeated, default '
+                                 'are the nameservers in /etc/resolv.conf for the builtin forwarder, unbound resolves '
+                                 'queries itself')
+        parser.add_argument('--dns-cache-size', action='store', type=int, default=16, metavar='MB',
+                            help='Memory for the cache of the builtin forwarder in MB, default is 16')
+        parser.add_argument('--dns-cache-file', action='store', type=str, default=None, metavar='FILE',
+                            help='Keep the DNS cache in FILE across runs, it is saved on exit and loaded on start')
+        parser.add_argument('--dns-warmup', action='store', type=str, default=None, metavar='FILE',
+                            help='Resolve the names listed in FILE (one per line) right after starting, so they are '
+                                 'cached when clients ask for them')
+        parser.add_argument('--dns-profile', action='store', choices=tools.UNBOUND_PROFILES, default='default',
+                            help='Scale threads and caches of unbound to the cores and memory of this host for a small, '
+                                 'default or large network, default is "default"')
+
+    def probe(self):
+        """
+        Locate and probe unbound, only done if the module is going to run. The builtin forwarder needs upstream servers
+        instead.
+        """
+        if self.backend == 'builtin':
+            self.version = 'builtin'
+            if not self.upstreams:
+                self.c.error('{!r}The builtin DNS forwarder has no upstream server, give one with --dns-upstream.')
+                self.enabled = False
+            return
+
+        # This module requires unbound, and unbound-control to publish DHCP clients
         self.binary = tools.locate('unbound')
+        self.control_binary = tools.locate('unbound-control')
+        self.checkconf_binary = tools.locate('unbound-checkconf')
+        if self.control_binary is None:
+            self.c.print('{!y}unbound-control was not found, DHCP clients will only be resolvable by the names they had '
+                         'when starting.')
         if self.binary is None:
             self.c.error('{!r}The DNS module requires unbound to be installed and on $PATH.')
             self.enabled = False
         else:
             try:
                 try:
-                    version_response = self.subprocess.check_output([self.binary, '-V'], stderr=subprocess.STDOUT).strip()
+                    version_response = tools.probe(self.subprocess, [self.binary, '-V']).strip()
                 except subprocess.CalledProcessError as e:
                     version_response = e.stdout.decode()
                 finally:
                     find_version = re.compile(r'Version\s*(?P<version>[\d\.]+)')
                     match = find_version.search(version_response)
+                    # Otherwise built with its internal select() based event loop
+                    self.libevent = 'libevent' in version_response
                     if not match:
                         self.c.print('{!y}The DNS module could not detect unbound version.')
                         self.enabled = False
@@ -54,58 +124,306 @@ class DNS(BaseModule):
                 if self.enabled:
                     self.c.print('{!g}The DNS module was configured successfully.')
 
-        self.stdout = tools.ThreadOutput('DNS')
-
-    @staticmethod
-    def register_args(parser: argparse.ArgumentParser):
-        pass
-
     def configure(self, args):
-        if not self.enabled and (args.internet_interface is not None):
-            self.c.error('{!r}DNS module requested, but it will not run!')
+        self.backend = args.dns_backend
+        self.profile = args.dns_profile
+        self.cache_size = args.dns_cache_size * 1024 * 1024
+        self.cache_file = args.dns_cache_file
+        self.warmup_file = args.dns_warmup
+        # Never forward to ourselves
+        own = {segment.ip for segment in args.segments}
+        self.upstreams = [upstream for upstream in args.dns_upstream or tools.DnsForwarder.system_upstreams()
+                          if upstream[0] not in own]
+        self.forwarders = [upstream for upstream in args.dns_upstream or [] if upstream[0] not in own]
+        if args.internet_interface is not None:
+            self.probe()
+            if not self.enabled:
+                self.c.error('{!r}DNS module requested, but it will not run!')
 
         self.enabled_user = self.enabled and (args.internet_interface is not None)
-        self.mask = args.subnet
-        self.ip = args.ip
+        self.segments = args.segments
+        self.domain = args.domain
+        if self.warmup_file is not None and self.enabled_user:
+            try:
+                with open(self.warmup_file) as f:
+                    self.warmup_names = [line.split()[0] for line in f
+                                         if line.strip() and not line.lstrip().startswith('#')]
+            except OSError as e:
+                self.c.error('{!r}Invalid warm-up list: %s' % (e,))
+                sys.exit(200)
 
     def start(self):
         if not self.enabled_user:
             return
 
-        self.configfile = tempfile.mkstemp(suffix='.conf', prefix='localnet_')[1]
+        self.records = tools.HostRecords(self.domain)
+        if self.backend == 'builtin':
+            self.running = True
+            self.daemon = tools.DnsForwarder('DNS', self.segments, self.upstreams, self.cache_size, self.subprocess,
+                                             domain=self.domain, cache_file=self.cache_file)
+            self.daemon.start()
+            self.watch_leases()
+            self.warm_up()
+            return
 
-        subnet_bytes = self.mask // 8
-        subnet0 = '.'.join(self.ip.split('.')[:subnet_bytes]) + '.0' * (4 - subnet_bytes)
+        self.configfile = self.subprocess.tempfile(suffix='.conf', prefix='localnet_')
 
         config = textwrap.dedent('''
                     server:
                         verbosity: 1
-                        interface: {ip}
-                        access-control: {subnet0}/{mask_bits} allow
-                ''').format(
-            ip=self.ip,
-            subnet0=subnet0,
-            mask_bits=self.mask
-        )
-        with open(self.configfile, 'w') as f:
-            f.write(config)
+                ''')
+        profile = tools.unbound_profile(self.profile, libevent=self.libevent)
+        config += ''.join('    %s: %s\n' % option for option in profile)
+        # One unbound serves all segments
+        for segment in self.segments:
+            config += '    interface: %s\n    access-control: %s allow\n' % (segment.ip, segment.network)
+        # The clients with a lease so far, later ones are pushed through unbound-control
+        leases = self.dhcp.leases if self.dhcp is not None and self.subprocess.plan is None else None
+        if leases is not None:
+            self.records.update(dict(leases.ips))
+        self.configured = list(self.records.records())
+        self.published = dict(self.configured)
+        config += '    local-zone: "%s." static\n' % (self.records.domain,)
+        for name, ip in self.records.records():
+            config += ''.join('    local-data: "%s"\n' % (record,) for record in tools.HostRecords.local_data(name, ip))
+        if self.forwarders:
+            if any(ipaddress.IPv4Address(ip).is_loopback for ip, _ in self.forwarders):
+                config += '    do-not-query-localhost: no\n'
+            config += '\nforward-zone:\n    name: "."\n'
+            config += ''.join('    forward-addr: %s@%d\n' % forwarder for forwarder in self.forwarders)
+        config += textwrap.dedent('''
+                    remote-control:
+                        control-enable: yes
+                        control-use-cert: no
+                        control-interface: {control}
+                ''').format(control=self.configfile + '.ctl')
+        self.subprocess.write_file(self.configfile, config)
+        self.running = True
+        self.check_config()
+        self.c.print('{!g}unbound profile %s: %s' % (self.profile, ', '.join('%s %s' % option for option in profile)))
 
         # Start DNS server
-        self.process = self.subprocess.Popen(
-            [self.binary, '-d', '-c', self.configfile],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        self.stdout.register(self.process)
-        self.stdout.start()
-        self.running = True
+        self.daemon = tools.Daemon('DNS', [self.binary, '-d', '-c', self.configfile], self.subprocess,
+                                   on_restart=self.republish)
+        self.daemon.spawn()
+        self.watch_leases()
+        if self.cache_file is not None and self.subprocess.plan is None:
+            self.load_cache()
+        self.warm_up()
+
+    def check_config(self):
+        """
+        Have unbound-checkconf validate the config before unbound is started with it, raises
+        subprocess.CalledProcessError if it is invalid.
+        """
+        if self.subprocess.plan is not None:
+            return
+        if self.checkconf_binary is None:
+            self.c.print('{!y}unbound-checkconf was not found, the config is not validated.')
+            return
+        try:
+            self.subprocess.check_output([self.checkconf_binary, self.configfile], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            self.c.error('{!r}unbound-checkconf rejected the config, try another --dns-profile.')
+            raise
+
+    def control(self, command: str, input_text: str = None):
+        """
+        Run an unbound-control command, returns (returncode, output) with a returncode of None if it could not be run.
+        """
+        try:
+            returncode, out, err = self.subprocess.communicate(
+                [self.control_binary, '-c', self.configfile, command], input_text)
+        except OSError as e:
+            return None, str(e)
+        return returncode, out if returncode == 0 else (err or out).strip()
+
+    def load_cache(self):
+        """
+        Load the cache saved by the last run into unbound, once it accepts commands.
+        """
+        if self.control_binary is None:
+            self.c.print('{!y}unbound-control was not found, the DNS cache is not loaded.')
+            return
+        try:
+            age = time.time() - os.stat(self.cache_file).st_mtime
+            with open(self.cache_file) as f:
+                dump = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self.c.error('{!y}Ignoring unreadable DNS cache %s: %s' % (self.cache_file, e))
+            return
+        if age > tools.DnsForwarder.MAX_TTL:
+            self.c.print('{!y}Ignoring the DNS cache %s, it was saved %.0f hours ago.' % (self.cache_file, age / 3600))
+            return
+        # unbound loads the TTLs as they were when dumped, so they are reduced by the time since and expired entries
+        # are left out
+        try:
+            dump, kept, dropped = tools.age_cache_dump(dump, max(age, 0))
+        except ValueError as e:
+            self.c.error('{!y}Ignoring the DNS cache %s: %s' % (self.cache_file, e))
+            return
+        deadline = time.monotonic() + DNS.CONTROL_TIMEOUT
+        with tools.tracer.span('DNS.load_cache', 'module', bytes=len(dump)):
+            while self.control('status')[0] != 0:
+                if time.monotonic() > deadline or not self.daemon.alive:
+                    self.c.error('{!y}unbound did not accept commands, the DNS cache is not loaded.')
+                    return
+                time.sleep(0.05)
+            returncode, output = self.control('load_cache', dump)
+        if returncode != 0:
+            self.c.error('{!y}Loading the DNS cache %s failed: %s' % (self.cache_file, output))
+        else:
+            self.c.print('{!g}Loaded the DNS cache from %s, %d rrsets (%d expired since it was saved)' % (
+                self.cache_file, kept, dropped))
+
+    def save_cache(self):
+        """
+        Save the cache of the running unbound, to be loaded by the next run.
+        """
+        if self.control_binary is None or not self.daemon.alive:
+            return
+        with tools.tracer.span('DNS.save_cache', 'module'):
+            returncode, output = self.control('dump_cache')
+        if returncode != 0:
+            self.c.error('{!r}Could not save the DNS cache: %s' % (output,))
+            return
+        try:
+            directory = os.path.dirname(os.path.abspath(self.cache_file))
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.dnscache_')
+            with os.fdopen(fd, 'w') as f:
+                f.write(output)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            self.c.error('{!r}Could not save the DNS cache %s: %s' % (self.cache_file, e))
+
+    def warm_up(self):
+        """
+        Resolve the names of the warm-up list in the background, through the first segment's address like a client.
+        """
+        if not self.warmup_names or self.subprocess.plan is not None:
+            return
+
+        def resolve():
+            started = time.monotonic()
+            try:
+                answered = asyncio.run(tools.dns_warmup(self.segments[0].ip, self.warmup_names))
+            except OSError as e:
+                self.c.error('{!y}DNS warm-up failed: %s' % (e,))
+                return
+            self.c.print('{!g}Warmed up the DNS cache with %d of %d names in %.1fs' % (
+                answered, len(self.warmup_names), time.monotonic() - started))
+
+        threading.Thread(target=resolve, name='DNS warm-up', daemon=True).start()
+
+    def watch_leases(self):
+        """
+        Follow the leases of the DHCP module from now on.
+        """
+        if self.dhcp is None or self.dhcp.leases is None or self.subprocess.plan is not None:
+            return
+        if self.backend == 'builtin':
+            self.publish(dict(self.dhcp.leases.ips))
+        self.dhcp.leases.listeners.append(self.publish)
+
+    def publish(self, changes: dict):
+        """
+        Listener of the DHCP lease index, updates the records of the clients whose leases changed in the running server.
+        """
+        removed, added = self.records.update(changes)
+        if not removed and not added:
+            return
+        with tools.tracer.span('DNS.publish', 'module', removed=len(removed), added=len(added)):
+            if self.backend == 'builtin':
+                for name, _ in removed:
+                    self.daemon.remove_host(name)
+                for name, ip in added:
+                    self.daemon.set_host(name, ip)
+            else:
+                self.schedule_push()
+
+    def schedule_push(self):
+        """
+        Bring the records of the running unbound up to date with unbound-control in a worker thread, so it does not hold
+        up the event loop. Changes made while a push is running are merged into the next one.
+        """
+        with self.push_lock:
+            self.wanted = dict(self.records.records())
+            if self.pushing:
+                return
+            self.pushing = True
+        self.daemon.loop.run_in_executor(None, self._push_pending)
+
+    def _push_pending(self):
+        while True:
+            with self.push_lock:
+                wanted, self.wanted = self.wanted, None
+                if wanted is None:
+                    self.pushing = False
+                    return
+                published = self.published
+            removed = [(name, ip) for name, ip in published.items() if wanted.get(name) != ip]
+            added = [(name, ip) for name, ip in wanted.items() if published.get(name) != ip]
+            if self.push(removed, added):
+                with self.push_lock:
+                    # Unless unbound was restarted meanwhile, see republish
+                    if self.published is published:
+                        self.published = wanted
+
+    def push(self, removed, added) -> bool:
+        """
+        Remove and add records in the running unbound, without reloading it. False if unbound-control failed.
+        """
+        daemon = self.daemon
+        if self.control_binary is None or daemon is None or not daemon.alive:
+            return False
+        removed_names = [name for name, _ in removed] + [tools.HostRecords.pointer(ip) for _, ip in removed]
+        records = [record for name, ip in added for record in tools.HostRecords.local_data(name, ip)]
+        for command, lines in (('local_datas_remove', removed_names), ('local_datas', records)):
+            if not lines:
+                continue
+            returncode, output = self.control(command, '\n'.join(lines) + '\n')
+            if returncode != 0:
+                self.c.error('{!r}Updating DNS records failed: %s' % (output,))
+                return False
+        return True
+
+    def republish(self):
+        """
+        unbound was restarted with the records it was started with, bring them up to date once it accepts commands.
+        """
+        self.daemon.loop.call_later(DNS.CONTROL_DELAY, self._republish)
+
+    def _republish(self):
+        if self.daemon is None:
+            return
+        with self.push_lock:
+            self.published = dict(self.configured)
+        self.schedule_push()
+
+    def services(self) -> list:
+        return [self.daemon] if self.daemon is not None else []
 
-    def status(self):
-        pass
+    def status(self) -> dict:
+        status = super().status()
+        status['records'] = len(self.records) if self.records is not None else 0
+        return status
 
     def stop(self):
         if not self.enabled_user or not self.running:
             return
 
-        self.process.terminate()
-        self.stdout.stop()
-        os.remove(self.configfile)
+        if self.dhcp is not None and self.dhcp.leases is not None and self.publish in self.dhcp.leases.listeners:
+            self.dhcp.leases.listeners.remove(self.publish)
+        if self.daemon is not None:
+            if self.cache_file is not None and self.backend == 'unbound' and self.subprocess.plan is None:
+                self.save_cache()
+            self.daemon.stop()
+            self.daemon = None
+        if self.configfile is not None:
+            self.subprocess.remove_file(self.configfile)
+            # unbound removes its control socket itself, unless it was killed
+            self.subprocess.remove_file(self.configfile + '.ctl', missing_ok=True)
+            self.configfile = None
         self.running = False
@@ -1,7 +1,6 @@
 import argparse
 import subprocess
-import sys
-from typing import List
+from typing import Dict, List, Optional
 
 import tools
 from modules import BaseModule
@@ -9,135 +8,325 @@ from modules import BaseModule
 
 class FIREWALL(BaseModule):
     """
-    Module to reconfigure firewalld/ufw to allow packet forwarding.
+    Module to reconfigure firewalld/ufw, or add nftables rules, to allow packet forwarding.
     """
-    SUPPORTED = {'firewall-cmd': 'firewall daemon'}
+    SUPPORTED = {'firewall-cmd': 'firewall daemon', 'firewalld': 'firewall daemon over D-Bus',
+                 'nftables': 'own nftables table, no daemon'}
+    # Backends talking to a daemon directly, mapped to the cmd tool that is installed along with the daemon
+    DIRECT = {'firewalld': 'firewall-cmd'}
+    # Backend without a daemon, only used if selected with --firewall-type
+    NATIVE = 'nftables'
+    TABLE = 'inet localnet_firewall'
+    DEPENDS = ['NM']
 
     def __init__(self):
         self.running = False
         self.c = tools.ColorPrint(name=self.__class__.__name__)
         self.subprocess = tools.mysubprocess(self.__class__.__name__)
 
-        self.local_interface = None
+        self.segments = []
         self.internet_interface = None
         self.firewall_type = None
         self.enabled = True
-        self.local_zone = None
         self.internet_zone = None
         self.query_forward = None
         self.dns_allowed = None
-
-        firewalls_detected = FIREWALL.find_available()
-        if len(firewalls_detected) == 0:
-            self.c.error('{!r}The FIREWALL module found no installed firewall cmd tools, this may still be ok. '
-                         'This module will not run!')
-            self.enabled = False
-        elif len(firewalls_detected) == 1:
-            self.firewall_type = firewalls_detected[0]
-        else:
-            self.c.error(
-                '{!r}The FIREWALL module found multiple installed firewall cmd tools, please specify by argument which '
-                'one to use. This module will not run!')
-            self.enabled = False
-
-        self.binary = tools.locate(self.firewall_type)
-        if self.binary is None:
-            self.c.error(
-                '{!r}The FIREWALL module could not find the cmd tool for the configured firewall type. This module will '
-                'not run!')
-            self.enabled = False
+        # Interfaces moved into the internet zone, mapped to the zone they were in before
+        self.moved_interfaces: Dict[str, Optional[str]] = {}
+        self.binary = None
+        self.dbus_address = None
+        self.firewalld = None
+        # The NAT module, whose table accepts forwarded traffic already
+        self.nat = None
 
     @staticmethod
     def register_args(parser: argparse.ArgumentParser):
         parser.add_argument('--firewall-type', action='store', type=str, default=None,
-                            help='Set firewall type to configure manually, selected automatically by default')
-        parser.add_argument('--no-firewall', action='store_true', default=False, help='Do not configure firewalld')
+                            help='Set firewall type to configure manually, one of %s, selected automatically by '
+                                 'default. nftables only adds accept rules in a table of its own, which cannot '
+                                 'override drops of another active firewall' % (', '.join(FIREWALL.SUPPORTED.keys()),))
+        parser.add_argument('--no-firewall', action='store_true', default=False, help='Do not configure the firewall')
+        parser.add_argument('--firewall-dbus', action='store', type=str, default=None, metavar='ADDRESS',
+                            help='Talk to firewalld on this D-Bus, e.g. "unix:path=/run/test_bus", default is the '
+                                 'system bus')
 
     @staticmethod
     def find_available() -> List[str]:
         found: List[str] = []
         for item in FIREWALL.SUPPORTED.keys():
-            if tools.locate(item) is not None:
+            if item not in FIREWALL.DIRECT and item != FIREWALL.NATIVE and tools.locate(item) is not None:
                 found.append(item)
 
         return found
 
-    def configure(self, args):
-        if args.firewall_type is None:
-            self.firewall_type = None
-        else:
-            if str(args.firewall_type) not in FIREWALL.SUPPORTED.keys():
-                self.c.error('{!}module does not recognize firewall type "%s". This module will not run!')
+    @staticmethod
+    def preferred(firewall_type: str, dbus_address: str = None) -> str:
+        """
+        The backend to use for a detected cmd tool: firewall-cmd would just make D-Bus calls, so they are made directly
+        if the bus is there.
+        """
+        for direct, tool in FIREWALL.DIRECT.items():
+            if firewall_type == tool and tools.Firewalld.available(dbus_address):
+                return direct
+        return firewall_type
+
+    def probe(self, firewall_type):
+        """
+        Select the given firewall type or detect the installed one and locate its cmd tool.
+        Only done if the module is going to run.
+        """
+        if firewall_type is None:
+            firewalls_detected = FIREWALL.find_available()
+            if len(firewalls_detected) == 0:
+                self.c.error('{!r}The FIREWALL module found no installed firewall cmd tools, this may still be ok. '
+                             'This module will not run!')
+                self.enabled = False
+                return
+            elif len(firewalls_detected) > 1:
+                self.c.error(
+                    '{!r}The FIREWALL module found multiple installed firewall cmd tools, please specify by argument '
+                    'which one to use. This module will not run!')
+                self.enabled = False
+                return
+            firewall_type = FIREWALL.preferred(firewalls_detected[0], self.dbus_address)
+        elif str(firewall_type) not in FIREWALL.SUPPORTED.keys():
+            self.c.error('{!r}The FIREWALL module does not recognize firewall type "%s". This module will not run!' % (
+                firewall_type,))
+            self.enabled = False
+            return
+
+        self.firewall_type = firewall_type
+        if self.firewall_type == 'firewalld':
+            if not tools.Firewalld.available(self.dbus_address):
+                self.c.error('{!r}The FIREWALL module found no D-Bus to reach firewalld on. This module will not run!')
+                self.enabled = False
+            return
+        if self.firewall_type == FIREWALL.NATIVE:
+            if not self.probe_nftables():
+                self.c.error('{!r}The FIREWALL module requires nft (nftables) to be installed and on $PATH. This module '
+                             'will not run!')
                 self.enabled = False
-        if args.no_firewall:
+            return
+        self.binary = tools.locate(self.firewall_type)
+        if self.binary is None:
+            self.c.error(
+                '{!r}The FIREWALL module could not find the cmd tool for the configured firewall type. This module will '
+                'not run!')
             self.enabled = False
 
-        self.local_interface = args.local_interface
+    def probe_nftables(self) -> bool:
+        """
+        Locate nft, the batches run in-process instead if libnftables is installed, so nft is not required then.
+        """
+        self.binary = tools.locate('nft')
+        if self.binary is None and tools.Nftables.load() is not None:
+            self.binary = 'nft'
+        return self.binary is not None
+
+    def configure(self, args):
+        # Without internet_interface there is nothing to forward
+        if args.no_firewall or args.internet_interface is None:
+            self.enabled = False
+        else:
+            self.dbus_address = args.firewall_dbus
+            self.probe(args.firewall_type)
+
+        self.segments = args.segments
         self.internet_interface = args.internet_interface
 
     def start(self):
         if not self.enabled:
             return
-        if self.firewall_type == 'firewall-cmd':
+        if self.firewall_type == 'firewalld':
+            self.start_firewalld()
+        elif self.firewall_type == FIREWALL.NATIVE:
+            # The whole table in a single transaction, replacing one left over by a previous run
+            self.running = True
+            with self.subprocess.batch([self.binary]) as batch:
+                for line in self.ruleset().splitlines():
+                    batch.add(line)
+        elif self.firewall_type == 'firewall-cmd':
             try:
                 self.internet_zone = self.subprocess.check_output(
                     ['firewall-cmd', '--get-zone-of-interface=%s' % (self.internet_interface,)]).strip()
             except subprocess.CalledProcessError:
-                self.c.error('{!r}Your main interface is not assigned to a zone, dont know what to do now...',
-                             file=sys.stderr)
+                self.c.error('{!r}Your main interface is not assigned to a zone, dont know what to do now...')
                 self.enabled = False
                 return
-            try:
-                self.local_zone = self.subprocess.check_output(
-                    ['firewall-cmd', '--get-zone-of-interface=%s' % (self.local_interface,)]).strip()
-            except subprocess.CalledProcessError:
-                self.local_zone = None
+            for segment in self.segments:
+                try:
+                    local_zone = self.subprocess.check_output(
+                        ['firewall-cmd', '--get-zone-of-interface=%s' % (segment.interface,)]).strip()
+                except subprocess.CalledProcessError:
+                    local_zone = None
 
-            if self.local_zone != self.internet_zone:
-                if self.local_zone is not None:
-                    self.subprocess.check_call(
-                        ['firewall-cmd', '--zone=%s' % (self.local_zone,),
-                         '--remove-interface=%s' % (self.local_interface,)])
-                self.subprocess.check_call(
-                    ['firewall-cmd', '--zone=%s' % (self.internet_zone,),
-                     '--add-interface=%s' % (self.local_interface,)])
+                if local_zone != self.internet_zone:
+                    self.moved_interfaces[segment.interface] = local_zone
 
             try:
-                self.subprocess.check_call(['firewall-cmd', '--zone=%s' % (self.internet_zone,), '--query-forward'])
+                self.subprocess.check_output(['firewall-cmd', '--zone=%s' % (self.internet_zone,), '--query-forward'])
                 self.query_forward = True
             except subprocess.CalledProcessError:
-                self.subprocess.check_call(['firewall-cmd', '--zone=%s' % (self.internet_zone,), '--add-forward'])
                 self.query_forward = False
 
             try:
-                self.subprocess.check_call(['firewall-cmd', '--zone=%s' % (self.internet_zone,), '--query-service=dns'])
+                self.subprocess.check_output(
+                    ['firewall-cmd', '--zone=%s' % (self.internet_zone,), '--query-service=dns'])
                 self.dns_allowed = True
             except subprocess.CalledProcessError:
-                self.subprocess.check_call(['firewall-cmd', '--zone=%s' % (self.internet_zone,), '--add-service=dns'])
                 self.dns_allowed = False
+
+            # All changes in as few calls as possible. If this fails partway, undoing changes that were not applied
+            # only results in warnings from firewall-cmd.
+            self.running = True
+            with self.subprocess.batch([self.binary]) as batch:
+                for interface, local_zone in sorted(self.moved_interfaces.items(), key=lambda item: str(item[1])):
+                    if local_zone is not None:
+                        batch.add('--zone=%s' % (local_zone,), '--remove-interface=%s' % (interface,))
+                for interface in self.moved_interfaces.keys():
+                    batch.add('--zone=%s' % (self.internet_zone,), '--add-interface=%s' % (interface,))
+                if not self.query_forward:
+                    batch.add('--zone=%s' % (self.internet_zone,), '--add-forward')
+                if not self.dns_allowed:
+                    batch.add('--zone=%s' % (self.internet_zone,), '--add-service=dns')
+        self.running = True
+
+    def ruleset(self) -> str:
+        """
+        Render the localnet_firewall nft table as a ruleset document. Its chains run before those of other tables at the
+        default filter priority 0 and only accept: DNS and DHCP to this host from the local segments and, unless the
+        NAT table does so already, forwarding from them to internet_interface and back for replies.
+        """
+        lines = [
+            'table %s' % (FIREWALL.TABLE,),
+            'delete table %s' % (FIREWALL.TABLE,),
+            'table %s {' % (FIREWALL.TABLE,),
+            '    set lan_interfaces {',
+            '        type ifname',
+            '        elements = { %s }' % (', '.join('"%s"' % (segment.interface,) for segment in self.segments),),
+            '    }',
+            '    chain input {',
+            '        type filter hook input priority -10;',
+            '        iifname @lan_interfaces udp dport { 53, 67 } accept',
+            '        iifname @lan_interfaces tcp dport 53 accept',
+            '    }',
+        ]
+        if self.nat is None or not self.nat.enabled_user:
+            lines += [
+                '    chain forward {',
+                '        type filter hook forward priority -10;',
+                '        iifname @lan_interfaces oifname "%s" accept' % (self.internet_interface,),
+                '        iifname "%s" oifname @lan_interfaces ct state { established, related } accept' % (
+                    self.internet_interface,),
+                '    }',
+            ]
+        lines.append('}')
+        return ''.join(line + '\n' for line in lines)
+
+    def start_firewalld(self):
+        """
+        The same changes as with firewall-cmd, with all queries and all changes sent at once over one connection.
+        """
+        self.firewalld = tools.Firewalld(self.subprocess, self.dbus_address)
+        try:
+            queried = self.query_firewalld()
+        except Exception:
+            self.firewalld.close()
+            self.firewalld = None
+            raise
+        if not queried:
+            self.firewalld.close()
+            self.firewalld = None
+            self.enabled = False
+            return
+
         self.running = True
+        calls = []
+        for interface, local_zone in sorted(self.moved_interfaces.items(), key=lambda item: str(item[1])):
+            if local_zone is not None:
+                calls.append(('removeInterface', 'ss', (local_zone, interface)))
+        for interface in self.moved_interfaces.keys():
+            calls.append(('addInterface', 'ss', (self.internet_zone, interface)))
+        if not self.query_forward:
+            calls.append(('addForward', 'si', (self.internet_zone, 0)))
+        if not self.dns_allowed:
+            calls.append(('addService', 'ssi', (self.internet_zone, 'dns', 0)))
+        self.firewalld.apply(calls)
+
+    def query_firewalld(self) -> bool:
+        """
+        Query the zones of the interfaces, and whether forwarding and the dns service are enabled in the zone of
+        internet_interface. Returns False if there is nothing the module can do.
+        """
+        interfaces = [self.internet_interface] + [segment.interface for segment in self.segments]
+        try:
+            zones = self.firewalld.query([('getZoneOfInterface', 's', (interface,)) for interface in interfaces])
+        except tools.DBusError as e:
+            self.c.error('{!r}Cannot reach firewalld: %s. This module will not run!' % (e,))
+            return False
+        # Interfaces without a zone have the empty zone
+        zones = [zone if isinstance(zone, str) and zone else None for zone in zones]
+        self.internet_zone = zones[0]
+        if self.internet_zone is None:
+            self.c.error('{!r}Your main interface is not assigned to a zone, dont know what to do now...')
+            return False
+        for segment, local_zone in zip(self.segments, zones[1:]):
+            if local_zone != self.internet_zone:
+                self.moved_interfaces[segment.interface] = local_zone
+
+        forward, dns = self.firewalld.query([('queryForward', 's', (self.internet_zone,)),
+                                             ('queryService', 'ss', (self.internet_zone, 'dns'))])
+        self.query_forward = forward is True
+        self.dns_allowed = dns is True
+        return True
 
-    def status(self):
-        pass
+    def stop_firewalld(self):
+        calls = []
+        if self.dns_allowed is False:
+            calls.append(('removeService', 'ss', (self.internet_zone, 'dns')))
+        if self.query_forward is False:
+            calls.append(('removeForward', 's', (self.internet_zone,)))
+        for interface in self.moved_interfaces.keys():
+            calls.append(('removeInterface', 'ss', (self.internet_zone, interface)))
+        for interface, local_zone in sorted(self.moved_interfaces.items(), key=lambda item: str(item[1])):
+            if local_zone is not None:
+                calls.append(('addInterface', 'ss', (local_zone, interface)))
+        try:
+            self.firewalld.apply(calls)
+        finally:
+            self.moved_interfaces = {}
+            self.firewalld.close()
+            self.firewalld = None
+
+    def status(self) -> dict:
+        status = super().status()
+        if self.running and self.firewall_type == FIREWALL.NATIVE:
+            status['rules'] = ('accepts in table %s, drops of other tables on the same hooks still apply' %
+                               (FIREWALL.TABLE,))
+        return status
 
     def stop(self):
         if not self.enabled or not self.running:
             return
 
-        if self.firewall_type == 'firewall-cmd':
-            if not self.dns_allowed:
-                self.subprocess.check_call(
-                    ['firewall-cmd', '--zone=%s' % (self.internet_zone,), '--remove-service=dns'])
-
-            if not self.query_forward:
-                self.subprocess.check_call(['firewall-cmd', '--zone=%s' % (self.internet_zone,), '--remove-forward'])
-
-            if self.local_zone != self.internet_zone:
-                self.subprocess.check_call(
-                    ['firewall-cmd', '--zone=%s' % (self.internet_zone,),
-                     '--remove-interface=%s' % (self.local_interface,)])
-                if self.local_zone is not None:
-                    self.subprocess.check_call(
-                        ['firewall-cmd', '--zone=%s' % (self.local_zone,),
-                         '--add-interface=%s' % (self.local_interface,)])
+        if self.firewall_type == 'firewalld':
+            self.stop_firewalld()
+        elif self.firewall_type == FIREWALL.NATIVE:
+            # Deleting the table removes its chains and rules at once
+            with self.subprocess.batch([self.binary]) as batch:
+                batch.add('delete table %s' % (FIREWALL.TABLE,))
+        elif self.firewall_type == 'firewall-cmd':
+            with self.subprocess.batch([self.binary]) as batch:
+                if self.dns_allowed is False:
+                    batch.add('--zone=%s' % (self.internet_zone,), '--remove-service=dns')
+
+                if self.query_forward is False:
+                    batch.add('--zone=%s' % (self.internet_zone,), '--remove-forward')
+
+                for interface in self.moved_interfaces.keys():
+                    batch.add('--zone=%s' % (self.internet_zone,), '--remove-interface=%s' % (interface,))
+                for interface, local_zone in sorted(self.moved_interfaces.items(), key=lambda item: str(item[1])):
+                    if local_zone is not None:
+                        batch.add('--zone=%s' % (local_zone,), '--add-interface=%s' % (interface,))
+            self.moved_interfaces = {}
         self.running = False
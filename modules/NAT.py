@@ -1,4 +1,7 @@
 import argparse
+import ipaddress
+import json
+import re
 import subprocess
 
 import tools
@@ -9,28 +12,64 @@ class NAT(BaseModule):
     """
     Module to reconfigure nftables independently from system config.
     """
+    DEPENDS = []
+    RATE = re.compile(r'^\d+(\.\d+)?([kmgt]?bit)?$')
 
     def __init__(self):
         self.running = False
         self.c = tools.ColorPrint(name=self.__class__.__name__)
         self.subprocess = tools.mysubprocess(self.__class__.__name__)
 
-        self.local_interface = None
+        self.segments = []
         self.internet_interface = None
         self.enabled = True
         self.enabled_user = True
-        self.sysctl_backup = None
-        self.subnet_definiton = None
+        self.binary = None
+        self.version = None
+        self.nftables = None
+        self.flowtable = False
+        self.offload = False
+        self.bandwidth = None
+        self.tc_binary = None
+        self.shaped = []
 
-        # This module requires nft
+    @staticmethod
+    def register_args(parser: argparse.ArgumentParser):
+        parser.add_argument('--flowtable', action='store_true', default=False,
+                            help='Offload established forwarded flows to an nftables flowtable, in hardware if all '
+                                 'interfaces support it. Clients are then accounted from conntrack, for their tracked '
+                                 'connections only.')
+        parser.add_argument('--bandwidth', action='store', type=NAT.parse_bandwidth, default=None,
+                            metavar='DOWN[/UP]',
+                            help='Shape traffic to the local segments to DOWN and to internet_interface to UP (default '
+                                 'DOWN) with fair queueing per client, rates as understood by tc, e.g. 100mbit/20mbit.')
+
+    @staticmethod
+    def parse_bandwidth(spec: str):
+        """
+        Parse DOWN[/UP] given with --bandwidth into (down, up), for use as argparse type.
+        """
+        rates = spec.lower().split('/')
+        if len(rates) > 2 or not all(NAT.RATE.match(rate) for rate in rates):
+            raise argparse.ArgumentTypeError('Bandwidth "%s" is not of the form DOWN[/UP], e.g. 100mbit/20mbit' % (spec,))
+        return rates[0], rates[-1]
+
+    def probe(self):
+        """
+        Load libnftables, or else locate and probe nft, only done if the module is going to run.
+        """
+        # Prefer changing nftables in-process, the nft binary is only required without libnftables
+        self.nftables = tools.Nftables.load()
         self.binary = tools.locate('nft')
-        if self.binary is None:
+        if self.nftables is not None:
+            self.binary = self.binary or 'nft'
+            self.version = self.nftables.library
+        elif self.binary is None:
             self.c.error('{!r}The NAT module requires nft (nftables) to be installed and on $PATH.')
             self.enabled = False
         else:
             try:
-                self.version = self.subprocess.check_output([self.binary, '-v'],
-                                                            stderr=subprocess.STDOUT).strip()
+                self.version = tools.probe(self.subprocess, [self.binary, '-v']).strip()
 
                 if not self.version:
                     self.c.error('{!r}The NAT module could not detect nft (nftables) version.')
@@ -39,77 +78,342 @@ class NAT(BaseModule):
                 self.c.error('{!r}The NAT module could not run nft (nftables).')
                 self.enabled = False
 
-    @staticmethod
-    def register_args(parser: argparse.ArgumentParser):
-        pass
-
     def configure(self, args):
-        if not self.enabled and (args.internet_interface is not None):
-            self.c.error('{!r}NAT module requested to bridge interfaces, but it will not run!')
+        if args.internet_interface is not None:
+            self.probe()
+            if not self.enabled:
+                self.c.error('{!r}NAT module requested to bridge interfaces, but it will not run!')
 
-        self.local_interface = args.local_interface
+        self.segments = args.segments
         self.internet_interface = args.internet_interface
         self.enabled_user = (self.internet_interface is not None) and self.enabled
-        ip_addr = str(args.ip).split('.')
-        mask_bytes = int(args.subnet) // 8
-        ip_addr2 = ip_addr[:mask_bytes] + (4 - mask_bytes) * ['0']
-        self.subnet_definiton = '.'.join(ip_addr2) + '/' + str(int(args.subnet))
+        self.flowtable = args.flowtable
+        self.bandwidth = args.bandwidth
+        if self.enabled_user and self.bandwidth is not None:
+            self.tc_binary = tools.locate('tc')
+            if self.tc_binary is None:
+                self.c.error('{!r}Shaping with --bandwidth requires tc (iproute2) to be installed and on $PATH.')
+                self.bandwidth = None
+        if self.flowtable or self.bandwidth is not None:
+            # The flowtable and the qdiscs need all their devices to exist, including VLANs created by DHCP
+            self.DEPENDS = ['DHCP']
 
     def start(self):
         if not self.enabled_user:
             return
 
-        # Store old val
-        self.sysctl_backup = self.subprocess.check_output(['sysctl', 'net.ipv4.ip_forward'],
-                                                          stderr=subprocess.STDOUT).strip()
-
-        # Enable forwarding
-        self.subprocess.check_call(['sysctl', 'net.ipv4.ip_forward=1'])
-
-        # Add a custom temporary nft table
-        self.subprocess.check_call(['nft', 'add table ip localnet'])
-        self.subprocess.check_call(['nft', 'add chain ip localnet forward { type filter hook forward priority -10 ; }'])
-        self.subprocess.check_call(['nft', 'add rule localnet forward ct state vmap '
-                                           '{ established : accept, related : accept, invalid : drop }'])
-        self.subprocess.check_call(['nft', 'add rule localnet forward iifname %s accept' % (self.local_interface,)])
-        self.subprocess.check_call(
-            ['nft', 'add chain ip localnet prerouting { type nat hook prerouting priority 90 ; }'])
-        self.subprocess.check_call(
-            ['nft', 'add chain ip localnet postrouting { type nat hook postrouting priority 90 ; }'])
-        self.subprocess.check_call(['nft', 'add rule localnet postrouting ip saddr %s oifname %s masquerade' % (
-            self.subnet_definiton, self.internet_interface)])
+        # Enable forwarding, the original value is journaled
         self.running = True
+        tools.write_sysctl(self.subprocess, 'net.ipv4.ip_forward', 1)
+
+        if self.flowtable:
+            self.offload = self.hardware_offload()
+            # Offloaded packets skip the forward chain, clients are accounted from their conntrack flows instead
+            tools.write_sysctl(self.subprocess, 'net.netfilter.nf_conntrack_acct', 1)
+
+        # Load the whole table as a single transaction, so it is never half built. Declaring and deleting the table
+        # first replaces a table left over by a previous run within the same transaction.
+        with self.subprocess.batch([self.binary]) as batch:
+            for line in self.ruleset().splitlines():
+                batch.add(line)
+
+        if self.bandwidth is not None:
+            self.shape()
 
-    def status(self):
-        pass
+    def shape(self):
+        """
+        Install a qdisc fair per client on every interface: cake, or if the kernel lacks it, fq_codel under HTB.
+        Traffic to the clients leaves through the segment interfaces, traffic from them through internet_interface.
+        """
+        down, up = self.bandwidth
+        interfaces = [(segment.interface, down, 'dual-dsthost') for segment in self.segments]
+        interfaces.append((self.internet_interface, up, 'dual-srchost'))
+
+        # Replacing a root qdisc configured by the admin could not be undone, stopping only brings back the default
+        try:
+            configured = self.configured_qdiscs([interface for interface, _, _ in interfaces])
+        except (subprocess.CalledProcessError, ValueError) as e:
+            self.c.error('{!r}Not shaping with --bandwidth, the root qdiscs could not be read: %s' % (e,))
+            return
+        if configured:
+            self.c.error('{!r}Not shaping with --bandwidth, it would replace the root qdisc configured on %s. Delete it '
+                         'first with "tc qdisc del dev INTERFACE root".' % (
+                             ', '.join('%s (%s)' % item for item in sorted(configured.items())),))
+            return
+        self.shaped = [interface for interface, _, _ in interfaces]
+
+        try:
+            with self.subprocess.batch([self.tc_binary]) as batch:
+                for interface, rate, isolation in interfaces:
+                    # nat lets cake look up the client addresses behind the masquerading on internet_interface
+                    batch.add('qdisc', 'replace', 'dev', interface, 'root', 'cake', 'bandwidth', rate, isolation, 'nat')
+        except subprocess.CalledProcessError:
+            self.c.error('{!y}Could not install cake, falling back to fq_codel under HTB.')
+            with self.subprocess.batch([self.tc_binary]) as batch:
+                for interface, rate, _ in interfaces:
+                    batch.add('qdisc', 'replace', 'dev', interface, 'root', 'handle', '1:', 'htb', 'default', '1')
+                    batch.add('class', 'replace', 'dev', interface, 'parent', '1:', 'classid', '1:1', 'htb', 'rate',
+                              rate)
+                    batch.add('qdisc', 'replace', 'dev', interface, 'parent', '1:1', 'fq_codel')
+
+    def configured_qdiscs(self, interfaces) -> dict:
+        """
+        The root qdiscs configured on the interfaces as {interface: kind}. The kernel attaches its default qdiscs (e.g.
+        noqueue, pfifo_fast, fq_codel or mq) with handle 0:, configured ones have another handle.
+        """
+        configured = {}
+        for interface in interfaces:
+            cmd = [self.tc_binary, '-j', 'qdisc', 'show', 'dev', interface, 'root']
+            returncode, out, err = self.subprocess.communicate(cmd)
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, cmd, output=out, stderr=err)
+            for qdisc in json.loads(out or '[]'):
+                if qdisc.get('root') and qdisc.get('handle', '0:') != '0:':
+                    configured[interface] = qdisc.get('kind')
+        return configured
+
+    def hardware_offload(self) -> bool:
+        """
+        Whether all interfaces of the flowtable advertise hw-tc-offload, as reported by ethtool -k.
+        """
+        ethtool = tools.locate('ethtool')
+        if ethtool is None:
+            return False
+        for interface in self.interfaces():
+            returncode, out, _ = self.subprocess.communicate([ethtool, '-k', interface])
+            if returncode or 'hw-tc-offload: on' not in out:
+                return False
+        self.c.print('{!g}All interfaces support hardware offload, offloading flows to the NICs.')
+        return True
+
+    def interfaces(self) -> list:
+        return [segment.interface for segment in self.segments] + [self.internet_interface]
+
+    def ruleset(self) -> str:
+        """
+        Render the temporary localnet nft table as a ruleset document, all segments are matched through sets.
+        """
+        lines = [
+            'table ip localnet',
+            'delete table ip localnet',
+            'table ip localnet {',
+            '    set lan_interfaces {',
+            '        type ifname',
+            '        elements = { %s }' % (', '.join('"%s"' % (segment.interface,) for segment in self.segments),),
+            '    }',
+            '    set lan_subnets {',
+            '        type ipv4_addr',
+            '        flags interval',
+            '        elements = { %s }' % (', '.join(segment.network for segment in self.segments),),
+            '    }',
+            '    counter masqueraded {',
+            '    }',
+        ]
+        if self.flowtable:
+            # Offloaded packets skip the forward chain, so it cannot count them. The flowtable counter keeps the
+            # conntrack accounting of offloaded flows up to date instead.
+            lines += [
+                '    flowtable fastpath {',
+                '        hook ingress priority 0;',
+                '        devices = { %s };' % (', '.join('"%s"' % (interface,) for interface in self.interfaces()),),
+                '        counter;',
+            ]
+            if self.offload:
+                lines.append('        flags offload;')
+            lines += [
+                '    }',
+                '    chain forward {',
+                '        type filter hook forward priority -10;',
+                # Established flows bypass the rest of the forwarding path from their next packet on
+                '        meta l4proto { tcp, udp } ct state established flow add @fastpath',
+                '        ct state vmap { established : accept, related : accept, invalid : drop }',
+                '        iifname @lan_interfaces accept',
+                '    }',
+            ]
+        else:
+            lines += [
+                '    counter forwarded {',
+                '    }',
+                # Per client counters, clients are added when they send or receive traffic and expire when idle
+                '    set upload {',
+                '        type ipv4_addr',
+                '        size 65535',
+                '        flags dynamic, timeout',
+                '        timeout 1h',
+                '    }',
+                '    set download {',
+                '        type ipv4_addr',
+                '        size 65535',
+                '        flags dynamic, timeout',
+                '        timeout 1h',
+                '    }',
+                '    chain forward {',
+                '        type filter hook forward priority -10;',
+                '        iifname @lan_interfaces ip saddr @lan_subnets update @upload { ip saddr counter }',
+                '        oifname @lan_interfaces ip daddr @lan_subnets update @download { ip daddr counter }',
+                '        ct state vmap { established : accept, related : accept, invalid : drop }',
+                '        iifname @lan_interfaces counter name forwarded accept',
+                '    }',
+            ]
+        lines += [
+            '    chain prerouting {',
+            '        type nat hook prerouting priority 90;',
+            '    }',
+            '    chain postrouting {',
+            '        type nat hook postrouting priority 90;',
+            '        ip saddr @lan_subnets oifname "%s" counter name masqueraded masquerade' % (
+                self.internet_interface,),
+            '    }',
+            '}',
+        ]
+        return ''.join(line + '\n' for line in lines)
 
     def stop(self):
         if not self.enabled_user or not self.running:
             return
 
-        # Restore forwarding val
-        self.subprocess.check_call(['sysctl', self.sysctl_backup.replace(' ', '')])
+        tools.restore_sysctl(self.subprocess, 'net.ipv4.ip_forward')
+        if self.flowtable:
+            tools.restore_sysctl(self.subprocess, 'net.netfilter.nf_conntrack_acct')
 
+        # Deleting the table removes its chains, rules, sets and counters at once
+        with self.subprocess.batch([self.binary]) as batch:
+            batch.add('delete table ip localnet')
+
+        # Deleting the root qdisc brings back the default one
+        if self.shaped:
+            shaped, self.shaped = self.shaped, []
+            with self.subprocess.batch([self.tc_binary]) as batch:
+                for interface in shaped:
+                    batch.add('qdisc', 'del', 'dev', interface, 'root')
+        self.running = False
+
+    def query(self, command) -> dict:
+        """
+        Run an nft listing command and return its JSON output, in-process if libnftables is available.
+        """
+        if self.nftables is not None:
+            return self.nftables.json(command)
+        # Not logged, this is read periodically for status
+        cmd = [self.binary, '-j'] + command.split()
+        returncode, out, err = self.subprocess.communicate(cmd)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, output=out, stderr=err)
+        return json.loads(out)
+
+    @staticmethod
+    def counters(table: dict) -> dict:
+        """
+        Collect the named counters from a listing of the localnet table as {name: {'packets': .., 'bytes': ..}}.
+        """
+        result = {}
+        for item in table.get('nftables', []):
+            if 'counter' in item:
+                result[item['counter']['name']] = {'packets': item['counter']['packets'],
+                                                   'bytes': item['counter']['bytes']}
+        return result
+
+    def clients(self, table: dict, flows) -> dict:
+        """
+        Collect the traffic of every client from the upload and download sets in a listing of the localnet table, and
+        count its connections in the conntrack flows, as {ip: {'upload': .., 'download': .., 'connections': ..}}.
+        With the flowtable, the traffic is that of the tracked connections, from their conntrack accounting.
+        """
+        if self.flowtable:
+            return self.flow_clients(flows)
+        result = {}
+        for item in table.get('nftables', []):
+            if 'set' not in item or item['set']['name'] not in ('upload', 'download'):
+                continue
+            for elem in item['set'].get('elem', []):
+                if isinstance(elem, dict) and 'elem' in elem:
+                    elem = elem['elem']
+                if not isinstance(elem, dict) or 'counter' not in elem:
+                    continue
+                client = result.setdefault(elem['val'], {'upload': None, 'download': None, 'connections': 0})
+                client[item['set']['name']] = {'packets': elem['counter']['packets'], 'bytes': elem['counter']['bytes']}
+
+        # Count by the original source address, then keep the addresses of the segments
+        sources = {}
+        for line in flows:
+            start = line.find(' src=')
+            if start >= 0:
+                source = line[start + 5:line.find(' ', start + 5)]
+                sources[source] = sources.get(source, 0) + 1
+        networks = [segment.address.network for segment in self.segments]
+        for source, count in sources.items():
+            try:
+                address = ipaddress.IPv4Address(source)
+            except ValueError:
+                continue
+            if any(address in network for network in networks):
+                result.setdefault(source, {'upload': None, 'download': None, 'connections': 0})['connections'] = count
+        return result
+
+    def flow_clients(self, flows) -> dict:
+        """
+        Sum the conntrack accounting of the flows of every client, the original direction as upload and the reply
+        direction as download. Flows only carry packets= and bytes= with net.netfilter.nf_conntrack_acct enabled.
+        """
+        result = {}
+        networks = [segment.address.network for segment in self.segments]
+        for line in flows:
+            directions = []
+            for field in line.split():
+                key, _, value = field.partition('=')
+                if key == 'src':
+                    directions.append({'source': value, 'packets': 0, 'bytes': 0})
+                elif key in ('packets', 'bytes') and directions:
+                    directions[-1][key] = int(value)
+            if len(directions) != 2:
+                continue
+            try:
+                address = ipaddress.IPv4Address(directions[0]['source'])
+            except ValueError:
+                continue
+            if not any(address in network for network in networks):
+                continue
+            client = result.setdefault(str(address), {'upload': {'packets': 0, 'bytes': 0},
+                                                      'download': {'packets': 0, 'bytes': 0}, 'connections': 0})
+            client['connections'] += 1
+            for name, direction in zip(('upload', 'download'), directions):
+                client[name]['packets'] += direction['packets']
+                client[name]['bytes'] += direction['bytes']
+        return result
+
+    @staticmethod
+    def offloaded_flows(flows) -> dict:
+        """
+        Count the conntrack flows offloaded to the flowtable, in software and in hardware.
+        """
+        software = hardware = 0
+        for line in flows:
+            if '[HW_OFFLOAD]' in line:
+                hardware += 1
+            elif '[OFFLOAD]' in line:
+                software += 1
+        return {'software': software, 'hardware': hardware}
+
+    def status(self) -> dict:
+        status = super().status()
+        if not self.running:
+            return status
+
+        # Everything is read at once: a single listing of the table and a single read of the conntrack table
         try:
-            self.subprocess.check_call(['nft', 'flush', 'chain', 'localnet', 'postrouting'])
-        except:
-            pass
-        try:
-            self.subprocess.check_call(['nft', 'flush', 'chain', 'localnet', 'forward'])
-        except:
-            pass
-        try:
-            self.subprocess.check_call(['nft', 'delete', 'chain', 'ip', 'localnet', 'prerouting'])
-        except:
-            pass
-        try:
-            self.subprocess.check_call(['nft', 'delete', 'chain', 'ip', 'localnet', 'postrouting'])
-        except:
-            pass
+            table = self.query('list table ip localnet')
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            status['counters'] = 'unavailable: %s' % (e,)
+            table = {}
+        else:
+            status['counters'] = self.counters(table)
         try:
-            self.subprocess.check_call(['nft', 'delete', 'chain', 'ip', 'localnet', 'forward'])
-        except:
-            pass
+            flows = tools.read_conntrack(self.subprocess)
+        except (subprocess.CalledProcessError, OSError) as e:
+            status['connections'] = 'unavailable: %s' % (e,)
+            flows = []
 
-        self.subprocess.check_call(['nft', 'delete', 'table', 'ip', 'localnet'])
-        self.running = False
+        status['clients'] = self.clients(table, flows)
+        if self.flowtable:
+            status['offloaded_flows'] = self.offloaded_flows(flows)
+        return status
@@ -1,5 +1,4 @@
 import argparse
-import subprocess
 
 import tools
 from modules import BaseModule
@@ -9,21 +8,34 @@ class NM(BaseModule):
     """
     Module to configure NetworkManager to set 'managed' flag of interface.
     """
+    DEPENDS = []
 
     def __init__(self):
         self.running = False
         self.c = tools.ColorPrint(name=self.__class__.__name__)
         self.subprocess = tools.mysubprocess(self.__class__.__name__)
 
-        self.local_interface = None
+        self.segments = []
+        self.unmanaged = []
+        self.disabled = False
+        self.binary = None
+        self.version = None
+
+    @staticmethod
+    def register_args(parser: argparse.ArgumentParser):
+        parser.add_argument('--no-nm', action='store_true', default=False, help='Do not configure NetworkManager.')
+
+    def probe(self):
+        """
+        Locate and probe nmcli, only done if not disabled by --no-nm.
+        """
         self.binary = tools.locate('nmcli')
         if self.binary is None:
             self.c.error('{!r}Could not find nmcli.')
             self.disabled = True
         else:
             try:
-                self.version = self.subprocess.check_output([self.binary, '--version'],
-                                                            stderr=subprocess.STDOUT).strip()
+                self.version = tools.probe(self.subprocess, [self.binary, '--version']).strip()
                 if not self.version:
                     self.c.error('{!r}The NM module could not detect nmcli version.')
                     self.disabled = True
@@ -35,24 +47,24 @@ class NM(BaseModule):
         if self.disabled:
             self.c.print('{!y}Assuming option --no-nm.')
 
-    @staticmethod
-    def register_args(parser: argparse.ArgumentParser):
-        parser.add_argument('--no-nm', action='store_true', default=False, help='Do not configure NetworkManager.')
-
     def configure(self, args):
+        self.disabled = args.no_nm
         if not self.disabled:
-            self.disabled = args.no_nm
-        self.local_interface = args.local_interface
+            self.probe()
+        self.segments = args.segments
 
     def start(self):
-        if not self.disabled:
-            self.subprocess.check_call(['nmcli', 'dev', 'set', self.local_interface, 'managed', 'no'])
         self.running = True
-
-    def status(self):
-        pass
+        if not self.disabled:
+            # 802.1q subinterfaces that are only created by the DHCP module are not managed by NetworkManager anyway
+            for segment in self.segments:
+                if segment.exists():
+                    self.subprocess.check_call(['nmcli', 'dev', 'set', segment.interface, 'managed', 'no'])
+                    self.unmanaged.append(segment.interface)
 
     def stop(self):
         if not self.disabled and self.running:
-            self.subprocess.check_call(['nmcli', 'dev', 'set', self.local_interface, 'managed', 'yes'])
+            for interface in self.unmanaged:
+                self.subprocess.check_call(['nmcli', 'dev', 'set', interface, 'managed', 'yes'])
+        self.unmanaged = []
         self.running = False
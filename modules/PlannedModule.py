@@ -0,0 +1,132 @@
+import argparse
+import json
+from typing import Dict, List
+
+import tools
+from modules import BaseModule
+
+
+class PlannedModule(BaseModule):
+    """
+    Module replaying the steps recorded for another module by --plan, used by --apply-plan.
+    Nothing is probed or computed, the recorded commands, files and daemons are applied as they are.
+    """
+
+    def __init__(self, name, depends, start_steps, stop_steps, paths: Dict[str, str] = None):
+        self.running = False
+        self._name = name
+        self.DEPENDS = list(depends)
+        self.c = tools.ColorPrint(name=name)
+        self.subprocess = tools.mysubprocess(name)
+        self.start_steps = start_steps
+        self.stop_steps = stop_steps
+        self.daemons = {}
+        # Placeholder names of temporary files in the plan, mapped to the files created for them, shared by all modules
+        self.paths = paths if paths is not None else {}
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @staticmethod
+    def load(path) -> List['PlannedModule']:
+        """
+        Load all modules from a plan file written by --plan.
+        """
+        with open(path) as f:
+            plan = json.load(f)
+        if plan.get('version') != tools.PLAN_VERSION:
+            raise ValueError('Plan %s has version %s, expected %d' % (path, plan.get('version'), tools.PLAN_VERSION))
+        paths = {}
+        return [PlannedModule(module['name'], module['depends'], module['start'], module['stop'], paths)
+                for module in plan['modules']]
+
+    @staticmethod
+    def register_args(parser: argparse.ArgumentParser):
+        pass
+
+    def configure(self, args):
+        pass
+
+    def start(self):
+        self.running = True
+        for step in self.start_steps:
+            self.execute(step)
+
+    def services(self) -> list:
+        return list(self.daemons.values())
+
+    def stop(self):
+        if not self.running:
+            return
+        for step in self.stop_steps:
+            self.execute(step)
+        self.running = False
+
+    def substitute(self, value):
+        """
+        Replace the placeholder names of temporary files in a step (including names derived from them, like a
+        socket next to a config file) with the names of the files created for them.
+        """
+        if isinstance(value, str):
+            for placeholder, path in self.paths.items():
+                value = value.replace(placeholder, path)
+            return value
+        if isinstance(value, list):
+            return [self.substitute(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self.substitute(item) for key, item in value.items()}
+        return value
+
+    def execute(self, step):
+        """
+        Apply a single recorded step, see tools.mysubprocess.record.
+        """
+        step = self.substitute(step)
+        op = step['op']
+        if op == 'tempfile':
+            self.paths[step['path']] = self.subprocess.tempfile(step['suffix'], step['prefix'])
+        elif op == 'run':
+            self.subprocess.check_call(step['argv'])
+        elif op == 'batch':
+            with self.subprocess.batch(step['prefix']) as batch:
+                for command in step['commands']:
+                    batch.add(*command)
+        elif op == 'write':
+            self.subprocess.write_file(step['path'], step['content'])
+        elif op == 'remove':
+            self.subprocess.remove_file(step['path'], step.get('missing_ok', False))
+        elif op == 'sysctl':
+            tools.write_sysctl(self.subprocess, step['sysctl'], step['value'])
+        elif op == 'restore_sysctl':
+            tools.restore_sysctl(self.subprocess, step['sysctl'])
+        elif op == 'spawn':
+            self.daemons[step['name']] = tools.Daemon(step['name'], step['argv'], self.subprocess)
+            self.daemons[step['name']].spawn()
+        elif op == 'serve':
+            segments = [tools.Segment.parse(spec) for spec in step['segments']]
+            reservations = tools.Reservations.load(step['reservations'], segments) \
+                if step.get('reservations') is not None else None
+            self.daemons[step['name']] = tools.DhcpServer(step['name'], segments, step['domain'], step['snapshot'],
+                                                          self.subprocess, reservations)
+            self.daemons[step['name']].start()
+        elif op == 'forward':
+            self.daemons[step['name']] = tools.DnsForwarder(step['name'],
+                                                            [tools.Segment.parse(spec) for spec in step['segments']],
+                                                            [tools.DnsForwarder.parse_upstream(upstream)
+                                                             for upstream in step['upstreams']],
+                                                            step['cache_size'], self.subprocess, step['port'],
+                                                            step.get('domain'), step.get('cache_file'))
+            self.daemons[step['name']].start()
+        elif op == 'firewalld':
+            firewalld = tools.Firewalld(self.subprocess, step['address'])
+            try:
+                firewalld.apply([tuple(call) for call in step['calls']])
+            finally:
+                firewalld.close()
+        elif op == 'stop':
+            daemon = self.daemons.pop(step['name'], None)
+            if daemon is not None:
+                daemon.stop()
+        else:
+            raise ValueError('Unknown plan step "%s"' % (op,))
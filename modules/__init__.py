@@ -4,3 +4,4 @@ from .DNS import DNS
 from .FIREWALL import FIREWALL
 from .NAT import NAT
 from .NM import NM
+from .PlannedModule import PlannedModule
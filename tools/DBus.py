@@ -0,0 +1,308 @@
+import os
+import socket
+import struct
+import threading
+from typing import List, Optional, Tuple
+
+
+class DBusError(Exception):
+    """
+    A method call failed: the error reply of the callee (name is its D-Bus error name), or the connection failed (name
+    is None).
+    """
+
+    def __init__(self, name: Optional[str], message: str):
+        super().__init__('%s: %s' % (name, message) if name else message)
+        self.name = name
+        self.message = message
+
+
+class DBus:
+    """
+    Minimal D-Bus client over one persistent connection to a bus, authenticated with SASL EXTERNAL. It only calls
+    methods: several calls can be sent at once and their replies are collected by serial, so they cost a single round
+    trip. Calls are serialized by a lock, so it can be used from any thread. If the connection breaks, it is opened
+    again once per call.
+    """
+
+    SYSTEM_BUS = 'unix:path=/run/dbus/system_bus_socket'
+    METHOD_CALL, METHOD_RETURN, ERROR, SIGNAL = 1, 2, 3, 4
+    PATH, INTERFACE, MEMBER, ERROR_NAME, REPLY_SERIAL, DESTINATION, SENDER, SIGNATURE = range(1, 9)
+    FIELD_TYPES = {PATH: 'o', INTERFACE: 's', MEMBER: 's', ERROR_NAME: 's', REPLY_SERIAL: 'u', DESTINATION: 's',
+                   SENDER: 's', SIGNATURE: 'g'}
+    ALIGNMENT = {'y': 1, 'g': 1, 'v': 1, 'n': 2, 'q': 2, 'b': 4, 'i': 4, 'u': 4, 'h': 4, 's': 4, 'o': 4, 'a': 4,
+                 'x': 8, 't': 8, 'd': 8, '(': 8, '{': 8}
+    FIXED = {'y': 'B', 'n': 'h', 'q': 'H', 'b': 'I', 'i': 'i', 'u': 'I', 'h': 'I', 'x': 'q', 't': 'Q', 'd': 'd'}
+    TIMEOUT = 10.0
+
+    def __init__(self, address: str = None):
+        self.address = address or os.environ.get('DBUS_SYSTEM_BUS_ADDRESS') or DBus.SYSTEM_BUS
+        self.sock = None
+        self.serial = 0
+        self.unique_name = None
+        self.buffer = b''
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def call(self, destination: str, path: str, interface: str, member: str, signature: str = '', args=()) -> list:
+        """
+        Call a method and return the values of its reply. Raises DBusError.
+        """
+        result = self.calls([(destination, path, interface, member, signature, args)])[0]
+        if isinstance(result, DBusError):
+            raise result
+        return result
+
+    def calls(self, calls: List[Tuple[str, str, str, str, str, tuple]]) -> list:
+        """
+        Send all calls (destination, path, interface, member, signature, args) at once and wait for their replies.
+        Returns the values of every reply in order, or a DBusError for calls that failed. Raises DBusError if the
+        bus cannot be reached.
+        """
+        with self.lock:
+            for attempt in (0, 1):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    return self._exchange(calls)
+                except (OSError, ValueError, struct.error) as e:
+                    self._close()
+                    if attempt:
+                        raise DBusError(None, 'D-Bus %s failed: %s' % (self.address, e))
+
+    def _connect(self):
+        transport, _, options = self.address.partition(':')
+        options = dict(option.partition('=')[::2] for option in options.split(','))
+        if transport != 'unix' or not ('path' in options or 'abstract' in options):
+            raise ValueError('unsupported bus address %s' % (self.address,))
+        path = options['path'] if 'path' in options else '\0' + options['abstract']
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(DBus.TIMEOUT)
+        self.sock.connect(path)
+        self.buffer = b''
+        # Authenticated as the uid of this process, by the credentials of the socket
+        self.sock.sendall(b'\0AUTH EXTERNAL %s\r\n' % (str(os.getuid()).encode().hex().encode(),))
+        reply = self._recv_line()
+        if not reply.startswith(b'OK '):
+            raise OSError('authentication rejected: %s' % (reply.decode(errors='replace'),))
+        self.sock.sendall(b'BEGIN\r\n')
+        self.unique_name = self._exchange([('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus',
+                                            'Hello', '', ())])[0][0]
+
+    def _close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.unique_name = None
+
+    def _exchange(self, calls) -> list:
+        serials = {}
+        data = b''
+        for index, (destination, path, interface, member, signature, args) in enumerate(calls):
+            self.serial = self.serial % 0xffffffff + 1
+            serials[self.serial] = index
+            data += DBus.message(DBus.METHOD_CALL, self.serial, {
+                DBus.PATH: path, DBus.INTERFACE: interface, DBus.MEMBER: member, DBus.DESTINATION: destination,
+            }, signature, args)
+        self.sock.sendall(data)
+
+        results = [None] * len(calls)
+        while serials:
+            message_type, _, fields, body = self._recv_message()
+            index = serials.pop(fields.get(DBus.REPLY_SERIAL), None)
+            if index is None or message_type not in (DBus.METHOD_RETURN, DBus.ERROR):
+                # Signals and anything else are not of interest
+                continue
+            if message_type == DBus.ERROR:
+                results[index] = DBusError(fields.get(DBus.ERROR_NAME), body[0] if body and isinstance(body[0], str)
+                                           else '')
+            else:
+                results[index] = body
+        return results
+
+    def _recv_line(self) -> bytes:
+        while b'\r\n' not in self.buffer:
+            self._fill()
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line
+
+    def _recv(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            self._fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def _fill(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise OSError('connection closed by the bus')
+        self.buffer += chunk
+
+    def _recv_message(self):
+        fixed = self._recv(16)
+        order = '<' if fixed[0:1] == b'l' else '>'
+        message_type = fixed[1]
+        body_length, serial, fields_length = struct.unpack(order + 'III', fixed[4:16])
+        header_length = 16 + fields_length + (-(16 + fields_length) % 8)
+        data = fixed + self._recv(header_length - 16 + body_length)
+        fields, _ = DBus.unmarshal(data, 12, 'a(yv)', order)
+        fields = {code: value for code, (_, value) in fields}
+        body = []
+        if fields.get(DBus.SIGNATURE):
+            body, _ = DBus.unmarshal(data[header_length:], 0, fields[DBus.SIGNATURE], order, many=True)
+        return message_type, serial, fields, body
+
+    def serve(self, name: str, handler):
+        """
+        Own the bus name and answer the method calls to it with handler(path, interface, member, args), which returns
+        the (signature, values) of the reply or raises DBusError for an error reply. Returns when the connection is
+        closed, e.g. by the bus exiting. Meant for mock services, the connection is used by nothing else meanwhile.
+        """
+        with self.lock:
+            if self.sock is None:
+                self._connect()
+            # 4: DBUS_NAME_FLAG_DO_NOT_QUEUE, fail instead of waiting for the name
+            result = self._exchange([('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus',
+                                      'RequestName', 'su', (name, 4))])[0]
+            if isinstance(result, DBusError):
+                raise result
+            if result[0] != 1:
+                raise DBusError(None, 'D-Bus name %s is taken' % (name,))
+            self.sock.settimeout(None)
+            try:
+                while True:
+                    message_type, serial, fields, body = self._recv_message()
+                    if message_type != DBus.METHOD_CALL:
+                        continue
+                    reply = {DBus.REPLY_SERIAL: serial, DBus.DESTINATION: fields.get(DBus.SENDER)}
+                    self.serial = self.serial % 0xffffffff + 1
+                    try:
+                        signature, values = handler(fields.get(DBus.PATH), fields.get(DBus.INTERFACE),
+                                                    fields.get(DBus.MEMBER), body)
+                    except DBusError as e:
+                        reply[DBus.ERROR_NAME] = e.name
+                        self.sock.sendall(DBus.message(DBus.ERROR, self.serial, reply, 's', (e.message,)))
+                    else:
+                        self.sock.sendall(DBus.message(DBus.METHOD_RETURN, self.serial, reply, signature, values))
+            except OSError:
+                pass
+            finally:
+                self._close()
+
+    @staticmethod
+    def message(message_type: int, serial: int, fields: dict, signature: str = '', args=()) -> bytes:
+        """
+        A little endian message of message_type with the given header fields and body.
+        """
+        body = bytearray()
+        DBus.marshal(body, signature, list(args))
+        if signature:
+            fields = dict(fields)
+            fields[DBus.SIGNATURE] = signature
+        header = bytearray(b'l' + bytes([message_type, 0, 1]) + struct.pack('<II', len(body), serial))
+        DBus.marshal(header, 'a(yv)', [[(code, (DBus.FIELD_TYPES[code], value))
+                                        for code, value in fields.items() if value is not None]])
+        header.extend(b'\0' * (-len(header) % 8))
+        return bytes(header + body)
+
+    @staticmethod
+    def split(signature: str) -> List[str]:
+        """
+        Split a signature into its single complete types.
+        """
+        types, i = [], 0
+        while i < len(signature):
+            start = i
+            while signature[i] == 'a':
+                i += 1
+            if signature[i] in '({':
+                depth = 0
+                while True:
+                    depth += signature[i] in '({'
+                    depth -= signature[i] in ')}'
+                    i += 1
+                    if depth == 0:
+                        break
+            else:
+                i += 1
+            types.append(signature[start:i])
+        return types
+
+    @staticmethod
+    def marshal(buffer: bytearray, signature: str, values: list):
+        """
+        Append values of signature to buffer, aligned relative to its start.
+        """
+        for code, value in zip(DBus.split(signature), values):
+            DBus._marshal(buffer, code, value)
+
+    @staticmethod
+    def _marshal(buffer: bytearray, code: str, value):
+        buffer.extend(b'\0' * (-len(buffer) % DBus.ALIGNMENT[code[0]]))
+        if code in DBus.FIXED:
+            buffer.extend(struct.pack('<' + DBus.FIXED[code], int(value) if code == 'b' else value))
+        elif code in 'so':
+            data = value.encode()
+            buffer.extend(struct.pack('<I', len(data)) + data + b'\0')
+        elif code == 'g':
+            buffer.extend(bytes([len(value)]) + value.encode() + b'\0')
+        elif code == 'v':
+            signature, inner = value
+            DBus._marshal(buffer, 'g', signature)
+            DBus._marshal(buffer, signature, inner)
+        elif code[0] == 'a':
+            element = code[1:]
+            offset = len(buffer)
+            buffer.extend(b'\0\0\0\0')
+            buffer.extend(b'\0' * (-len(buffer) % DBus.ALIGNMENT[element[0]]))
+            start = len(buffer)
+            for item in (value.items() if element[0] == '{' else value):
+                DBus._marshal(buffer, element, item)
+            struct.pack_into('<I', buffer, offset, len(buffer) - start)
+        else:
+            DBus.marshal(buffer, code[1:-1], list(value))
+
+    @staticmethod
+    def unmarshal(data: bytes, offset: int, signature: str, order: str = '<', many: bool = False):
+        """
+        Read a value of signature (or, if many, a list of the values of all types in it) at offset of data, aligned
+        relative to the start of data. Returns it and the offset after it.
+        """
+        values = []
+        for code in DBus.split(signature):
+            value, offset = DBus._unmarshal(data, offset, code, order)
+            values.append(value)
+        return (values if many else values[0]), offset
+
+    @staticmethod
+    def _unmarshal(data: bytes, offset: int, code: str, order: str):
+        offset += -offset % DBus.ALIGNMENT[code[0]]
+        if code in DBus.FIXED:
+            value = struct.unpack_from(order + DBus.FIXED[code], data, offset)[0]
+            return (bool(value) if code == 'b' else value), offset + struct.calcsize(DBus.FIXED[code])
+        if code in 'so':
+            length = struct.unpack_from(order + 'I', data, offset)[0]
+            return data[offset + 4:offset + 4 + length].decode(), offset + 5 + length
+        if code == 'g':
+            length = data[offset]
+            return data[offset + 1:offset + 1 + length].decode(), offset + 2 + length
+        if code == 'v':
+            signature, offset = DBus._unmarshal(data, offset, 'g', order)
+            value, offset = DBus._unmarshal(data, offset, signature, order)
+            return (signature, value), offset
+        if code[0] == 'a':
+            element = code[1:]
+            length = struct.unpack_from(order + 'I', data, offset)[0]
+            offset += 4
+            offset += -offset % DBus.ALIGNMENT[element[0]]
+            end = offset + length
+            items = []
+            while offset < end:
+                item, offset = DBus._unmarshal(data, offset, element, order)
+                items.append(item)
+            return (dict(items) if element[0] == '{' else items), offset
+        values, offset = DBus.unmarshal(data, offset, code[1:-1], order, many=True)
+        return tuple(values), offset
@@ -0,0 +1,222 @@
+import errno
+import os
+import subprocess
+import sys
+import time
+
+from tools import ColorPrint
+from tools.Tracer import tracer
+
+
+class Daemon:
+    """
+    A long running subprocess that can be watched by the Supervisor.
+    While attached to an event loop its output is forwarded line by line prefixed by '[name] ', its exit is detected
+    through a pidfd and, unless it was stopped on purpose, it is restarted with exponential backoff.
+    """
+
+    BACKOFF_MIN = 0.5
+    BACKOFF_MAX = 30.0
+    STABLE_AFTER = 10.0
+    STOP_TIMEOUT = 5.0
+
+    def __init__(self, name, argv, runner, restart=True, on_restart=None):
+        """
+        Create a daemon called name, that runs argv using the given mysubprocess runner. on_restart is called after it
+        was restarted, e.g. to restore state that was changed at runtime.
+        """
+        self.name = name
+        self.argv = argv
+        self.runner = runner
+        self.restart = restart
+        self.on_restart = on_restart
+        self.c = ColorPrint(name=name)
+
+        self.process = None
+        self.loop = None
+        self.pidfd = None
+        self.watched = False
+        self.started_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.stopping = False
+        self.restart_handle = None
+        self.buffer = b''
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def spawn(self):
+        """
+        Start the subprocess. If already attached to an event loop it is watched right away.
+        """
+        self.stopping = False
+        if self.runner.plan is not None:
+            self.runner.record('spawn', name=self.name, argv=self.argv)
+            return
+        # Own session, so that a Ctrl+C on the terminal reaches only us and we stop the daemon in order
+        self.process = self.runner.Popen(self.argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                         start_new_session=True)
+        self.started_at = time.monotonic()
+        os.set_blocking(self.process.stdout.fileno(), False)
+        if self.loop is not None:
+            self._watch()
+
+    def attach(self, loop):
+        """
+        Start watching the subprocess on the given asyncio event loop.
+        """
+        self.loop = loop
+        if self.process is not None:
+            self._watch()
+
+    def detach(self):
+        """
+        Stop watching the subprocess, it keeps running. Must be called from the thread running the loop or while the
+        loop is not running.
+        """
+        if self.restart_handle is not None:
+            self.restart_handle.cancel()
+            self.restart_handle = None
+        self._unwatch()
+        self.loop = None
+
+    def check(self):
+        """
+        Poll the subprocess for an exit, used where no pidfd is available (on SIGCHLD).
+        """
+        if self.watched and self.pidfd is None and self.process.poll() is not None:
+            self._on_exit()
+
+    def stop(self):
+        """
+        Terminate the subprocess and wait for it to exit, forwarding its last output.
+        """
+        self.stopping = True
+        self.detach()
+        if self.runner.plan is not None:
+            self.runner.record('stop', name=self.name)
+            return
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(self.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.c.error('{!r}Did not terminate within %.0fs, killing it.' % (self.STOP_TIMEOUT,))
+                self.process.kill()
+                self.process.wait()
+        self._drain()
+        self.process.stdout.close()
+
+    def status(self) -> dict:
+        return {
+            'alive': self.alive,
+            'pid': self.process.pid if self.alive else None,
+            'uptime': time.monotonic() - self.started_at if self.alive else 0.0,
+            'restarts': self.restarts,
+        }
+
+    def _watch(self):
+        self.watched = True
+        try:
+            self.pidfd = os.pidfd_open(self.process.pid)
+        except (AttributeError, OSError):
+            # Python < 3.9 or kernel < 5.3, the Supervisor falls back to SIGCHLD
+            self.pidfd = None
+        else:
+            self.loop.add_reader(self.pidfd, self._on_exit, self.process)
+        self.loop.add_reader(self.process.stdout.fileno(), self._on_output, self.process)
+
+    def _unwatch(self):
+        if not self.watched:
+            return
+        self.watched = False
+        if not self.process.stdout.closed:
+            self.loop.remove_reader(self.process.stdout.fileno())
+        if self.pidfd is not None:
+            self.loop.remove_reader(self.pidfd)
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    def _on_output(self, process):
+        if process is not self.process or process.stdout.closed:
+            # Woken up in the same iteration the process exited and was already cleaned up
+            return
+        try:
+            data = os.read(self.process.stdout.fileno(), 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        if not data:
+            self.loop.remove_reader(self.process.stdout.fileno())
+            self._emit(b'', final=True)
+        else:
+            self._emit(data)
+
+    def _on_exit(self, process=None):
+        if not self.watched or (process is not None and process is not self.process):
+            return
+        returncode = self.process.poll()
+        if returncode is None:
+            return
+
+        self._unwatch()
+        self._drain()
+        self.process.stdout.close()
+        tracer.instant('%s exited' % (self.name,), 'daemon', pid=self.process.pid, returncode=returncode,
+                       expected=self.stopping)
+        if self.stopping or not self.restart:
+            return
+
+        if time.monotonic() - self.started_at >= self.STABLE_AFTER:
+            self.failures = 0
+        delay = min(self.BACKOFF_MIN * 2 ** self.failures, self.BACKOFF_MAX)
+        self.failures += 1
+        self.c.error('{!r}Exited with status %d, restarting in %.1fs.' % (returncode, delay))
+        self.restart_handle = self.loop.call_later(delay, self._restart)
+
+    def _restart(self):
+        self.restart_handle = None
+        self.restarts += 1
+        try:
+            self.spawn()
+        except OSError as e:
+            delay = min(self.BACKOFF_MIN * 2 ** self.failures, self.BACKOFF_MAX)
+            self.failures += 1
+            self.c.error('{!r}Restart failed: %s, retrying in %.1fs.' % (e, delay))
+            self.restart_handle = self.loop.call_later(delay, self._restart)
+            return
+        if self.on_restart is not None:
+            self.on_restart()
+
+    def _drain(self):
+        """
+        Forward whatever output is left in the pipe without blocking.
+        """
+        if self.process.stdout.closed:
+            return
+        while True:
+            try:
+                data = os.read(self.process.stdout.fileno(), 65536)
+            except OSError:
+                break
+            if not data:
+                break
+            self._emit(data)
+        self._emit(b'', final=True)
+
+    def _emit(self, data, final=False):
+        *lines, self.buffer = (self.buffer + data).split(b'\n')
+        if final and self.buffer:
+            lines.append(self.buffer)
+            self.buffer = b''
+        out = ''
+        for line in lines:
+            out += '[%s] %s\n' % (self.name, line.decode(errors='replace').rstrip('\r'))
+        if out:
+            sys.stdout.write(out)
+            sys.stdout.flush()
@@ -0,0 +1,520 @@
+import ipaddress
+import json
+import os
+import re
+import socket
+import struct
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from tools import ColorPrint
+from tools.LeaseIndex import Lease, LeaseIndex
+from tools.Segment import Segment
+from tools.Tracer import tracer
+
+
+class AddressPool:
+    """
+    The addresses of a DHCP range as a bitmap, one bit per address, set if the address is taken.
+    Free addresses are searched from where the last one was found, so allocating is cheap while the pool is not full.
+    """
+
+    FREE_BYTE = re.compile(b'[^\xff]')
+
+    def __init__(self, first: ipaddress.IPv4Address, last: ipaddress.IPv4Address):
+        self.first = int(first)
+        self.size = int(last) - self.first + 1
+        self.bits = bytearray((self.size + 7) // 8)
+        # Bits past the end of the range are never free
+        for index in range(self.size, len(self.bits) * 8):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.cursor = 0
+        self.used = 0
+
+    def __contains__(self, ip) -> bool:
+        return 0 <= int(ip) - self.first < self.size
+
+    def is_free(self, ip) -> bool:
+        index = int(ip) - self.first
+        return not self.bits[index >> 3] & (1 << (index & 7))
+
+    def take(self, ip) -> bool:
+        """
+        Take a specific address, False if it is taken already.
+        """
+        if not self.is_free(ip):
+            return False
+        index = int(ip) - self.first
+        self.bits[index >> 3] |= 1 << (index & 7)
+        self.used += 1
+        return True
+
+    def allocate(self) -> Optional[ipaddress.IPv4Address]:
+        """
+        Take any free address, None if the pool is exhausted.
+        """
+        match = AddressPool.FREE_BYTE.search(self.bits, self.cursor) or AddressPool.FREE_BYTE.search(self.bits)
+        if match is None:
+            return None
+        self.cursor = match.start()
+        byte = self.bits[self.cursor]
+        bit = (~byte & (byte + 1)).bit_length() - 1
+        ip = ipaddress.IPv4Address(self.first + self.cursor * 8 + bit)
+        self.take(ip)
+        return ip
+
+    def release(self, ip):
+        if ip not in self or self.is_free(ip):
+            return
+        index = int(ip) - self.first
+        self.bits[index >> 3] &= ~(1 << (index & 7))
+        self.used -= 1
+
+    @property
+    def free(self) -> int:
+        return self.size - self.used
+
+
+class DhcpServer:
+    """
+    DHCPv4 server running on the Supervisor's event loop, serving the DHCP range of every segment on its interface.
+    Addresses are handed out from an AddressPool per segment, active leases are kept in a LeaseIndex and, if a snapshot
+    file is given, saved there periodically and on stop and loaded again on start. Clients with a reservation get their
+    fixed address, which is outside of the ranges.
+    Like a Daemon it is started and stopped by its module and attached to the event loop by the Supervisor.
+    """
+
+    SERVER_PORT = 67
+    CLIENT_PORT = 68
+    LEASE_TIME = 14400
+    OFFER_TIME = 60
+    DECLINE_TIME = 3600
+    TICK_INTERVAL = 10
+
+    HEADER = struct.Struct('!BBBB4sHH4s4s4s4s16s64s128s4s')
+    MAGIC = b'\x63\x82\x53\x63'
+
+    BOOTREQUEST, BOOTREPLY = 1, 2
+    DISCOVER, OFFER, REQUEST, DECLINE, ACK, NAK, RELEASE, INFORM = range(1, 9)
+
+    OPTION_SUBNET_MASK = 1
+    OPTION_ROUTER = 3
+    OPTION_DNS = 6
+    OPTION_HOSTNAME = 12
+    OPTION_DOMAIN = 15
+    OPTION_BROADCAST = 28
+    OPTION_REQUESTED_IP = 50
+    OPTION_LEASE_TIME = 51
+    OPTION_MESSAGE_TYPE = 53
+    OPTION_SERVER_ID = 54
+    OPTION_RENEWAL_TIME = 58
+    OPTION_REBINDING_TIME = 59
+    OPTION_END = 255
+
+    def __init__(self, name, segments: List[Segment], domain, snapshot, runner, reservations=None):
+        self.name = name
+        self.segments = segments
+        self.domain = domain
+        self.snapshot = snapshot
+        self.runner = runner
+        self.reservations = reservations
+        self.c = ColorPrint(name=name)
+
+        self.pools = {segment.interface: AddressPool(segment.range_start, segment.range_end) for segment in segments}
+        self.leases = LeaseIndex(None)
+        self.offers: Dict[str, Lease] = {}
+        self.declined: Dict[str, float] = {}
+        self.sockets = {}
+        self.loop = None
+        self.timer = None
+        self.dirty = False
+        self.started_at = None
+        self.served = 0
+
+    @property
+    def alive(self) -> bool:
+        return bool(self.sockets)
+
+    def start(self):
+        """
+        Load the snapshot and open a socket on every interface. If already attached to an event loop it serves right
+        away, otherwise once attached.
+        """
+        if self.runner.plan is not None:
+            self.runner.record('serve', name=self.name, segments=[segment.spec for segment in self.segments],
+                               domain=self.domain, snapshot=self.snapshot,
+                               reservations=self.reservations.path if self.reservations is not None else None)
+            return
+        with tracer.span('%s.start' % (self.name,), 'serve', module=self.runner.name):
+            self._load()
+            for segment in self.segments:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, segment.interface.encode())
+                    # Room for bursts of requests from many clients at once (e.g. after a switch reboots)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+                    sock.bind(('', DhcpServer.SERVER_PORT))
+                except OSError:
+                    sock.close()
+                    self.stop()
+                    raise
+                sock.setblocking(False)
+                self.sockets[segment.interface] = (sock, segment)
+        self.started_at = time.monotonic()
+        self.c.print('{!g}Serving DHCP on %s' % (', '.join(self.sockets),))
+        if self.loop is not None:
+            self._watch()
+
+    def attach(self, loop):
+        self.loop = loop
+        if self.sockets:
+            self._watch()
+
+    def detach(self):
+        if self.loop is not None:
+            for sock, _ in self.sockets.values():
+                self.loop.remove_reader(sock)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.loop = None
+
+    def check(self):
+        pass
+
+    def stop(self):
+        """
+        Stop serving and save the snapshot.
+        """
+        self.detach()
+        if self.runner.plan is not None:
+            self.runner.record('stop', name=self.name)
+            return
+        for sock, _ in self.sockets.values():
+            sock.close()
+        self.sockets = {}
+        self._save()
+
+    def status(self) -> dict:
+        return {
+            'alive': self.alive,
+            'pid': os.getpid() if self.alive else None,
+            'uptime': time.monotonic() - self.started_at if self.alive else 0.0,
+            'restarts': 0,
+            'leases': len(self.leases),
+            'offers': len(self.offers),
+            'free': sum(pool.free for pool in self.pools.values()),
+            'reservations': len(self.reservations) if self.reservations is not None else 0,
+            'served': self.served,
+        }
+
+    def _watch(self):
+        for sock, segment in self.sockets.values():
+            self.loop.add_reader(sock, self._on_readable, sock, segment)
+        self._tick()
+
+    def _tick(self):
+        # Expire offers, declines and leases, then save the snapshot if anything changed
+        now = time.time()
+        for mac, offer in list(self.offers.items()):
+            if offer.ends <= now:
+                self._release(self.offers.pop(mac))
+        for ip, until in list(self.declined.items()):
+            if until <= now:
+                del self.declined[ip]
+                self._pool(ip).release(ipaddress.IPv4Address(ip))
+        self.leases.expire(now)
+        # Only expired leases are left to notify, as packets are handled and notified in one go. Their addresses go
+        # back to their pool.
+        for ip, lease in self.leases.notify().items():
+            if lease is None:
+                self._release(Lease(ip))
+                self.dirty = True
+        if self.dirty:
+            self._save()
+        self.timer = self.loop.call_later(DhcpServer.TICK_INTERVAL, self._tick)
+
+    def _on_readable(self, sock, segment):
+        # Handle everything queued at once
+        while True:
+            try:
+                data, _ = sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.c.error('{!r}Receiving on %s failed: %s' % (segment.interface, e))
+                break
+            try:
+                self._handle(sock, segment, data)
+            except (ValueError, IndexError, struct.error) as e:
+                self.c.error('{!y}Ignoring malformed packet on %s: %s' % (segment.interface, e))
+        self.leases.notify()
+
+    def _handle(self, sock, segment, data):
+        if len(data) < DhcpServer.HEADER.size:
+            raise ValueError('too short')
+        header = list(DhcpServer.HEADER.unpack_from(data))
+        (op, htype, hlen, _, xid, _, flags, ciaddr, _, _, giaddr, chaddr, _, _, magic) = header
+        if op != DhcpServer.BOOTREQUEST or magic != DhcpServer.MAGIC or hlen > 16:
+            return
+        if giaddr != b'\0\0\0\0':
+            # Relayed requests are not supported, only directly attached segments are served
+            return
+        options = DhcpServer.parse_options(data[DhcpServer.HEADER.size:])
+        message_type = options.get(DhcpServer.OPTION_MESSAGE_TYPE, b'\0')[0]
+        mac = ':'.join('%02x' % (b,) for b in chaddr[:hlen])
+        hostname = options.get(DhcpServer.OPTION_HOSTNAME, b'').decode(errors='replace').strip().lower() or None
+        requested = options.get(DhcpServer.OPTION_REQUESTED_IP)
+        requested = str(ipaddress.IPv4Address(requested)) if requested and len(requested) == 4 else None
+        server_id = options.get(DhcpServer.OPTION_SERVER_ID)
+        ciaddr_ip = str(ipaddress.IPv4Address(ciaddr))
+        self.served += 1
+
+        if message_type == DhcpServer.DISCOVER:
+            lease = self._offer(segment, mac, hostname, requested)
+            if lease is not None:
+                self._reply(sock, segment, header, DhcpServer.OFFER, lease.ip)
+        elif message_type == DhcpServer.REQUEST:
+            if server_id is not None and server_id != ipaddress.IPv4Address(segment.ip).packed:
+                # The client chose another server
+                offer = self.offers.pop(mac, None)
+                if offer is not None:
+                    self._release(offer)
+                return
+            ip = requested or (ciaddr_ip if ciaddr_ip != '0.0.0.0' else None)
+            lease = self._bind(segment, mac, hostname, ip)
+            if lease is not None:
+                self._reply(sock, segment, header, DhcpServer.ACK, lease.ip)
+            elif ip is not None:
+                # Outside of the range or taken by another client
+                self._reply(sock, segment, header, DhcpServer.NAK, None)
+        elif message_type == DhcpServer.DECLINE and requested is not None:
+            # Someone else uses the address, keep it out of the pool for a while
+            lease = self.leases.lookup_ip(requested)
+            if lease is not None and lease.mac == mac:
+                self.leases.remove(requested)
+            offer = self.offers.get(mac)
+            if offer is not None and offer.ip == requested:
+                del self.offers[mac]
+            if ipaddress.IPv4Address(requested) in self._pool(requested):
+                self._pool(requested).take(ipaddress.IPv4Address(requested))
+                self.declined[requested] = time.time() + DhcpServer.DECLINE_TIME
+            self.dirty = True
+        elif message_type == DhcpServer.RELEASE:
+            lease = self.leases.lookup_ip(ciaddr_ip)
+            if lease is not None and lease.mac == mac:
+                self.leases.remove(ciaddr_ip)
+                self._release(lease)
+                self.dirty = True
+        elif message_type == DhcpServer.INFORM:
+            self._reply(sock, segment, header, DhcpServer.ACK, None)
+
+    def _offer(self, segment, mac, hostname, requested) -> Optional[Lease]:
+        """
+        Pick an address for a client: its current lease or offer, else the requested address if free, else any.
+        """
+        pool = self.pools[segment.interface]
+        lease = self.leases.lookup_mac(mac) or self.offers.get(mac)
+        fixed = self._fixed(segment, mac)
+        if fixed is not None:
+            ip, reserved_hostname = fixed
+            if lease is not None and lease.ip != ip:
+                # Reserved since it got a dynamic address
+                self.offers.pop(mac, None)
+                self.leases.remove(lease.ip)
+                self._release(lease)
+                lease = None
+            if lease is None:
+                lease = Lease(ip)
+                lease.mac = mac
+                lease.state = 'offered'
+                self.offers[mac] = lease
+            lease.hostname = reserved_hostname or hostname or lease.hostname
+            if lease.state != LeaseIndex.ACTIVE:
+                lease.ends = time.time() + DhcpServer.OFFER_TIME
+            return lease
+        if lease is not None and ipaddress.IPv4Address(lease.ip) in pool:
+            if lease.state != LeaseIndex.ACTIVE:
+                lease.ends = time.time() + DhcpServer.OFFER_TIME
+            return lease
+        if lease is not None:
+            # Moved to another segment
+            self.offers.pop(mac, None)
+            self.leases.remove(lease.ip)
+            self._release(lease)
+
+        ip = None
+        if requested is not None and ipaddress.IPv4Address(requested) in pool \
+                and pool.take(ipaddress.IPv4Address(requested)):
+            ip = ipaddress.IPv4Address(requested)
+        if ip is None:
+            ip = pool.allocate()
+        if ip is None:
+            self.c.error('{!r}No free address left for %s on %s' % (mac, segment.interface))
+            return None
+        lease = Lease(str(ip))
+        lease.mac = mac
+        lease.hostname = hostname
+        lease.state = 'offered'
+        lease.ends = time.time() + DhcpServer.OFFER_TIME
+        self.offers[mac] = lease
+        return lease
+
+    def _bind(self, segment, mac, hostname, ip) -> Optional[Lease]:
+        """
+        Turn the offer or lease of a client into an active lease of ip, None if the client may not have it.
+        """
+        if ip is None:
+            return None
+        address = ipaddress.IPv4Address(ip)
+        pool = self.pools[segment.interface]
+        fixed = self._fixed(segment, mac)
+        if fixed is not None and fixed[0] != ip or fixed is None and address not in pool:
+            return None
+        lease = self.offers.get(mac) or self.leases.lookup_mac(mac)
+        if lease is None or lease.ip != ip:
+            # Init-reboot or a lease we do not know (e.g. lost without a snapshot), grant it if the address is free
+            if fixed is None and not pool.take(address):
+                return None
+            if lease is not None:
+                self.offers.pop(mac, None)
+                self.leases.remove(lease.ip)
+                self._release(lease)
+            lease = Lease(ip)
+            lease.mac = mac
+        self.offers.pop(mac, None)
+        lease.hostname = (fixed[1] if fixed is not None else None) or hostname or lease.hostname
+        lease.starts = int(time.time())
+        lease.ends = lease.starts + DhcpServer.LEASE_TIME
+        lease.state = LeaseIndex.ACTIVE
+        self.leases.apply(lease)
+        self.dirty = True
+        return lease
+
+    def _release(self, lease):
+        if lease.ip in self.declined:
+            return
+        self._pool(lease.ip).release(ipaddress.IPv4Address(lease.ip))
+
+    def _fixed(self, segment, mac):
+        """
+        (ip, hostname) reserved for mac on segment, None if there is no such reservation.
+        """
+        if self.reservations is None:
+            return None
+        fixed = self.reservations.lookup_mac(mac)
+        if fixed is None or ipaddress.IPv4Address(fixed[0]) not in segment.address.network:
+            return None
+        return fixed
+
+    def _pool(self, ip) -> AddressPool:
+        address = ipaddress.IPv4Address(ip)
+        for pool in self.pools.values():
+            if address in pool:
+                return pool
+        # Not in any range, an empty pool ignores it
+        return AddressPool(address, address - 1)
+
+    def _reply(self, sock, segment, request_header, message_type, yiaddr):
+        header = list(request_header)
+        header[0] = DhcpServer.BOOTREPLY
+        header[3] = 0
+        header[5] = 0
+        if message_type != DhcpServer.ACK:
+            # ciaddr is only kept when acknowledging a renewal or an inform
+            header[7] = b'\0\0\0\0'
+        header[8] = ipaddress.IPv4Address(yiaddr).packed if yiaddr is not None else b'\0\0\0\0'
+        header[9] = b'\0\0\0\0'
+        header[12] = b'\0' * 64
+        header[13] = b'\0' * 128
+
+        options = [(DhcpServer.OPTION_MESSAGE_TYPE, bytes([message_type])),
+                   (DhcpServer.OPTION_SERVER_ID, ipaddress.IPv4Address(segment.ip).packed)]
+        if message_type != DhcpServer.NAK:
+            if yiaddr is not None:
+                options += [
+                    (DhcpServer.OPTION_LEASE_TIME, struct.pack('!I', DhcpServer.LEASE_TIME)),
+                    (DhcpServer.OPTION_RENEWAL_TIME, struct.pack('!I', DhcpServer.LEASE_TIME // 2)),
+                    (DhcpServer.OPTION_REBINDING_TIME, struct.pack('!I', DhcpServer.LEASE_TIME * 7 // 8)),
+                ]
+            options += [
+                (DhcpServer.OPTION_SUBNET_MASK, ipaddress.IPv4Address(segment.netmask).packed),
+                (DhcpServer.OPTION_ROUTER, ipaddress.IPv4Address(segment.ip).packed),
+                (DhcpServer.OPTION_DNS, ipaddress.IPv4Address(segment.ip).packed),
+                (DhcpServer.OPTION_BROADCAST, ipaddress.IPv4Address(segment.broadcast).packed),
+            ]
+            if self.domain:
+                options.append((DhcpServer.OPTION_DOMAIN, self.domain.encode()))
+        packet = DhcpServer.HEADER.pack(*header) + b''.join(
+            bytes([code, len(value)]) + value for code, value in options) + bytes([DhcpServer.OPTION_END])
+
+        # Clients without an address yet can only receive broadcasts, the socket is bound to the interface
+        ciaddr = ipaddress.IPv4Address(request_header[7])
+        if message_type == DhcpServer.ACK and int(ciaddr):
+            destination = str(ciaddr)
+        else:
+            destination = '255.255.255.255'
+        try:
+            sock.sendto(packet, (destination, DhcpServer.CLIENT_PORT))
+        except OSError as e:
+            self.c.error('{!r}Sending to %s on %s failed: %s' % (destination, segment.interface, e))
+
+    @staticmethod
+    def parse_options(data) -> dict:
+        options = {}
+        i = 0
+        while i < len(data):
+            code = data[i]
+            if code == 0:
+                i += 1
+                continue
+            if code == DhcpServer.OPTION_END:
+                break
+            length = data[i + 1]
+            # Long options may be split, their parts are concatenated
+            options[code] = options.get(code, b'') + bytes(data[i + 2:i + 2 + length])
+            i += 2 + length
+        return options
+
+    def _load(self):
+        if self.snapshot is None:
+            return
+        try:
+            with open(self.snapshot) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.c.error('{!y}Ignoring unreadable lease snapshot %s: %s' % (self.snapshot, e))
+            return
+        now = time.time()
+        for ip, mac, hostname, starts, ends in snapshot.get('leases', []):
+            address = ipaddress.IPv4Address(ip)
+            reserved = self.reservations is not None and (self.reservations.lookup_mac(mac) or (None,))[0] == ip
+            if ends <= now or not reserved and not any(address in pool for pool in self.pools.values()):
+                continue
+            if not reserved and not self._pool(ip).take(address):
+                continue
+            lease = Lease(ip)
+            lease.mac, lease.hostname, lease.starts, lease.ends = mac, hostname, starts, ends
+            lease.state = LeaseIndex.ACTIVE
+            self.leases.apply(lease)
+        self.c.print('{!g}Loaded %d leases from %s' % (len(self.leases), self.snapshot))
+
+    def _save(self):
+        self.dirty = False
+        if self.snapshot is None:
+            return
+        leases = [[lease.ip, lease.mac, lease.hostname, lease.starts, lease.ends]
+                  for lease in self.leases.ips.values()]
+        try:
+            directory = os.path.dirname(os.path.abspath(self.snapshot))
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.leases_')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'leases': leases}, f)
+            os.replace(tmp, self.snapshot)
+        except OSError as e:
+            self.c.error('{!r}Could not save the lease snapshot %s: %s' % (self.snapshot, e))
@@ -0,0 +1,668 @@
+import argparse
+import asyncio
+import base64
+import binascii
+import ipaddress
+import json
+import os
+import random
+import socket
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from tools import ColorPrint
+from tools.Segment import Segment
+from tools.Tracer import tracer
+
+
+class DnsCache:
+    """
+    Bounded LRU cache of DNS responses by question. An entry expires with the smallest TTL of its records (of the SOA
+    for negative answers), and the least recently used entries are evicted once all entries together take more than
+    max_bytes, counting a fixed overhead per entry, so the memory used stays predictable.
+    """
+
+    OVERHEAD = 256
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # key -> (response with id 0, offsets of its TTL fields, stored at, expires at)
+        self.entries: OrderedDict = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, now: float):
+        entry = self.entries.get(key)
+        if entry is not None and entry[3] <= now:
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, response: bytes, offsets: List[int], ttl: int, now: float):
+        size = len(response) + DnsCache.OVERHEAD
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (response, offsets, now, now + ttl)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        if key in self.entries:
+            self._drop(key)
+
+    def dump(self, now: float) -> list:
+        """
+        The entries that did not expire yet, least recently used first, with their times as unix timestamps so they
+        can be loaded by another process.
+        """
+        wall = time.time()
+        return [[base64.b64encode(key[0]).decode(), key[1], key[2], base64.b64encode(response).decode(), offsets,
+                 wall - (now - stored_at), wall + (expires_at - now)]
+                for key, (response, offsets, stored_at, expires_at) in self.entries.items() if expires_at > now]
+
+    def load(self, entries: list, now: float) -> int:
+        """
+        Add entries written by dump, keeping their remaining TTL. Returns how many were still valid.
+        """
+        wall = time.time()
+        loaded = 0
+        for question, dnssec_ok, checking_disabled, response, offsets, stored_at, expires_at in entries:
+            if expires_at <= wall:
+                continue
+            response = base64.b64decode(response)
+            size = len(response) + DnsCache.OVERHEAD
+            key = (base64.b64decode(question), dnssec_ok, checking_disabled)
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (response, offsets, now - (wall - stored_at), now + (expires_at - wall))
+            self.bytes += size
+            loaded += 1
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+        return loaded
+
+    def _drop(self, key):
+        self.bytes -= len(self.entries.pop(key)[0]) + DnsCache.OVERHEAD
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class _Pending:
+    """
+    A query forwarded upstream, with everyone waiting for its answer.
+    """
+    __slots__ = ('key', 'query', 'waiters', 'attempt', 'id', 'sock', 'upstream', 'timer')
+
+    def __init__(self, key, query):
+        self.key = key
+        self.query = query
+        self.waiters = []
+        self.attempt = 0
+        self.id = None
+        self.sock = None
+        self.upstream = None
+        self.timer = None
+
+
+class DnsForwarder:
+    """
+    Caching DNS forwarder running on the Supervisor's event loop, answering UDP and TCP queries from the segments on
+    their ip. Answers are cached in a DnsCache, identical queries arriving while one is forwarded wait for its answer,
+    and queries are forwarded over a pool of UDP sockets with random ports and ids, retried on the next upstream on
+    timeout. Names under domain and their reverse names are answered from the local host records instead (see set_host).
+    Like a Daemon it is started and stopped by its module and attached to the event loop by the Supervisor.
+    """
+
+    PORT = 53
+    POOL_SIZE = 16
+    TIMEOUT = 2.0
+    ATTEMPTS = 3
+    TCP_IDLE = 10.0
+    MAX_TTL = 86400
+    MAX_NEGATIVE_TTL = 3600
+
+    QR, OPCODE, AA, TC, RD, RA, CD, RCODE = 0x8000, 0x7800, 0x0400, 0x0200, 0x0100, 0x0080, 0x0010, 0x000f
+    NOERROR, FORMERR, SERVFAIL, NXDOMAIN, NOTIMP, REFUSED = 0, 1, 2, 3, 4, 5
+    TYPE_A, TYPE_SOA, TYPE_PTR, TYPE_AAAA, TYPE_OPT = 1, 6, 12, 28, 41
+    LOCAL_TTL = 300
+    HEADER = struct.Struct('!HHHHHH')
+
+    def __init__(self, name, segments: List[Segment], upstreams: List[Tuple[str, int]], cache_size: int, runner,
+                 port: int = PORT, domain: str = None, cache_file: str = None):
+        self.name = name
+        self.segments = segments
+        self.upstreams = upstreams
+        self.port = port
+        self.domain = domain.lower().strip('.') if domain else None
+        self.cache_file = cache_file
+        # Local host records, names in lowercase without the trailing dot
+        self.hosts: Dict[str, str] = {}
+        self.pointers: Dict[str, str] = {}
+        self.runner = runner
+        self.c = ColorPrint(name=name)
+
+        self.cache = DnsCache(cache_size)
+        self.networks = [(int(segment.address.network.network_address), int(segment.address.network.netmask))
+                         for segment in segments]
+        self.sockets = []
+        self.listeners = []
+        self.servers = []
+        self.pool = []
+        self.pending: Dict[int, _Pending] = {}
+        self.inflight: Dict[tuple, _Pending] = {}
+        self.loop = None
+        self.started_at = None
+        self.queries = 0
+        self.coalesced = 0
+        self.forwarded = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.local_answers = 0
+
+    @staticmethod
+    def parse_upstream(spec: str) -> Tuple[str, int]:
+        """
+        Parse an upstream given as IP[:PORT], for use as argparse type.
+        """
+        ip, _, port = spec.partition(':')
+        try:
+            return str(ipaddress.IPv4Address(ip)), int(port) if port else DnsForwarder.PORT
+        except ValueError:
+            raise argparse.ArgumentTypeError('Upstream "%s" is not of the form IP[:PORT]' % (spec,))
+
+    @staticmethod
+    def system_upstreams(path='/etc/resolv.conf') -> List[Tuple[str, int]]:
+        """
+        The IPv4 nameservers of the system.
+        """
+        upstreams = []
+        try:
+            with open(path) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 2 and parts[0] == 'nameserver':
+                        try:
+                            upstreams.append((str(ipaddress.IPv4Address(parts[1])), DnsForwarder.PORT))
+                        except ValueError:
+                            pass
+        except OSError:
+            pass
+        return upstreams
+
+    @property
+    def alive(self) -> bool:
+        return bool(self.sockets)
+
+    def start(self):
+        """
+        Load the cache file, and open the listening sockets on the ip of every segment and the upstream socket pool.
+        If already attached to an event loop it serves right away, otherwise once attached.
+        """
+        if self.runner.plan is not None:
+            self.runner.record('forward', name=self.name, segments=[segment.spec for segment in self.segments],
+                               upstreams=['%s:%d' % upstream for upstream in self.upstreams],
+                               cache_size=self.cache.max_bytes, port=self.port, domain=self.domain,
+                               cache_file=self.cache_file)
+            return
+        with tracer.span('%s.start' % (self.name,), 'serve', module=self.runner.name):
+            try:
+                for segment in self.segments:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    self.sockets.append(sock)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+                    sock.bind((segment.ip, self.port))
+                    sock.setblocking(False)
+                    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    self.listeners.append(listener)
+                    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    listener.bind((segment.ip, self.port))
+                    listener.listen(128)
+                    listener.setblocking(False)
+                for _ in range(DnsForwarder.POOL_SIZE):
+                    # Bound to a random port each, together with random ids this makes spoofing answers hard
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    self.pool.append(sock)
+                    sock.bind(('0.0.0.0', 0))
+                    sock.setblocking(False)
+            except OSError:
+                self.stop()
+                raise
+            self._load_cache()
+        self.started_at = time.monotonic()
+        self.c.print('{!g}Forwarding DNS on %s to %s' % (', '.join(segment.ip for segment in self.segments),
+                                                        ', '.join('%s:%d' % upstream for upstream in self.upstreams)))
+        if self.loop is not None:
+            self._watch()
+
+    def attach(self, loop):
+        self.loop = loop
+        if self.sockets:
+            self._watch()
+
+    def detach(self):
+        """
+        Stop serving, queries still waiting for upstream are dropped.
+        """
+        if self.loop is not None:
+            for sock in self.sockets + self.pool:
+                self.loop.remove_reader(sock)
+            for server in self.servers:
+                server.close()
+        self.servers = []
+        for pending in self.pending.values():
+            if pending.timer is not None:
+                pending.timer.cancel()
+        self.pending = {}
+        self.inflight = {}
+        self.loop = None
+
+    def check(self):
+        pass
+
+    def stop(self):
+        """
+        Stop serving and save the cache file.
+        """
+        self.detach()
+        if self.runner.plan is not None:
+            self.runner.record('stop', name=self.name)
+            return
+        if self.sockets:
+            self._save_cache()
+        for sock in self.sockets + self.listeners + self.pool:
+            sock.close()
+        self.sockets, self.listeners, self.pool = [], [], []
+
+    def status(self) -> dict:
+        return {
+            'alive': self.alive,
+            'pid': os.getpid() if self.alive else None,
+            'uptime': time.monotonic() - self.started_at if self.alive else 0.0,
+            'restarts': 0,
+            'queries': self.queries,
+            'cache hits': self.cache.hits,
+            'cache entries': len(self.cache),
+            'cache bytes': self.cache.bytes,
+            'coalesced': self.coalesced,
+            'forwarded': self.forwarded,
+            'timeouts': self.timeouts,
+            'failures': self.failures,
+            'local answers': self.local_answers,
+            'host records': len(self.hosts),
+        }
+
+    def set_host(self, name: str, ip: str):
+        """
+        Answer A queries for name and PTR queries for ip locally, replacing a previous address of name.
+        """
+        name = name.lower().strip('.')
+        self.remove_host(name)
+        self.hosts[name] = ip
+        self.pointers[ipaddress.IPv4Address(ip).reverse_pointer] = name
+
+    def remove_host(self, name: str):
+        """
+        Drop the records of name, it does not exist anymore.
+        """
+        name = name.lower().strip('.')
+        ip = self.hosts.pop(name, None)
+        if ip is not None:
+            pointer = ipaddress.IPv4Address(ip).reverse_pointer
+            if self.pointers.get(pointer) == name:
+                del self.pointers[pointer]
+
+    def _load_cache(self):
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f).get('entries', [])
+            loaded = self.cache.load(entries, time.monotonic())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError, binascii.Error) as e:
+            self.c.error('{!y}Ignoring unreadable DNS cache %s: %s' % (self.cache_file, e))
+            return
+        self.c.print('{!g}Loaded %d cached answers from %s' % (loaded, self.cache_file))
+
+    def _save_cache(self):
+        if self.cache_file is None:
+            return
+        try:
+            directory = os.path.dirname(os.path.abspath(self.cache_file))
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.dnscache_')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'entries': self.cache.dump(time.monotonic())}, f)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            self.c.error('{!r}Could not save the DNS cache %s: %s' % (self.cache_file, e))
+
+    def _watch(self):
+        for sock in self.sockets:
+            self.loop.add_reader(sock, self._on_query, sock)
+        for sock in self.pool:
+            self.loop.add_reader(sock, self._on_upstream, sock)
+        for listener in self.listeners:
+            self.loop.create_task(self._serve_tcp(listener))
+
+    async def _serve_tcp(self, listener):
+        server = await asyncio.start_server(self._on_tcp_client, sock=listener)
+        if self.loop is None:
+            # Detached meanwhile
+            server.close()
+        else:
+            self.servers.append(server)
+
+    def _allowed(self, ip: str) -> bool:
+        address = int.from_bytes(socket.inet_aton(ip), 'big')
+        return any(address & netmask == network for network, netmask in self.networks)
+
+    def _on_query(self, sock):
+        # Handle everything queued at once
+        while True:
+            try:
+                data, address = sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.c.error('{!r}Receiving queries failed: %s' % (e,))
+                return
+            if not self._allowed(address[0]):
+                continue
+            self._query(data, lambda packet, address=address: self._send(sock, packet, address), False)
+
+    async def _on_tcp_client(self, reader, writer):
+        if not self._allowed(writer.get_extra_info('peername')[0]):
+            writer.close()
+            return
+        try:
+            while True:
+                length = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), DnsForwarder.TCP_IDLE))[0]
+                data = await asyncio.wait_for(reader.readexactly(length), DnsForwarder.TCP_IDLE)
+                self._query(data, lambda packet: writer.write(struct.pack('!H', len(packet)) + packet), True)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    def _send(self, sock, packet, address):
+        try:
+            sock.sendto(packet, address)
+        except OSError as e:
+            self.c.error('{!r}Sending to %s failed: %s' % (address[0], e))
+
+    def _query(self, data: bytes, reply, tcp: bool):
+        """
+        Answer a query from the host records or the cache, or forward it upstream unless the same question is forwarded
+        already.
+        """
+        try:
+            query_id, flags, qdcount = DnsForwarder.HEADER.unpack_from(data)[:3]
+            if flags & DnsForwarder.QR:
+                return
+            if flags & DnsForwarder.OPCODE or qdcount != 1:
+                reply(DnsForwarder._error(data, None, DnsForwarder.NOTIMP if flags & DnsForwarder.OPCODE
+                                          else DnsForwarder.FORMERR))
+                return
+            end, key, max_size = DnsForwarder._parse_query(data)
+        except (ValueError, IndexError, struct.error):
+            if len(data) >= DnsForwarder.HEADER.size:
+                reply(DnsForwarder._error(data, None, DnsForwarder.FORMERR))
+            return
+        self.queries += 1
+        if self.domain is not None and self._local(data, end, reply):
+            return
+        # A client waiting for the answer: how to reply, its id and question (keeping the case it used) and size limit
+        waiter = (reply, query_id, data[12:end], 65535 if tcp else max_size, tcp)
+
+        now = time.monotonic()
+        entry = self.cache.get(key, now)
+        if entry is not None:
+            response, offsets, stored_at, _ = entry
+            DnsForwarder._answer(response, waiter, offsets, int(now - stored_at))
+            return
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            pending.waiters.append(waiter)
+            return
+        pending = _Pending(key, data)
+        pending.waiters.append(waiter)
+        self.inflight[key] = pending
+        self._forward(pending)
+
+    def _local(self, data: bytes, end: int, reply) -> bool:
+        """
+        Answer a query for a name under the domain or the reverse name of a host record, False if it is for neither.
+        Names under the domain without a record do not exist, other types than A (PTR) of them have no data.
+        """
+        name, offset = [], 12
+        while data[offset]:
+            name.append(data[offset + 1:offset + 1 + data[offset]].decode(errors='replace').lower())
+            offset += 1 + data[offset]
+        name = '.'.join(name)
+        qtype = struct.unpack_from('!H', data, offset + 1)[0]
+        target = self.pointers.get(name)
+        if target is not None:
+            rtype = DnsForwarder.TYPE_PTR
+            rdata = b''.join(bytes([len(label)]) + label.encode() for label in target.split('.')) + b'\0'
+        elif name == self.domain or name.endswith('.' + self.domain):
+            rtype = DnsForwarder.TYPE_A
+            ip = self.hosts.get(name)
+            rdata = socket.inet_aton(ip) if ip is not None else None
+        else:
+            return False
+        self.local_answers += 1
+        flags = DnsForwarder.QR | DnsForwarder.AA | DnsForwarder.RA | (struct.unpack_from('!H', data, 2)[0] &
+                                                                        DnsForwarder.RD)
+        if rdata is None and name != self.domain:
+            flags |= DnsForwarder.NXDOMAIN
+        if rdata is None or qtype != rtype:
+            reply(DnsForwarder.HEADER.pack(struct.unpack_from('!H', data)[0], flags, 1, 0, 0, 0) + data[12:end])
+            return True
+        # The answer's name points to the question
+        record = struct.pack('!HHHIH', 0xc00c, rtype, 1, DnsForwarder.LOCAL_TTL, len(rdata)) + rdata
+        reply(DnsForwarder.HEADER.pack(struct.unpack_from('!H', data)[0], flags, 1, 1, 0, 0) + data[12:end] + record)
+        return True
+
+    def _forward(self, pending: _Pending):
+        query_id = random.getrandbits(16)
+        while query_id in self.pending:
+            query_id = random.getrandbits(16)
+        pending.id = query_id
+        pending.sock = random.choice(self.pool)
+        pending.upstream = self.upstreams[pending.attempt % len(self.upstreams)]
+        self.pending[query_id] = pending
+        self.forwarded += 1
+        try:
+            pending.sock.sendto(struct.pack('!H', query_id) + pending.query[2:], pending.upstream)
+        except OSError as e:
+            self.c.error('{!r}Forwarding to %s failed: %s' % (pending.upstream[0], e))
+        pending.timer = self.loop.call_later(DnsForwarder.TIMEOUT, self._timeout, pending)
+
+    def _timeout(self, pending: _Pending):
+        self.timeouts += 1
+        del self.pending[pending.id]
+        pending.attempt += 1
+        if pending.attempt < DnsForwarder.ATTEMPTS:
+            self._forward(pending)
+        else:
+            self._fail(pending)
+
+    def _fail(self, pending: _Pending):
+        self.failures += 1
+        self.inflight.pop(pending.key, None)
+        for waiter in pending.waiters:
+            waiter[0](DnsForwarder._error(pending.query, waiter, DnsForwarder.SERVFAIL))
+
+    def _on_upstream(self, sock):
+        while True:
+            try:
+                data, address = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # e.g. ICMP port unreachable from an upstream, the query times out and is retried
+                continue
+            if len(data) < DnsForwarder.HEADER.size:
+                continue
+            pending = self.pending.get(struct.unpack_from('!H', data)[0])
+            # Only accept the answer from where the query went to, for the same question
+            if pending is None or pending.sock is not sock or address != pending.upstream:
+                continue
+            end = 12 + len(pending.waiters[0][2])
+            if data[12:end].lower() != pending.query[12:end].lower():
+                continue
+            pending.timer.cancel()
+            del self.pending[pending.id]
+            self._resolved(pending, data, end)
+
+    def _resolved(self, pending: _Pending, response: bytes, end: int):
+        flags = struct.unpack_from('!H', response, 2)[0]
+        if flags & DnsForwarder.TC and any(waiter[4] for waiter in pending.waiters):
+            # Too large for UDP, clients on UDP retry on TCP themselves, those on TCP get it from upstream by TCP
+            waiters = [waiter for waiter in pending.waiters if not waiter[4]]
+            for waiter in waiters:
+                DnsForwarder._answer(response, waiter, [], 0)
+            pending.waiters = [waiter for waiter in pending.waiters if waiter[4]]
+            self.loop.create_task(self._forward_tcp(pending, end))
+            return
+        self.inflight.pop(pending.key, None)
+        try:
+            ttl, offsets = DnsForwarder._ttl(response, end)
+        except (ValueError, IndexError, struct.error):
+            ttl, offsets = 0, []
+        if not flags & DnsForwarder.TC:
+            self.cache.put(pending.key, b'\0\0' + response[2:], offsets, ttl, time.monotonic())
+        for waiter in pending.waiters:
+            DnsForwarder._answer(response, waiter, offsets, 0)
+
+    async def _forward_tcp(self, pending: _Pending, end: int):
+        for attempt in range(len(self.upstreams)):
+            upstream = self.upstreams[(pending.attempt + attempt) % len(self.upstreams)]
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*upstream), DnsForwarder.TIMEOUT)
+                try:
+                    writer.write(struct.pack('!H', len(pending.query)) + pending.query)
+                    length = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), DnsForwarder.TIMEOUT))[0]
+                    response = await asyncio.wait_for(reader.readexactly(length), DnsForwarder.TIMEOUT)
+                finally:
+                    writer.close()
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                continue
+            if response[:2] == pending.query[:2] and response[12:end].lower() == pending.query[12:end].lower():
+                self.forwarded += 1
+                self._resolved(pending, response, end)
+                return
+        self._fail(pending)
+
+    @staticmethod
+    def _answer(response: bytes, waiter, offsets: List[int], elapsed: int):
+        """
+        Send response to a waiting client, with its id and question, TTLs reduced by elapsed seconds, and truncated if
+        larger than it accepts.
+        """
+        reply, query_id, question, max_size, _ = waiter
+        if len(response) > max_size:
+            flags = struct.unpack_from('!H', response, 2)[0] | DnsForwarder.TC
+            reply(DnsForwarder.HEADER.pack(query_id, flags, 1, 0, 0, 0) + question)
+            return
+        packet = bytearray(response)
+        struct.pack_into('!H', packet, 0, query_id)
+        packet[12:12 + len(question)] = question
+        if elapsed:
+            for offset in offsets:
+                ttl = struct.unpack_from('!I', packet, offset)[0]
+                struct.pack_into('!I', packet, offset, max(ttl - elapsed, 0))
+        reply(bytes(packet))
+
+    @staticmethod
+    def _error(query: bytes, waiter, rcode: int) -> bytes:
+        """
+        An error response to query, for waiter if given.
+        """
+        query_id, flags = struct.unpack_from('!HH', query)
+        flags = DnsForwarder.QR | DnsForwarder.RA | (flags & (DnsForwarder.OPCODE | DnsForwarder.RD)) | rcode
+        if waiter is None:
+            return DnsForwarder.HEADER.pack(query_id, flags, 0, 0, 0, 0)
+        return DnsForwarder.HEADER.pack(waiter[1], flags, 1, 0, 0, 0) + waiter[2]
+
+    @staticmethod
+    def _skip_name(data: bytes, offset: int) -> int:
+        while True:
+            length = data[offset]
+            if length & 0xc0 == 0xc0:
+                return offset + 2
+            if length & 0xc0:
+                raise ValueError('invalid label')
+            offset += 1 + length
+            if length == 0:
+                return offset
+
+    @staticmethod
+    def _parse_query(data: bytes):
+        """
+        The end of the question, the cache key and the UDP payload size the client accepts.
+        The key is the question in lowercase, the DNSSEC OK bit and the checking disabled flag, as they change answers.
+        """
+        offset = 12
+        while data[offset]:
+            if data[offset] & 0xc0:
+                raise ValueError('compressed question')
+            offset += 1 + data[offset]
+        end = offset + 5
+        if end > len(data):
+            raise ValueError('truncated question')
+        flags, arcount = struct.unpack_from('!H', data, 2)[0], struct.unpack_from('!H', data, 10)[0]
+        max_size, dnssec_ok = 512, False
+        offset = end
+        for _ in range(arcount):
+            offset = DnsForwarder._skip_name(data, offset)
+            rtype, rclass, ttl, length = struct.unpack_from('!HHIH', data, offset)
+            if rtype == DnsForwarder.TYPE_OPT:
+                max_size, dnssec_ok = max(rclass, 512), bool(ttl & 0x8000)
+            offset += 10 + length
+        return end, (data[12:end].lower(), dnssec_ok, bool(flags & DnsForwarder.CD)), max_size
+
+    @staticmethod
+    def _ttl(response: bytes, end: int) -> Tuple[int, List[int]]:
+        """
+        How long response may be cached, and the offsets of the TTL fields of its records (but the OPT pseudo-record).
+        Negative answers are cached for the TTL of the SOA in the authority section (RFC 2308), errors not at all.
+        """
+        _, flags, _, ancount, nscount, arcount = DnsForwarder.HEADER.unpack_from(response)
+        rcode = flags & DnsForwarder.RCODE
+        offsets, ttls, negative_ttl = [], [], None
+        offset = end
+        for section, count in enumerate((ancount, nscount, arcount)):
+            for _ in range(count):
+                offset = DnsForwarder._skip_name(response, offset)
+                rtype, _, ttl, length = struct.unpack_from('!HHIH', response, offset)
+                if rtype != DnsForwarder.TYPE_OPT:
+                    offsets.append(offset + 4)
+                    ttls.append(ttl)
+                if section == 1 and rtype == DnsForwarder.TYPE_SOA:
+                    # The SOA MINIMUM is the last field of its rdata
+                    minimum = struct.unpack_from('!I', response, offset + 10 + length - 4)[0]
+                    negative_ttl = min(ttl, minimum, DnsForwarder.MAX_NEGATIVE_TTL)
+                offset += 10 + length
+        if rcode == DnsForwarder.NXDOMAIN or rcode == DnsForwarder.NOERROR and not ancount:
+            return negative_ttl or 0, offsets
+        if rcode != DnsForwarder.NOERROR:
+            return 0, offsets
+        return min(ttls + [DnsForwarder.MAX_TTL]), offsets
@@ -0,0 +1,75 @@
+import os
+from typing import List, Tuple
+
+from tools.DBus import DBus, DBusError
+from tools.Tracer import tracer
+
+
+class Firewalld:
+    """
+    The runtime zone settings of firewalld, changed through its D-Bus API over one persistent connection instead of a
+    firewall-cmd process (with a connection of its own) per change. All queries or changes given at once are sent
+    together and cost a single round trip.
+    """
+
+    BUS_NAME = 'org.fedoraproject.FirewallD1'
+    PATH = '/org/fedoraproject/FirewallD1'
+    ZONE = BUS_NAME + '.zone'
+    # Errors firewall-cmd only warns about, the zone is as requested already
+    WARNINGS = ('ALREADY_ENABLED', 'NOT_ENABLED', 'ZONE_ALREADY_SET')
+
+    def __init__(self, runner, address: str = None):
+        self.runner = runner
+        self.bus = DBus(address)
+
+    @property
+    def address(self) -> str:
+        return self.bus.address
+
+    @staticmethod
+    def available(address: str = None) -> bool:
+        """
+        Whether the bus firewalld would be on is there, without connecting to it.
+        """
+        transport, _, options = DBus(address).address.partition(':')
+        options = dict(option.partition('=')[::2] for option in options.split(','))
+        return transport == 'unix' and ('abstract' in options or os.path.exists(options.get('path', '')))
+
+    def close(self):
+        self.bus.close()
+
+    def query(self, calls: List[Tuple[str, str, tuple]]) -> list:
+        """
+        Call the zone methods (member, signature, args) that only read settings, also while planning. Returns the
+        value of every reply in order, or a DBusError for calls that failed. Raises DBusError if firewalld cannot be
+        reached.
+        """
+        with tracer.span('firewalld', 'command', module=self.runner.name, calls=[call[0] for call in calls]):
+            results = self.bus.calls([(Firewalld.BUS_NAME, Firewalld.PATH, Firewalld.ZONE, member, signature, args)
+                                      for member, signature, args in calls])
+        return [result if isinstance(result, DBusError) else result[0] for result in results]
+
+    def apply(self, calls: List[Tuple[str, str, tuple]]):
+        """
+        Call the zone methods (member, signature, args) that change settings, in order. Raises DBusError for the first
+        one that failed, unless firewall-cmd would only have warned about it.
+        """
+        if not calls:
+            return
+        if self.runner.plan is not None:
+            self.runner.record('firewalld', address=self.address, calls=[list(call) for call in calls])
+            return
+        self.runner.c.print('{!y} D-Bus: %s' % (', '.join('%s(%s)' % (member, ', '.join(map(str, args)))
+                                                          for member, _, args in calls),))
+        failed = None
+        for (member, _, args), result in zip(calls, self.query(calls)):
+            if not isinstance(result, DBusError):
+                continue
+            if result.message.split(':')[0] in Firewalld.WARNINGS:
+                self.runner.c.print('{!y} Warning: %s' % (result.message,))
+            elif failed is None:
+                failed = result
+                self.runner.c.error('{!r} %s(%s) failed: %s' % (member, ', '.join(map(str, args)), result.message))
+        if failed is not None:
+            raise failed
+        self.runner.c.print('{!g} Done')
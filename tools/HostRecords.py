@@ -0,0 +1,79 @@
+import ipaddress
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class HostRecords:
+    """
+    The A and PTR records under domain for the active DHCP leases, kept up to date from the changes a LeaseIndex passes
+    to its listeners. A lease is published under the first label of the hostname its client sent, if a name is claimed
+    by several leases the most recent one gets it.
+    """
+
+    TTL = 300
+    INVALID = re.compile(r'[^a-z0-9-]+')
+
+    def __init__(self, domain: str):
+        self.domain = domain.lower().strip('.')
+        self.names: Dict[str, str] = {}
+        self.ips: Dict[str, str] = {}
+
+    @staticmethod
+    def label(hostname: Optional[str]) -> Optional[str]:
+        """
+        hostname made a valid DNS label, None if nothing is left of it.
+        """
+        if not hostname:
+            return None
+        label = HostRecords.INVALID.sub('-', hostname.split('.')[0].lower()).strip('-')[:63].rstrip('-')
+        return label or None
+
+    def update(self, changes: dict) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+        """
+        Apply the changes {ip: Lease or None} of a LeaseIndex, returns the records (fqdn, ip) removed and added.
+        All removals are to be applied before the additions, a record can be in both if it was replaced.
+        """
+        removed, added = [], []
+        for ip, lease in changes.items():
+            label = HostRecords.label(lease.hostname) if lease is not None else None
+            name = '%s.%s' % (label, self.domain) if label is not None else None
+            if name is not None and self.ips.get(ip) == name:
+                # Renewed
+                continue
+            old = self.ips.pop(ip, None)
+            if old is not None:
+                del self.names[old]
+                removed.append((old, ip))
+            if name is None:
+                continue
+            other = self.names.pop(name, None)
+            if other is not None:
+                del self.ips[other]
+                removed.append((name, other))
+            self.names[name] = ip
+            self.ips[ip] = name
+            added.append((name, ip))
+        # Added and removed again within the same changes
+        added = [record for record in added if self.names.get(record[0]) == record[1]]
+        return removed, added
+
+    def records(self) -> Iterator[Tuple[str, str]]:
+        return iter(self.names.items())
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def pointer(ip: str) -> str:
+        """
+        The reverse name of ip, without the trailing dot.
+        """
+        return ipaddress.IPv4Address(ip).reverse_pointer
+
+    @staticmethod
+    def local_data(name: str, ip: str) -> List[str]:
+        """
+        The A and PTR record of name in unbound local-data syntax.
+        """
+        return ['%s. %d IN A %s' % (name, HostRecords.TTL, ip),
+                '%s. %d IN PTR %s.' % (HostRecords.pointer(ip), HostRecords.TTL, name)]
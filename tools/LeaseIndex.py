@@ -0,0 +1,236 @@
+import calendar
+import heapq
+import os
+import time
+from typing import Dict, Optional
+
+
+class Lease:
+    """
+    A single lease as read from a dhcpd lease file, ends is a unix timestamp or None for infinite leases.
+    """
+    __slots__ = ('ip', 'mac', 'hostname', 'starts', 'ends', 'state')
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.mac = None
+        self.hostname = None
+        self.starts = None
+        self.ends = None
+        self.state = None
+
+    def __repr__(self):
+        return 'Lease(%s, %s, %s, %s)' % (self.ip, self.mac, self.hostname, self.state)
+
+
+class LeaseIndex:
+    """
+    Index of the active leases in a dhcpd lease file by ip, mac and hostname.
+    dhcpd only appends to its lease file, so every update reads just the bytes appended since the last one, remembering
+    the byte offset and any incomplete lease block. When dhcpd compacts the file (it writes a new one and renames it over
+    the old one), the new file is read once and whatever it no longer contains is dropped.
+    Can be attached to an event loop like a Daemon, it then polls the file for changes. listeners are called with a
+    dict {ip: Lease or None if gone} of the changes of every update.
+    Without a path, the index is maintained through apply and remove instead, e.g. by the builtin DHCP server.
+    """
+
+    POLL_INTERVAL = 2
+    ACTIVE = 'active'
+
+    def __init__(self, path, name='leases'):
+        self.path = path
+        self.name = name
+        self.listeners = []
+
+        self.ips: Dict[str, Lease] = {}
+        self.macs: Dict[str, Lease] = {}
+        self.hostnames: Dict[str, Lease] = {}
+        self.expiry = []
+
+        self.inode = None
+        self.offset = 0
+        self.partial = b''
+        self.current = None
+        self.depth = 0
+        self.seen = None
+        self.changes = {}
+
+        self.loop = None
+        self.timer = None
+
+    def lookup_ip(self, ip) -> Optional[Lease]:
+        return self.ips.get(ip)
+
+    def lookup_mac(self, mac) -> Optional[Lease]:
+        return self.macs.get(mac.lower())
+
+    def lookup_hostname(self, hostname) -> Optional[Lease]:
+        return self.hostnames.get(hostname.lower())
+
+    def __len__(self):
+        return len(self.ips)
+
+    def update(self):
+        """
+        Read what was appended to the lease file and drop expired leases, see notify for the changes.
+        """
+        if self.path is None:
+            self.expire()
+            return
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # Rewritten by dhcpd, read the new file from its start
+            self.inode = st.st_ino
+            self.offset = 0
+            self.partial = b''
+            self.current = None
+            self.depth = 0
+            self.seen = set()
+
+        if st.st_size > self.offset:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            self.offset += len(data)
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            for line in lines:
+                self._parse(line.decode(errors='replace').strip())
+
+        if self.seen is not None and self.current is None:
+            # Compacted, leases that are not in the new file are gone
+            for ip in [ip for ip in self.ips if ip not in self.seen]:
+                self.remove(ip)
+            self.seen = None
+
+        self.expire()
+
+    def expire(self, now=None):
+        """
+        Drop all leases that ended by now, without looking at the others.
+        """
+        now = time.time() if now is None else now
+        while self.expiry and self.expiry[0][0] <= now:
+            ends, ip = heapq.heappop(self.expiry)
+            lease = self.ips.get(ip)
+            # Entries of leases that were renewed or removed in the meantime are skipped
+            if lease is not None and lease.ends == ends:
+                self.remove(ip)
+
+    def attach(self, loop):
+        self.loop = loop
+        self._poll()
+
+    def detach(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.loop = None
+
+    def check(self):
+        pass
+
+    def status(self) -> dict:
+        return {'leases': len(self.ips), 'bytes read': self.offset}
+
+    def notify(self) -> dict:
+        """
+        Pass the changes since the last notification to all listeners and return them.
+        """
+        changes, self.changes = self.changes, {}
+        if changes:
+            for listener in self.listeners:
+                listener(changes)
+        return changes
+
+    def _poll(self):
+        self.update()
+        self.notify()
+        self.timer = self.loop.call_later(LeaseIndex.POLL_INTERVAL, self._poll)
+
+    def _parse(self, line):
+        if self.current is None:
+            parts = line.split()
+            if len(parts) == 3 and parts[0] == 'lease' and parts[2] == '{':
+                self.current = Lease(parts[1])
+                self.depth = 1
+            return
+
+        if line.endswith('{'):
+            # Nested blocks like "on expiry { ... }"
+            self.depth += 1
+            return
+        if line == '}':
+            self.depth -= 1
+            if self.depth == 0:
+                lease, self.current = self.current, None
+                if self.seen is not None:
+                    self.seen.add(lease.ip)
+                self.apply(lease)
+            return
+        if self.depth > 1:
+            return
+
+        parts = line.rstrip(';').split()
+        if len(parts) < 2:
+            return
+        lease = self.current
+        if parts[0] == 'binding' and parts[1] == 'state':
+            lease.state = parts[2]
+        elif parts[0] == 'hardware':
+            lease.mac = parts[-1].lower()
+        elif parts[0] == 'client-hostname':
+            lease.hostname = line.split('"')[1].lower() if '"' in line else None
+        elif parts[0] in ('starts', 'ends'):
+            setattr(lease, parts[0], LeaseIndex._parse_time(parts[1:]))
+
+    @staticmethod
+    def _parse_time(parts):
+        # Either "never", "epoch <seconds>" or "<weekday> <yyyy/mm/dd> <hh:mm:ss>" in UTC
+        if parts[0] == 'never':
+            return None
+        if parts[0] == 'epoch':
+            return int(parts[1])
+        # Split by hand, strptime would dominate the time of reading a large lease file
+        year, month, day = parts[1].split('/')
+        hour, minute, second = parts[2].split(':')
+        return calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+
+    def apply(self, lease):
+        """
+        Add, update or (if it is not active anymore) remove a lease.
+        """
+        if lease.state != LeaseIndex.ACTIVE or (lease.ends is not None and lease.ends <= time.time()):
+            if lease.ip in self.ips:
+                self.remove(lease.ip)
+            return
+
+        old = self.ips.get(lease.ip)
+        if old is not None:
+            self._unindex(old)
+        self.ips[lease.ip] = lease
+        if lease.mac is not None:
+            self.macs[lease.mac] = lease
+        if lease.hostname:
+            self.hostnames[lease.hostname] = lease
+        if lease.ends is not None:
+            heapq.heappush(self.expiry, (lease.ends, lease.ip))
+        self.changes[lease.ip] = lease
+
+    def remove(self, ip):
+        lease = self.ips.pop(ip, None)
+        if lease is None:
+            return
+        self._unindex(lease)
+        self.changes[ip] = None
+
+    def _unindex(self, lease):
+        # Another lease may have taken over the mac or hostname meanwhile
+        if lease.mac is not None and self.macs.get(lease.mac) is lease:
+            del self.macs[lease.mac]
+        if lease.hostname and self.hostnames.get(lease.hostname) is lease:
+            del self.hostnames[lease.hostname]
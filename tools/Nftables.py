@@ -0,0 +1,89 @@
+import ctypes
+import ctypes.util
+import json
+import subprocess
+import threading
+
+
+class Nftables:
+    """
+    Binding of libnftables through ctypes, to change and query nftables in-process instead of running nft.
+    Use Nftables.load(), which returns None if the library is not installed.
+    """
+
+    OUTPUT_HANDLE = 1 << 3
+    OUTPUT_JSON = 1 << 4
+
+    _instance = None
+    _loaded = False
+    _load_lock = threading.Lock()
+
+    def __init__(self, library):
+        self.library = library
+        lib = ctypes.CDLL(library, use_errno=True)
+        lib.nft_ctx_new.restype = ctypes.c_void_p
+        lib.nft_ctx_new.argtypes = [ctypes.c_uint32]
+        lib.nft_ctx_free.restype = None
+        lib.nft_ctx_free.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_buffer_output.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_buffer_error.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_get_output_buffer.restype = ctypes.c_char_p
+        lib.nft_ctx_get_output_buffer.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_get_error_buffer.restype = ctypes.c_char_p
+        lib.nft_ctx_get_error_buffer.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_output_get_flags.restype = ctypes.c_uint
+        lib.nft_ctx_output_get_flags.argtypes = [ctypes.c_void_p]
+        lib.nft_ctx_output_set_flags.restype = None
+        lib.nft_ctx_output_set_flags.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+        lib.nft_run_cmd_from_buffer.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        self.lib = lib
+
+        self.ctx = lib.nft_ctx_new(0)
+        if not self.ctx:
+            raise OSError('nft_ctx_new failed')
+        if lib.nft_ctx_buffer_output(self.ctx) or lib.nft_ctx_buffer_error(self.ctx):
+            raise OSError('Could not buffer libnftables output')
+        self.flags = lib.nft_ctx_output_get_flags(self.ctx)
+
+        # A context must not be used by several threads at once, but modules are started concurrently
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load():
+        """
+        The shared instance, or None if libnftables is not available.
+        """
+        with Nftables._load_lock:
+            if not Nftables._loaded:
+                Nftables._loaded = True
+                library = ctypes.util.find_library('nftables')
+                if library is not None:
+                    try:
+                        Nftables._instance = Nftables(library)
+                    except (OSError, AttributeError):
+                        Nftables._instance = None
+            return Nftables._instance
+
+    def cmd(self, text, json_output=False):
+        """
+        Run nft commands (anything nft -f accepts) as a single transaction and return (returncode, output, error).
+        """
+        with self.lock:
+            self.lib.nft_ctx_output_set_flags(self.ctx, self.flags | (Nftables.OUTPUT_JSON if json_output else 0))
+            try:
+                returncode = self.lib.nft_run_cmd_from_buffer(self.ctx, text.encode())
+                out = self.lib.nft_ctx_get_output_buffer(self.ctx) or b''
+                err = self.lib.nft_ctx_get_error_buffer(self.ctx) or b''
+            finally:
+                self.lib.nft_ctx_output_set_flags(self.ctx, self.flags)
+        return returncode, out.decode(), err.decode()
+
+    def json(self, text) -> dict:
+        """
+        Run a listing command like "list ruleset" and return its parsed JSON output.
+        Raises subprocess.CalledProcessError like the equivalent nft -j command would.
+        """
+        returncode, out, err = self.cmd(text, json_output=True)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, ['nft', '-j'] + text.split(), output=out, stderr=err)
+        return json.loads(out)
@@ -0,0 +1,233 @@
+import base64
+import hashlib
+import hmac
+import os
+import random
+import socket
+import struct
+import threading
+from typing import List, Optional, Tuple
+
+from tools.LeaseIndex import Lease
+
+
+class OmapiError(Exception):
+    """
+    An OMAPI request failed, or the connection to the server did.
+    """
+    pass
+
+
+class Omapi:
+    """
+    Client for the OMAPI of a running dhcpd, over one persistent TCP connection authenticated with an HMAC-MD5 key.
+    Requests are serialized by a lock, so it can be used from any thread. If the connection breaks (e.g. dhcpd was
+    restarted), it is opened again once per request.
+    """
+
+    PROTOCOL_VERSION = 100
+    HEADER = struct.Struct('!IIIIII')
+    OPEN, REFRESH, UPDATE, NOTIFY, STATUS, DELETE = range(1, 7)
+    ALGORITHM = b'hmac-md5.SIG-ALG.REG.INT.'
+    LEASE_STATES = {1: 'free', 2: 'active', 3: 'expired', 4: 'released', 5: 'abandoned', 6: 'reset', 7: 'backup',
+                    8: 'reserved', 9: 'bootp'}
+    TIMEOUT = 5.0
+
+    def __init__(self, host: str, port: int, key_name: str, secret: str):
+        self.host = host
+        self.port = port
+        self.key_name = key_name
+        self.key = base64.b64decode(secret)
+        self.sock = None
+        self.authid = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def generate_secret() -> str:
+        """
+        A random HMAC-MD5 key, base64 encoded as used by dhcpd.conf.
+        """
+        return base64.b64encode(os.urandom(32)).decode()
+
+    @staticmethod
+    def free_port(host: str = '127.0.0.1') -> int:
+        """
+        A TCP port that is currently free on host.
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind((host, 0))
+            return sock.getsockname()[1]
+
+    @staticmethod
+    def config(key_name: str, secret: str, port: int) -> str:
+        """
+        The dhcpd.conf statements enabling OMAPI on port with the given key.
+        """
+        return 'key %s {\n  algorithm hmac-md5;\n  secret "%s";\n};\nomapi-port %d;\nomapi-key %s;\n' % (
+            key_name, secret, port, key_name)
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def add_host(self, name: str, mac: str, ip: str, hostname: Optional[str] = None):
+        """
+        Create a host declaration with a fixed address, like a host block in dhcpd.conf.
+        """
+        obj = [(b'name', name.encode()),
+               (b'hardware-address', Omapi._pack_mac(mac)),
+               (b'hardware-type', struct.pack('!I', 1)),
+               (b'ip-address', socket.inet_aton(ip))]
+        if hostname:
+            obj.append((b'statements', ('option host-name "%s";' % (hostname,)).encode()))
+        opcode, _, _, message = self.request(Omapi.OPEN, message=[(b'type', b'host'),
+                                                                  (b'create', struct.pack('!I', 1)),
+                                                                  (b'exclusive', struct.pack('!I', 1))], obj=obj)
+        if opcode != Omapi.UPDATE:
+            raise OmapiError('Adding host %s failed: %s' % (name, Omapi._status(message)))
+
+    def remove_host(self, name: str) -> bool:
+        """
+        Delete a host declaration, also one from dhcpd.conf. False if there is no such host.
+        """
+        handle = self._open(b'host', [(b'name', name.encode())])
+        if handle is None:
+            return False
+        opcode, _, _, message = self.request(Omapi.DELETE, handle=handle)
+        if opcode != Omapi.STATUS or Omapi._result(message) not in (None, 0):
+            raise OmapiError('Removing host %s failed: %s' % (name, Omapi._status(message)))
+        return True
+
+    def lookup_lease(self, ip: str = None, mac: str = None) -> Optional[Lease]:
+        """
+        The lease of ip or mac as currently known to dhcpd, None if there is none.
+        """
+        if ip is not None:
+            obj = [(b'ip-address', socket.inet_aton(ip))]
+        else:
+            obj = [(b'hardware-address', Omapi._pack_mac(mac)), (b'hardware-type', struct.pack('!I', 1))]
+        opcode, _, obj, _ = self.request(Omapi.OPEN, message=[(b'type', b'lease')], obj=obj)
+        if opcode != Omapi.UPDATE:
+            return None
+        values = dict(obj)
+        lease = Lease(socket.inet_ntoa(values[b'ip-address']))
+        if b'hardware-address' in values:
+            lease.mac = ':'.join('%02x' % (b,) for b in values[b'hardware-address'])
+        if values.get(b'client-hostname'):
+            lease.hostname = values[b'client-hostname'].decode(errors='replace').lower()
+        for attribute in ('starts', 'ends'):
+            value = values.get(attribute.encode())
+            if value is not None and len(value) == 4:
+                setattr(lease, attribute, struct.unpack('!I', value)[0])
+        if b'state' in values:
+            lease.state = Omapi.LEASE_STATES.get(struct.unpack('!I', values[b'state'])[0])
+        return lease
+
+    def request(self, opcode: int, handle: int = 0, message: List[Tuple[bytes, bytes]] = (),
+                obj: List[Tuple[bytes, bytes]] = ()) -> Tuple[int, int, list, list]:
+        """
+        Send a signed message and wait for the reply to it. Returns its opcode, handle, object and message.
+        Raises OmapiError if the server cannot be reached.
+        """
+        with self.lock:
+            for attempt in (0, 1):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    return self._exchange(opcode, handle, message, obj, self.authid)
+                except (OSError, struct.error) as e:
+                    self._close()
+                    if attempt:
+                        raise OmapiError('OMAPI on %s:%d failed: %s' % (self.host, self.port, e))
+
+    def _open(self, object_type: bytes, obj) -> Optional[int]:
+        opcode, handle, _, _ = self.request(Omapi.OPEN, message=[(b'type', object_type)], obj=obj)
+        return handle if opcode == Omapi.UPDATE and handle else None
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=Omapi.TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(struct.pack('!II', Omapi.PROTOCOL_VERSION, Omapi.HEADER.size))
+        version, header_size = struct.unpack('!II', self._recv(8))
+        if version != Omapi.PROTOCOL_VERSION or header_size != Omapi.HEADER.size:
+            raise OSError('unsupported OMAPI protocol %d' % (version,))
+        # The authenticator is opened unsigned, its handle signs everything after
+        self.authid = 0
+        opcode, handle, _, message = self._exchange(
+            Omapi.OPEN, 0, [(b'type', b'authenticator')],
+            [(b'name', self.key_name.encode()), (b'algorithm', Omapi.ALGORITHM)], 0)
+        if opcode != Omapi.UPDATE:
+            raise OSError('key %s was not accepted: %s' % (self.key_name, Omapi._status(message)))
+        self.authid = handle
+
+    def _close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.authid = 0
+
+    def _exchange(self, opcode, handle, message, obj, authid):
+        tid = random.getrandbits(32)
+        signed = authid != 0
+        body = Omapi._pairs(message) + Omapi._pairs(obj)
+        header = Omapi.HEADER.pack(authid, 16 if signed else 0, opcode, handle, tid, 0)
+        signature = self._sign(header[4:] + body) if signed else b''
+        self.sock.sendall(header + body + signature)
+
+        # Replies to other transactions (e.g. notifications) are skipped
+        while True:
+            header = self._recv(Omapi.HEADER.size)
+            reply_authid, authlen, reply_opcode, reply_handle, _, rid = Omapi.HEADER.unpack(header)
+            reply_message, raw_message = self._recv_pairs()
+            reply_obj, raw_obj = self._recv_pairs()
+            reply_signature = self._recv(authlen)
+            if authlen and not hmac.compare_digest(reply_signature, self._sign(header[4:] + raw_message + raw_obj)):
+                raise OSError('reply with an invalid signature')
+            if rid == tid:
+                return reply_opcode, reply_handle, reply_obj, reply_message
+
+    def _sign(self, data: bytes) -> bytes:
+        return hmac.new(self.key, data, hashlib.md5).digest()
+
+    def _recv(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise OSError('connection closed by dhcpd')
+            data += chunk
+        return data
+
+    def _recv_pairs(self):
+        # Name/value pairs up to an empty name, returned parsed and as received for checking the signature
+        pairs, raw = [], b''
+        while True:
+            length = self._recv(2)
+            raw += length
+            name_length = struct.unpack('!H', length)[0]
+            if name_length == 0:
+                return pairs, raw
+            name = self._recv(name_length)
+            length = self._recv(4)
+            value = self._recv(struct.unpack('!I', length)[0])
+            raw += name + length + value
+            pairs.append((name, value))
+
+    @staticmethod
+    def _pairs(pairs) -> bytes:
+        return b''.join(struct.pack('!H', len(name)) + name + struct.pack('!I', len(value)) + value
+                        for name, value in pairs) + b'\0\0'
+
+    @staticmethod
+    def _pack_mac(mac: str) -> bytes:
+        return bytes(int(part, 16) for part in mac.split(':'))
+
+    @staticmethod
+    def _result(message) -> Optional[int]:
+        value = dict(message).get(b'result')
+        return struct.unpack('!I', value)[0] if value is not None and len(value) == 4 else None
+
+    @staticmethod
+    def _status(message) -> str:
+        text = dict(message).get(b'message')
+        return text.decode(errors='replace') if text else 'result %s' % (Omapi._result(message),)
@@ -0,0 +1,220 @@
+import csv
+import ipaddress
+import json
+import re
+import socket
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from tools.Segment import Segment
+
+
+class Reservations:
+    """
+    Static DHCP reservations (MAC, IP, hostname) read from a host inventory file, validated against the segments.
+    The entries are only kept in the indexes by MAC, IP and hostname, the IPs as ints.
+    """
+
+    MAC = re.compile(r'^[0-9a-f]{12}$')
+    MAC_COLONS = re.compile(r'^[0-9a-f]{2}(:[0-9a-f]{2}){5}$')
+    MAC_SEPARATORS = re.compile(r'[:\-.]')
+    HOSTNAME = re.compile(r'^(?!-)[a-z0-9-]{1,63}(?<!-)(\.(?!-)[a-z0-9-]{1,63}(?<!-))*$')
+    JSON_SEPARATORS = re.compile(r'[\s,\[\]]*')
+    CHUNK = 1 << 16
+
+    def __init__(self, path: str, segments: List[Segment]):
+        self.path = path
+        self.segments = segments
+        self.macs: Dict[str, Tuple[int, Optional[str]]] = {}
+        self.ips: Dict[int, str] = {}
+        self.hostnames: Dict[str, str] = {}
+        # Segments by prefix length and network address, to find the one of an address with a lookup per prefix length,
+        # along with the addresses not to be reserved and the DHCP range as ints
+        self.networks: Dict[int, Dict[int, Tuple[Segment, Tuple[int, int, int], int, int]]] = {}
+        for segment in segments:
+            network = segment.address.network
+            self.networks.setdefault(network.prefixlen, {})[int(network.network_address)] = (
+                segment, (int(network.network_address), int(network.broadcast_address), int(segment.address.ip)),
+                int(segment.range_start), int(segment.range_end))
+
+    @staticmethod
+    def load(path: str, segments: List[Segment]) -> 'Reservations':
+        """
+        Read a CSV (mac,ip[,hostname] with an optional header line) or JSON (an array or a stream of objects with
+        "mac", "ip" and optionally "hostname") inventory. Raises ValueError for invalid, duplicate or conflicting entries
+        and OSError if the file cannot be read.
+        """
+        reservations = Reservations(path, segments)
+        with open(path, newline='') as f:
+            start = f.read(1)
+            while start.isspace():
+                start = f.read(1)
+            f.seek(0)
+            entries = reservations._json(f) if start in ('[', '{') else reservations._csv(f)
+            for line, mac, ip, hostname in entries:
+                try:
+                    reservations.add(mac, ip, hostname)
+                except ValueError as e:
+                    raise ValueError('%s:%d: %s' % (path, line, e))
+        return reservations
+
+    def add(self, mac: str, ip: str, hostname: Optional[str] = None):
+        """
+        Add a reservation, raises ValueError if it is invalid or conflicts with another one.
+        """
+        mac = Reservations.normalize_mac(mac)
+        address = Reservations.parse_ip(ip)
+        hostname = hostname.strip().lower() or None if hostname else None
+        if hostname is not None and not Reservations.HOSTNAME.match(hostname):
+            raise ValueError('invalid hostname "%s"' % (hostname,))
+
+        segment = self._network(address)
+        if segment is None:
+            raise ValueError('%s is not in any local subnet' % (ipaddress.IPv4Address(address),))
+        segment, unavailable, first, last = segment
+        if address in unavailable:
+            raise ValueError('%s is not a host address available in %s' % (ipaddress.IPv4Address(address),
+                                                                            segment.network))
+        if first <= address <= last:
+            raise ValueError('%s is inside the DHCP range %s' % (ipaddress.IPv4Address(address), segment.range))
+
+        if mac in self.macs:
+            raise ValueError('%s is reserved twice' % (mac,))
+        if address in self.ips:
+            raise ValueError('%s is reserved for %s already' % (ipaddress.IPv4Address(address), self.ips[address]))
+        if hostname is not None and hostname in self.hostnames:
+            raise ValueError('hostname %s is used by %s already' % (hostname, self.hostnames[hostname]))
+        self.macs[mac] = (address, hostname)
+        self.ips[address] = mac
+        if hostname is not None:
+            self.hostnames[hostname] = mac
+
+    def remove(self, mac: str) -> bool:
+        """
+        Remove the reservation of mac, False if there is none.
+        """
+        entry = self.macs.pop(Reservations.normalize_mac(mac), None)
+        if entry is None:
+            return False
+        address, hostname = entry
+        del self.ips[address]
+        if hostname is not None:
+            del self.hostnames[hostname]
+        return True
+
+    def lookup_mac(self, mac: str) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        (ip, hostname) reserved for mac (as normalized by normalize_mac), None if there is none.
+        """
+        entry = self.macs.get(mac)
+        if entry is None:
+            return None
+        return socket.inet_ntoa(entry[0].to_bytes(4, 'big')), entry[1]
+
+    def segment(self, address: int) -> Optional[Segment]:
+        """
+        The segment whose subnet contains address (as int), None if there is none.
+        """
+        network = self._network(address)
+        return network[0] if network is not None else None
+
+    def _network(self, address: int):
+        for prefixlen, networks in self.networks.items():
+            network = networks.get(address & (0xffffffff << (32 - prefixlen)) & 0xffffffff)
+            if network is not None:
+                return network
+        return None
+
+    def render(self) -> Iterator[str]:
+        """
+        The reservations as dhcpd host declarations, one string each.
+        """
+        for mac, (address, hostname) in self.macs.items():
+            yield Reservations.host(mac, socket.inet_ntoa(address.to_bytes(4, 'big')), hostname)
+
+    @staticmethod
+    def host(mac: str, ip: str, hostname: Optional[str]) -> str:
+        """
+        A dhcpd host declaration, named after the mac so that it is unique.
+        """
+        option = '  option host-name "%s";\n' % (hostname,) if hostname else ''
+        return 'host %s {\n  hardware ethernet %s;\n  fixed-address %s;\n%s}\n' % (
+            Reservations.host_name(mac), mac, ip, option)
+
+    @staticmethod
+    def host_name(mac: str) -> str:
+        return 'localnet-' + mac.replace(':', '')
+
+    @staticmethod
+    def normalize_mac(mac: str) -> str:
+        """
+        mac in lowercase colon notation, accepting ':', '-' or '.' as separators. Raises ValueError if invalid.
+        """
+        mac = mac.strip().lower()
+        if Reservations.MAC_COLONS.match(mac):
+            return mac
+        digits = Reservations.MAC_SEPARATORS.sub('', mac)
+        if not Reservations.MAC.match(digits):
+            raise ValueError('invalid MAC address "%s"' % (mac,))
+        return '%s:%s:%s:%s:%s:%s' % (digits[0:2], digits[2:4], digits[4:6], digits[6:8], digits[8:10], digits[10:12])
+
+    @staticmethod
+    def parse_ip(ip: str) -> int:
+        """
+        A dotted quad IPv4 address as int, raises ValueError if invalid. Faster than ipaddress for bulk input.
+        """
+        try:
+            return int.from_bytes(socket.inet_pton(socket.AF_INET, ip.strip()), 'big')
+        except OSError:
+            raise ValueError('invalid IPv4 address "%s"' % (ip,))
+
+    def __len__(self):
+        return len(self.macs)
+
+    def _csv(self, f) -> Iterator[Tuple[int, str, str, Optional[str]]]:
+        columns = None
+        reader = csv.reader(f)
+        for row in reader:
+            if not row or not ''.join(row).strip() or row[0].lstrip().startswith('#'):
+                continue
+            if columns is None:
+                # The first line is either a header naming the columns or already an entry in the default order
+                names = [name.strip().lower() for name in row]
+                if 'mac' in names and 'ip' in names:
+                    columns = (names.index('mac'), names.index('ip'),
+                               names.index('hostname') if 'hostname' in names else None)
+                    continue
+                columns = (0, 1, 2)
+            mac, ip, hostname = columns
+            if len(row) <= max(mac, ip):
+                raise ValueError('%s:%d: expected mac,ip[,hostname]' % (self.path, reader.line_num))
+            yield (reader.line_num, row[mac], row[ip],
+                   row[hostname] if hostname is not None and hostname < len(row) else None)
+
+    def _json(self, f) -> Iterator[Tuple[int, str, str, Optional[str]]]:
+        # Decode one object at a time from a buffer of a few chunks, the file is never read as a whole. Entries are
+        # identified by the line they start on, lines counts those before the buffer.
+        decoder = json.JSONDecoder()
+        buffer, position, eof, lines = '', 0, False, 0
+        while True:
+            position = Reservations.JSON_SEPARATORS.match(buffer, position).end()
+            line = lines + buffer.count('\n', 0, position) + 1
+            try:
+                if position == len(buffer):
+                    raise ValueError('end of buffer')
+                entry, position = decoder.raw_decode(buffer, position)
+            except ValueError as e:
+                # Incomplete at the end of the buffer, read on unless there is nothing left
+                if eof:
+                    if position == len(buffer):
+                        return
+                    raise ValueError('%s:%d: %s' % (self.path, line, e))
+                chunk = f.read(Reservations.CHUNK)
+                eof = not chunk
+                lines += buffer.count('\n', 0, position)
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            if not isinstance(entry, dict) or not isinstance(entry.get('mac'), str) \
+                    or not isinstance(entry.get('ip'), str):
+                raise ValueError('%s:%d: expected an object with "mac" and "ip"' % (self.path, line))
+            hostname = entry.get('hostname')
+            yield line, entry['mac'], entry['ip'], hostname if isinstance(hostname, str) else None
@@ -0,0 +1,122 @@
+import argparse
+import ipaddress
+import os
+import re
+from typing import List
+
+
+class Segment:
+    """
+    A local network segment: an interface (or 802.1q subinterface like eth0.10) with this computers static ip, the
+    subnet and the DHCP range served on it.
+    """
+
+    VLAN = re.compile(r'^(?P<parent>.+)\.(?P<id>\d+)$')
+
+    def __init__(self, interface: str, ip: str, prefixlen: int, range_start: str = None, range_end: str = None):
+        """
+        Create a segment, the DHCP range defaults to the .100 - .200 host addresses of the subnet.
+        Raises ValueError if the addresses do not fit together.
+        """
+        self.interface = interface
+        self.address = ipaddress.IPv4Interface('%s/%d' % (ip, int(prefixlen)))
+        network = self.address.network
+        if network.num_addresses < 4:
+            raise ValueError('Subnet %s of %s is too small' % (network, interface))
+
+        if range_start is None:
+            last = network.broadcast_address - 1
+            range_start = min(network.network_address + 100, last)
+            range_end = min(network.network_address + 200, last)
+        self.range_start = ipaddress.IPv4Address(range_start)
+        self.range_end = ipaddress.IPv4Address(range_end or range_start)
+
+        for address in (self.range_start, self.range_end):
+            if address not in network or address in (network.network_address, network.broadcast_address):
+                raise ValueError('DHCP range address %s is not a host address in %s' % (address, network))
+        if self.range_start > self.range_end:
+            raise ValueError('DHCP range %s is empty' % (self.range,))
+        if self.range_start <= self.address.ip <= self.range_end:
+            raise ValueError('%s is inside the DHCP range %s' % (self.ip, self.range))
+
+    @staticmethod
+    def parse(spec: str) -> 'Segment':
+        """
+        Parse a segment given on the cmdline as INTERFACE:IP/BITS[:FIRST-LAST], for use as argparse type.
+        """
+        parts = spec.split(':')
+        if len(parts) not in (2, 3) or '/' not in parts[1]:
+            raise argparse.ArgumentTypeError('Segment "%s" is not of the form INTERFACE:IP/BITS[:FIRST-LAST]' % (spec,))
+        ip, prefixlen = parts[1].split('/', 1)
+        first, last = parts[2].split('-', 1) if len(parts) == 3 else (None, None)
+        try:
+            return Segment(parts[0], ip, int(prefixlen), first, last)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError('Segment "%s": %s' % (spec, e))
+
+    @property
+    def ip(self) -> str:
+        return str(self.address.ip)
+
+    @property
+    def prefixlen(self) -> int:
+        return self.address.network.prefixlen
+
+    @property
+    def network(self) -> str:
+        return str(self.address.network)
+
+    @property
+    def subnet0(self) -> str:
+        return str(self.address.network.network_address)
+
+    @property
+    def netmask(self) -> str:
+        return str(self.address.network.netmask)
+
+    @property
+    def broadcast(self) -> str:
+        return str(self.address.network.broadcast_address)
+
+    @property
+    def range(self) -> str:
+        return '%s %s' % (self.range_start, self.range_end)
+
+    @property
+    def spec(self) -> str:
+        """
+        The segment in the form parsed by Segment.parse.
+        """
+        return '%s:%s:%s-%s' % (self.interface, self.address, self.range_start, self.range_end)
+
+    @property
+    def vlan(self):
+        """
+        (parent interface, vlan id) if the interface is named like an 802.1q subinterface, else None.
+        """
+        match = Segment.VLAN.match(self.interface)
+        if match is None:
+            return None
+        return match.group('parent'), int(match.group('id'))
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join('/sys/class/net', self.interface))
+
+    def __repr__(self):
+        return 'Segment(%s, %s, %s)' % (self.interface, self.address, self.range)
+
+
+def segments(args) -> List[Segment]:
+    """
+    Collect all segments from cmdline arguments: the one given by local_interface, --ip, --subnet and --iprange,
+    followed by all given with --segment. Raises ValueError if they overlap.
+    """
+    result = [Segment(args.local_interface, args.ip, args.subnet, *args.iprange.split())] + list(args.segment or [])
+
+    for i, segment in enumerate(result):
+        for other in result[:i]:
+            if segment.interface == other.interface:
+                raise ValueError('Interface %s is used by more than one segment' % (segment.interface,))
+            if segment.address.network.overlaps(other.address.network):
+                raise ValueError('Subnets %s and %s overlap' % (segment.network, other.network))
+    return result
@@ -0,0 +1,58 @@
+import asyncio
+import signal
+
+from tools import ColorPrint
+
+
+class Supervisor:
+    """
+    Event loop watching the services of all running modules.
+    It sleeps until a service produces output, a child exits or a signal arrives, so it uses no CPU while idle.
+    """
+
+    def __init__(self):
+        self.c = ColorPrint(name='SUPERVISOR')
+        self.loop = asyncio.new_event_loop()
+        self.services = []
+
+    def watch(self, module):
+        """
+        Attach all services of a started module to the event loop.
+        """
+        for service in module.services():
+            service.attach(self.loop)
+            self.services.append(service)
+
+    def run(self, on_status=None, on_reload=None):
+        """
+        Run until SIGINT or SIGTERM is received. on_status is called on SIGUSR1, on_reload on SIGHUP in a worker
+        thread, so that slow reloads do not hold up the services.
+        All services are detached again before returning, they keep running until their module is stopped.
+        """
+        handled = [signal.SIGINT, signal.SIGTERM, signal.SIGCHLD]
+        self.loop.add_signal_handler(signal.SIGINT, self.loop.stop)
+        self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+        self.loop.add_signal_handler(signal.SIGCHLD, self._reap)
+        if on_status is not None:
+            self.loop.add_signal_handler(signal.SIGUSR1, on_status)
+            handled.append(signal.SIGUSR1)
+        if on_reload is not None:
+            self.loop.add_signal_handler(signal.SIGHUP, self.loop.run_in_executor, None, on_reload)
+            handled.append(signal.SIGHUP)
+
+        try:
+            self.loop.run_forever()
+        finally:
+            for sig in handled:
+                self.loop.remove_signal_handler(sig)
+            for service in self.services:
+                service.detach()
+            self.services = []
+
+    def close(self):
+        self.loop.close()
+
+    def _reap(self):
+        # Only needed for services without a pidfd, those with one are woken up by the loop directly.
+        for service in self.services:
+            service.check()
@@ -0,0 +1,95 @@
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    Records timed spans of module phases and external commands and writes them as Chrome trace-event JSON, which can be
+    opened in chrome://tracing or Perfetto. Nothing is recorded unless enabled with a file to write to.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def enable(self, path):
+        """
+        Start recording, the trace is written to path when the program exits.
+        """
+        self.path = path
+        atexit.register(self.write)
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """
+        Record the wall and CPU time of the with block as a complete event. The yielded dict holds the args of the
+        event, the block can add to it (e.g. the returncode of a command).
+        """
+        if not self.enabled:
+            yield args
+            return
+
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield args
+        except BaseException as e:
+            args.setdefault('error', repr(e))
+            raise
+        finally:
+            end = time.perf_counter()
+            args['cpu_ms'] = round((time.thread_time() - cpu) * 1e3, 3)
+            args['wall_ms'] = round((end - start) * 1e3, 3)
+            self._add({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'args': args,
+            })
+
+    def instant(self, name, category, **args):
+        """
+        Record a single point in time, e.g. a daemon exiting.
+        """
+        if self.enabled:
+            self._add({
+                'name': name,
+                'cat': category,
+                'ph': 'i',
+                's': 't',
+                'ts': (time.perf_counter() - self.origin) * 1e6,
+                'args': args,
+            })
+
+    def write(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            events = list(self.events)
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread}}
+                        for (pid, tid), thread in self.threads.items()]
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+
+    def _add(self, event):
+        event['pid'] = os.getpid()
+        event['tid'] = threading.get_native_id()
+        with self.lock:
+            self.threads[(event['pid'], event['tid'])] = threading.current_thread().name
+            self.events.append(event)
+
+
+tracer = Tracer()
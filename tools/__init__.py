@@ -1,6 +1,28 @@
 from .ColorPrint import ColorPrint
-from .ThreadOutput import ThreadOutput
+from .Daemon import Daemon
+from .LeaseIndex import Lease, LeaseIndex
+from .DhcpServer import AddressPool, DhcpServer
+from .DBus import DBus, DBusError
+from .DnsForwarder import DnsCache, DnsForwarder
+from .Firewalld import Firewalld
+from .HostRecords import HostRecords
+from .Nftables import Nftables
+from .Omapi import Omapi, OmapiError
+from .Reservations import Reservations
+from .Segment import Segment, segments
+from .Supervisor import Supervisor
+from .Tracer import Tracer, tracer
 from .UserInput import ask, choose
+from .benchmark import format_latencies, percentiles
+from .conntrack import read_conntrack
+from .dhcpload import dhcp_load
+from .dnsload import dns_load, dns_stub, dns_warmup
 from .interactive import interactive
+from .lifecycle import start_modules, stop_modules
 from .locate import locate
 from .mysubprocess import mysubprocess
+from .plan import PLAN_VERSION, compile_plan, save_plan
+from .probe import probe
+from .sysctl import read_sysctl, recover_sysctl, restore_sysctl, write_sysctl
+from .unbound_cache import age_cache_dump
+from .unbound_profile import PROFILES as UNBOUND_PROFILES, host_resources, unbound_profile
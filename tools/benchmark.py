@@ -0,0 +1,23 @@
+import math
+from typing import Dict, Iterable, List
+
+
+def percentiles(values: List[float], points: Iterable[float]) -> Dict[float, float]:
+    """
+    Nearest-rank percentiles of values, e.g. points (50, 99, 99.9). Missing if there are no values.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {point: ordered[max(math.ceil(point / 100 * len(ordered)), 1) - 1] for point in points}
+
+
+def format_latencies(values: List[float], points: Iterable[float] = (50, 90, 99, 99.9)) -> str:
+    """
+    Format latencies given in seconds as "p50 1.2ms, p90 ..., max ...".
+    """
+    if not values:
+        return 'no samples'
+    result = ['p%g %.2fms' % (point, value * 1e3) for point, value in percentiles(values, points).items()]
+    result.append('max %.2fms' % (max(values) * 1e3,))
+    return ', '.join(result)
@@ -0,0 +1,28 @@
+import os
+import subprocess
+from typing import List
+
+from tools.locate import locate
+
+PROC_FILE = '/proc/net/nf_conntrack'
+
+
+def read_conntrack(runner) -> List[str]:
+    """
+    Read the whole conntrack table at once, one line per flow, from /proc/net/nf_conntrack or, if the kernel does not
+    provide it, from conntrack -L. Lines read from /proc start with the address family, e.g.
+    "ipv4     2 tcp      6 431999 ESTABLISHED src=10.10.10.100 dst=... [OFFLOAD] mark=0 use=2".
+    Raises OSError if neither is available.
+    """
+    if os.path.exists(PROC_FILE):
+        with open(PROC_FILE) as f:
+            return f.read().splitlines()
+
+    binary = locate('conntrack')
+    if binary is None:
+        raise OSError('Neither %s nor conntrack is available' % (PROC_FILE,))
+    # Not logged, this is read periodically for status
+    returncode, out, err = runner.communicate([binary, '-L', '-f', 'ipv4'])
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, [binary, '-L', '-f', 'ipv4'], output=out, stderr=err)
+    return ['ipv4     2 ' + line for line in out.splitlines()]
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import socket
+import struct
+import time
+
+from tools.DhcpServer import DhcpServer
+
+
+class _Swarm:
+    """
+    A socket on the DHCP client port shared by all simulated clients, replies are handed to the client waiting for
+    their transaction id.
+    """
+
+    def __init__(self, loop, interface):
+        self.loop = loop
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        self.sock.bind(('', DhcpServer.CLIENT_PORT))
+        self.sock.setblocking(False)
+        self.waiting = {}
+        loop.add_reader(self.sock, self._on_readable)
+
+    def close(self):
+        self.loop.remove_reader(self.sock)
+        self.sock.close()
+
+    async def exchange(self, packet, xid, timeout):
+        """
+        Broadcast packet and wait for the reply to xid, None on timeout.
+        """
+        future = self.loop.create_future()
+        self.waiting[xid] = future
+        try:
+            self.sock.sendto(packet, ('255.255.255.255', DhcpServer.SERVER_PORT))
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.waiting.pop(xid, None)
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            if len(data) < DhcpServer.HEADER.size:
+                continue
+            future = self.waiting.get(data[4:8])
+            if future is not None and not future.done():
+                future.set_result(data)
+
+
+def _request(mac, xid, message_type, options=b'') -> bytes:
+    # Broadcast flag set, the simulated clients have no address to receive unicasts on
+    header = DhcpServer.HEADER.pack(DhcpServer.BOOTREQUEST, 1, 6, 0, xid, 0, 0x8000, b'\0' * 4, b'\0' * 4, b'\0' * 4,
+                                    b'\0' * 4, mac + b'\0' * 10, b'\0' * 64, b'\0' * 128, DhcpServer.MAGIC)
+    return header + bytes([DhcpServer.OPTION_MESSAGE_TYPE, 1, message_type]) + options + \
+        bytes([DhcpServer.OPTION_END])
+
+
+def _reply(data):
+    options = DhcpServer.parse_options(data[DhcpServer.HEADER.size:])
+    return options.get(DhcpServer.OPTION_MESSAGE_TYPE, b'\0')[0], data[16:20], options
+
+
+async def _client(swarm, index, base, timeout, retries, results):
+    mac = struct.pack('!HI', 0x0200 | (base >> 32 & 0xff), (base + index) & 0xffffffff)
+    xid = struct.pack('!I', (base + index) & 0xffffffff)
+    hostname = b'bench%d' % (index,)
+    started = time.perf_counter()
+
+    for _ in range(retries + 1):
+        offer = await swarm.exchange(_request(mac, xid, DhcpServer.DISCOVER,
+                                              bytes([DhcpServer.OPTION_HOSTNAME, len(hostname)]) + hostname),
+                                     xid, timeout)
+        if offer is not None and _reply(offer)[0] == DhcpServer.OFFER:
+            break
+    else:
+        results['failed'] += 1
+        return
+    offered = time.perf_counter()
+    _, yiaddr, options = _reply(offer)
+    request = _request(mac, xid, DhcpServer.REQUEST,
+                       bytes([DhcpServer.OPTION_REQUESTED_IP, 4]) + yiaddr +
+                       bytes([DhcpServer.OPTION_SERVER_ID, 4]) + options.get(DhcpServer.OPTION_SERVER_ID, b'\0' * 4) +
+                       bytes([DhcpServer.OPTION_HOSTNAME, len(hostname)]) + hostname)
+
+    for _ in range(retries + 1):
+        ack = await swarm.exchange(request, xid, timeout)
+        if ack is None:
+            continue
+        if _reply(ack)[0] == DhcpServer.ACK:
+            results['latencies'].append(time.perf_counter() - started)
+            results['offer_latencies'].append(offered - started)
+            return
+        if _reply(ack)[0] == DhcpServer.NAK:
+            results['naks'] += 1
+            return
+    results['failed'] += 1
+
+
+async def dhcp_load(interface, clients, concurrency, timeout=2.0, retries=2, warmup=10.0) -> dict:
+    """
+    Simulate clients DHCP clients with distinct macs on interface, at most concurrency of them at once, each running
+    DISCOVER/OFFER/REQUEST/ACK. Waits up to warmup seconds for the server to answer at all before starting the clock.
+    Returns the number of leases, NAKs and failures, the elapsed time and the latencies in seconds.
+    """
+    loop = asyncio.get_running_loop()
+    swarm = _Swarm(loop, interface)
+    # Random macs and transaction ids, so runs against a server keeping its leases do not renew old ones
+    base = int.from_bytes(os.urandom(5), 'big')
+    results = {'clients': clients, 'naks': 0, 'failed': 0, 'latencies': [], 'offer_latencies': []}
+    try:
+        deadline = time.monotonic() + warmup
+        while True:
+            warm = {'naks': 0, 'failed': 0, 'latencies': [], 'offer_latencies': []}
+            await _client(swarm, clients, base, min(timeout, 1.0), 0, warm)
+            if warm['latencies'] or time.monotonic() > deadline:
+                break
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(index):
+            async with semaphore:
+                await _client(swarm, index, base, timeout, retries, results)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(index) for index in range(clients)))
+        results['elapsed'] = time.perf_counter() - started
+    finally:
+        swarm.close()
+    results['leased'] = len(results['latencies'])
+    return results
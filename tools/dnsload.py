@@ -0,0 +1,267 @@
+import asyncio
+import random
+import signal
+import socket
+import struct
+import time
+from typing import Dict, List, Optional
+
+from tools.DnsForwarder import DnsForwarder
+
+RCODES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED'}
+READY_NAME = 'localnet-bench-ready.invalid'
+
+
+def _query(name: str, query_id: int, qtype: int = 1) -> bytes:
+    labels = b''.join(bytes([len(label)]) + label.encode() for label in name.strip('.').split('.')) + b'\0'
+    return DnsForwarder.HEADER.pack(query_id, DnsForwarder.RD, 1, 0, 0, 0) + labels + struct.pack('!HH', qtype, 1)
+
+
+def _skip_name(data: bytes, offset: int) -> int:
+    while data[offset]:
+        if data[offset] & 0xc0 == 0xc0:
+            return offset + 2
+        offset += 1 + data[offset]
+    return offset + 1
+
+
+def _address(answer: bytes) -> Optional[bytes]:
+    """
+    The address of the first A record in the answer section, None if there is none.
+    """
+    try:
+        count = struct.unpack_from('!H', answer, 6)[0]
+        offset = _skip_name(answer, DnsForwarder.HEADER.size) + 4
+        for _ in range(count):
+            offset = _skip_name(answer, offset)
+            rtype, _, _, length = struct.unpack_from('!HHIH', answer, offset)
+            offset += 10
+            if rtype == DnsForwarder.TYPE_A and length == 4:
+                return answer[offset:offset + 4]
+            offset += length
+    except (IndexError, struct.error):
+        pass
+    return None
+
+
+class _Resolver:
+    """
+    A UDP socket to the server shared by all queries, answers are handed to the query waiting for their id.
+    """
+
+    def __init__(self, loop, server, port):
+        self.loop = loop
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        self.sock.connect((server, port))
+        self.sock.setblocking(False)
+        self.waiting: Dict[int, asyncio.Future] = {}
+        loop.add_reader(self.sock, self._on_readable)
+
+    def close(self):
+        self.loop.remove_reader(self.sock)
+        self.sock.close()
+
+    async def resolve(self, name: str, timeout: float, qtype: int = 1) -> Optional[bytes]:
+        """
+        Query the record of type qtype (A by default) of name, the answer or None on timeout.
+        """
+        query_id = random.getrandbits(16)
+        while query_id in self.waiting:
+            query_id = random.getrandbits(16)
+        future = self.loop.create_future()
+        self.waiting[query_id] = future
+        try:
+            self.sock.send(_query(name, query_id, qtype))
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.waiting.pop(query_id, None)
+
+    async def wait_ready(self, timeout: float):
+        """
+        Wait for the server to answer at all, e.g. while it is starting, asking for a name that is not replayed.
+        Raises OSError if it does not within timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while await self.resolve(READY_NAME, 0.2) is None:
+            if time.monotonic() > deadline:
+                raise OSError('%s does not answer' % (self.sock.getpeername()[0],))
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self.sock.recv(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # e.g. ICMP port unreachable while the server is starting
+                continue
+            if len(data) < DnsForwarder.HEADER.size:
+                continue
+            future = self.waiting.get(struct.unpack_from('!H', data)[0])
+            if future is not None and not future.done():
+                future.set_result(data)
+
+
+async def dns_load(server: str, names: List[str], queries: int, qps: float, concurrency: int, timeout: float,
+                   port: int = DnsForwarder.PORT, ready_timeout: float = 10.0) -> dict:
+    """
+    Query the A records of names in turn, queries in total, at qps queries per second (open loop, regardless of how many
+    are outstanding) or, if qps is 0, as fast as concurrency outstanding queries allow. Waits up to ready_timeout for the
+    server to answer at all. The upstream (dns_stub) answers every query it gets with a new address, so an answer with
+    an address not seen before was fetched upstream and counts as cache miss, all others as cache hits.
+    """
+    loop = asyncio.get_running_loop()
+    resolver = _Resolver(loop, server, port)
+    try:
+        await resolver.wait_ready(ready_timeout)
+        seen = set()
+        hits, misses, other = [], [], []
+        rcodes: Dict[str, int] = {}
+        timeouts = 0
+
+        async def one(index):
+            nonlocal timeouts
+            name = names[index % len(names)]
+            sent = time.perf_counter()
+            answer = await resolver.resolve(name, timeout)
+            if answer is None:
+                timeouts += 1
+                return
+            address = _address(answer)
+            if address is None:
+                other.append(time.perf_counter() - sent)
+            elif address in seen:
+                hits.append(time.perf_counter() - sent)
+            else:
+                seen.add(address)
+                misses.append(time.perf_counter() - sent)
+            rcode = RCODES.get(answer[3] & DnsForwarder.RCODE, str(answer[3] & DnsForwarder.RCODE))
+            rcodes[rcode] = rcodes.get(rcode, 0) + 1
+
+        start = time.perf_counter()
+        if qps:
+            # Sent on schedule, all queries due are sent at once, as sleeping is not precise enough for each
+            tasks = []
+            while len(tasks) < queries:
+                due = min(int((time.perf_counter() - start) * qps) + 1, queries)
+                while len(tasks) < due:
+                    tasks.append(loop.create_task(one(len(tasks))))
+                await asyncio.sleep(max(start + len(tasks) / qps - time.perf_counter(), 0))
+            await asyncio.gather(*tasks)
+        else:
+            counter = iter(range(queries))
+
+            async def worker():
+                for index in counter:
+                    await one(index)
+
+            await asyncio.gather(*(worker() for _ in range(min(concurrency, queries))))
+        elapsed = time.perf_counter() - start
+    finally:
+        resolver.close()
+
+    return {
+        'queries': queries,
+        'answered': len(hits) + len(misses) + len(other),
+        'timeouts': timeouts,
+        'rcodes': rcodes,
+        'elapsed': elapsed,
+        'target_qps': qps,
+        'hit_latencies': hits,
+        'miss_latencies': misses,
+    }
+
+
+async def dns_warmup(server: str, names: List[str], concurrency: int = 32, timeout: float = 2.0,
+                     port: int = DnsForwarder.PORT, ready_timeout: float = 10.0) -> int:
+    """
+    Resolve the A and AAAA records of names once, so that they are cached by the server. Returns how many names were
+    answered.
+    """
+    loop = asyncio.get_running_loop()
+    resolver = _Resolver(loop, server, port)
+    answered = 0
+    try:
+        await resolver.wait_ready(ready_timeout)
+        pending = iter(names)
+
+        async def worker():
+            nonlocal answered
+            for name in pending:
+                answers = await asyncio.gather(resolver.resolve(name, timeout, DnsForwarder.TYPE_A),
+                                               resolver.resolve(name, timeout, DnsForwarder.TYPE_AAAA))
+                if any(answer is not None for answer in answers):
+                    answered += 1
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(names)))))
+    finally:
+        resolver.close()
+    return answered
+
+
+class _Stub(asyncio.DatagramProtocol):
+    """
+    Authoritative for every name: A queries are answered with an address in 198.18.0.0/15 that is new for every query
+    (until 2^17 queries wrap around), so clients can tell answers fetched from here from cached ones. Other types are
+    answered with no data and an SOA for negative caching.
+    """
+
+    def __init__(self, delay: float, ttl: int):
+        self.delay = delay
+        self.ttl = ttl
+        self.transport = None
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        try:
+            answer = self.answer(data, self.queries)
+        except (ValueError, IndexError, struct.error):
+            return
+        self.queries += 1
+        if self.delay:
+            asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, answer, address)
+        else:
+            self.transport.sendto(answer, address)
+
+    def answer(self, query: bytes, serial: int) -> bytes:
+        query_id, flags = struct.unpack_from('!HH', query)
+        offset = 12
+        while query[offset]:
+            offset += 1 + query[offset]
+        qtype = struct.unpack_from('!H', query, offset + 1)[0]
+        question = query[12:offset + 5]
+        flags = DnsForwarder.QR | DnsForwarder.AA | (flags & DnsForwarder.RD)
+        if qtype == DnsForwarder.TYPE_A:
+            address = 0xc6120000 | serial & 0x1ffff
+            record = struct.pack('!HHHIHI', 0xc00c, DnsForwarder.TYPE_A, 1, self.ttl, 4, address)
+            return DnsForwarder.HEADER.pack(query_id, flags, 1, 1, 0, 0) + question + record
+        # Names compressed to the question, MNAME and RNAME under it
+        rdata = b'\x02ns\xc0\x0c\x0ahostmaster\xc0\x0c' + struct.pack('!IIIII', 1, 3600, 600, 86400, self.ttl)
+        record = struct.pack('!HHHIH', 0xc00c, DnsForwarder.TYPE_SOA, 1, self.ttl, len(rdata)) + rdata
+        return DnsForwarder.HEADER.pack(query_id, flags, 1, 0, 1, 0) + question + record
+
+
+def dns_stub(host: str = '127.0.0.1', delay: float = 0.0, ttl: int = 3600):
+    """
+    Serve as stub authoritative upstream on a free UDP port of host until SIGTERM or SIGINT. The port is printed as
+    first line to stdout, the number of queries answered as second line on exit.
+    """
+    loop = asyncio.new_event_loop()
+    stub = _Stub(delay, ttl)
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(lambda: stub, local_addr=(host, 0)))
+    transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    print(transport.get_extra_info('sockname')[1], flush=True)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        transport.close()
+        loop.close()
+    print(stub.queries, flush=True)
@@ -0,0 +1,91 @@
+import sys
+from typing import Dict
+
+from tools.DBus import DBus, DBusError
+from tools.Firewalld import Firewalld
+
+
+class FirewalldMock:
+    """
+    Fake runtime zone settings of firewalld, answering the zone methods the FIREWALL module calls with the same errors
+    firewalld gives, e.g. ALREADY_ENABLED for enabling forwarding twice.
+    """
+
+    ERROR = Firewalld.BUS_NAME + '.Exception'
+
+    def __init__(self, zones: Dict[str, str]):
+        # Interfaces mapped to their zone
+        self.zones = dict(zones)
+        self.forward = set()
+        self.services = {}
+
+    def call(self, path, interface, member, args):
+        """
+        Handle a method call, as handler of DBus.serve. Every call is printed to stdout.
+        """
+        print('%s(%s)' % (member, ', '.join(map(str, args))), flush=True)
+        if path != Firewalld.PATH or interface != Firewalld.ZONE or not hasattr(self, member):
+            raise DBusError('org.freedesktop.DBus.Error.UnknownMethod', 'No such method %s.%s' % (interface, member))
+        return getattr(self, member)(*args)
+
+    def _fail(self, code, detail):
+        raise DBusError(FirewalldMock.ERROR, '%s: %s' % (code, detail))
+
+    def getZoneOfInterface(self, interface):
+        return 's', (self.zones.get(interface, ''),)
+
+    def queryForward(self, zone):
+        return 'b', (zone in self.forward,)
+
+    def queryService(self, zone, service):
+        return 'b', (service in self.services.get(zone, set()),)
+
+    def addForward(self, zone, timeout):
+        if zone in self.forward:
+            self._fail('ALREADY_ENABLED', 'forward')
+        self.forward.add(zone)
+        return 's', (zone,)
+
+    def removeForward(self, zone):
+        if zone not in self.forward:
+            self._fail('NOT_ENABLED', 'forward')
+        self.forward.discard(zone)
+        return 's', (zone,)
+
+    def addService(self, zone, service, timeout):
+        if service in self.services.get(zone, set()):
+            self._fail('ALREADY_ENABLED', service)
+        self.services.setdefault(zone, set()).add(service)
+        return 's', (zone,)
+
+    def removeService(self, zone, service):
+        if service not in self.services.get(zone, set()):
+            self._fail('NOT_ENABLED', service)
+        self.services[zone].discard(service)
+        return 's', (zone,)
+
+    def addInterface(self, zone, interface):
+        if self.zones.get(interface) == zone:
+            self._fail('ZONE_ALREADY_SET', '%s in %s' % (interface, zone))
+        if interface in self.zones:
+            self._fail('ZONE_CONFLICT', '%s in %s' % (interface, self.zones[interface]))
+        self.zones[interface] = zone
+        return 's', (zone,)
+
+    def removeInterface(self, zone, interface):
+        if self.zones.get(interface) != zone:
+            self._fail('UNKNOWN_INTERFACE', interface)
+        del self.zones[interface]
+        return 's', (zone,)
+
+
+def firewalld_mock(address: str, zones: Dict[str, str]):
+    """
+    Serve a FirewalldMock with the interfaces in zones {interface: zone} on the bus at address, until the bus exits.
+    """
+    DBus(address).serve(Firewalld.BUS_NAME, FirewalldMock(zones).call)
+
+
+if __name__ == '__main__':
+    # python3 -m tools.firewalld_mock ADDRESS [INTERFACE=ZONE ...]
+    firewalld_mock(sys.argv[1], dict(item.split('=', 1) for item in sys.argv[2:]))
@@ -4,13 +4,15 @@ from modules.FIREWALL import FIREWALL
 
 
 def interactive(args):
-    firewalls_detected = FIREWALL.find_available()
+    # A firewall type given on the command line is kept, e.g. nftables, which is never detected
+    firewalls_detected = FIREWALL.find_available() if args.firewall_type is None else []
     if len(firewalls_detected) == 1:
-        args.firewall_type = firewalls_detected[0]
-    else:
-        args.firewall_type = tools.choose('Multiple firewalls found', 'Select the one actively used',
-                                          {k: v for k, v in FIREWALL.SUPPORTED.items() if k in firewalls_detected},
-                                          '', False)
+        args.firewall_type = FIREWALL.preferred(firewalls_detected[0], args.firewall_dbus)
+    elif len(firewalls_detected) > 1:
+        args.firewall_type = FIREWALL.preferred(
+            tools.choose('Multiple firewalls found', 'Select the one actively used',
+                         {k: v for k, v in FIREWALL.SUPPORTED.items() if k in firewalls_detected}, '', False),
+            args.firewall_dbus)
 
     adapters = ifaddr.get_adapters(include_unconfigured=True)
 
@@ -0,0 +1,108 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List
+
+from tools import ColorPrint
+from tools.Tracer import tracer
+
+c = ColorPrint(name='LOCALNET')
+
+
+def _name(module) -> str:
+    return module.name
+
+
+def _dependencies(modules) -> Dict[object, List[object]]:
+    """
+    Map every module to the modules it depends on. Dependencies on modules that are not part of the list are ignored.
+    """
+    by_name = {_name(module): module for module in modules}
+    return {module: [by_name[name] for name in module.DEPENDS if name in by_name] for module in modules}
+
+
+def _dependents(modules) -> Dict[object, List[object]]:
+    """
+    Map every module to the modules depending on it, this is the order for tearing down.
+    """
+    dependencies = _dependencies(modules)
+    return {module: [other for other in modules if module in dependencies[other]] for module in modules}
+
+
+def _traced(module, action: str):
+    with tracer.span('%s.%s' % (_name(module), action), 'module'):
+        getattr(module, action)()
+
+
+def _run(modules, after, action: str, abort_on_error: bool):
+    """
+    Call action on all modules in a thread pool, every module as soon as all modules in after[module] are done.
+    Returns the list of modules that succeeded and a list of (module, exception) that failed. If abort_on_error is set,
+    nothing new is scheduled after the first failure, otherwise failed modules count as done.
+    """
+    succeeded = []
+    failed = []
+    finished = set()
+    remaining = list(modules)
+    futures = {}
+
+    with ThreadPoolExecutor(max_workers=max(len(modules), 1)) as pool:
+        while True:
+            if not (failed and abort_on_error):
+                for module in list(remaining):
+                    if all(other in finished for other in after[module]):
+                        remaining.remove(module)
+                        futures[pool.submit(_traced, module, action)] = module
+
+            if not futures:
+                break
+
+            try:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            except KeyboardInterrupt as e:
+                # Let everything in flight finish, so it can be rolled back. Teardown is not interruptible.
+                if abort_on_error:
+                    failed.append((None, e))
+                continue
+
+            for future in done:
+                module = futures.pop(future)
+                finished.add(module)
+                exception = future.exception()
+                if exception is None:
+                    succeeded.append(module)
+                else:
+                    failed.append((module, exception))
+
+    if remaining and not failed:
+        raise RuntimeError('Circular module dependencies between %s' % (', '.join(map(_name, remaining)),))
+
+    return succeeded, failed
+
+
+def start_modules(modules):
+    """
+    Start modules concurrently, every module only after all modules it DEPENDS on are started.
+    If a module fails, everything that was started (including the partially started module) is stopped again and the
+    exception is raised. Failures while rolling back are only logged, so they do not hide the cause.
+    """
+    started, failed = _run(modules, _dependencies(modules), 'start', abort_on_error=True)
+    if failed:
+        names = [_name(module) for module, _ in failed if module is not None]
+        c.error('{!r}Starting %s failed, rolling back.' % (', '.join(names) or 'modules',))
+        try:
+            stop_modules(started + [module for module, _ in failed if module is not None])
+        except Exception:
+            # Every failure was logged by stop_modules already
+            c.error('{!r}Rolling back was incomplete, the start failure follows.')
+        raise failed[0][1]
+
+
+def stop_modules(modules):
+    """
+    Stop modules concurrently, every module only after all modules depending on it are stopped.
+    Failures do not stop the teardown of the other modules, the first one is raised in the end.
+    """
+    _, failed = _run(modules, _dependents(modules), 'stop', abort_on_error=False)
+    for module, exception in failed:
+        c.error('{!r}Stopping %s failed: %s' % (_name(module), exception))
+    if failed:
+        raise failed[0][1]
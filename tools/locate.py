@@ -1,9 +1,12 @@
+import functools
 import os
 
 
+@functools.lru_cache(maxsize=None)
 def locate(filename, search_path=os.environ['PATH'], path_sep=os.pathsep):
     """
     Helper function to locate a file in the os PATH.
+    Results are remembered, so every file is only looked up once per run.
     """
 
     for path in search_path.split(path_sep):
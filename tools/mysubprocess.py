@@ -1,11 +1,53 @@
+import os
+import re
+import secrets
 import subprocess
+import tempfile
 
 from tools import ColorPrint
+from tools.Nftables import Nftables
+from tools.Tracer import tracer
+
+
+class _Popen(subprocess.Popen):
+    """
+    Popen that reaps the child with wait4, to know how much CPU time it used.
+    """
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, self.rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # Same as subprocess does, if SIGCLD is set to be ignored
+            pid = self.pid
+            sts = 0
+        return pid, sts
+
+    def cpu_ms(self):
+        if self.rusage is None:
+            return None
+        return round((self.rusage.ru_utime + self.rusage.ru_stime) * 1e3, 3)
 
 
 class mysubprocess:
+    """
+    Runs external commands for a module, logging and tracing them.
+    While plan is a list, everything that changes the system (check_call, batches, daemons and files) is only recorded
+    there as a step instead. check_output is for queries and always runs.
+    """
+
     def __init__(self, name):
+        self.name = name
         self.c = ColorPrint(name=name)
+        self.plan = None
+
+    def record(self, op, **step):
+        """
+        Record a step of the plan, see modules.PlannedModule for how steps are replayed.
+        """
+        self.c.print("{!y} Plan: %s %s" % (op, ' '.join('%s=%s' % item for item in step.items() if item[0] != 'content')))
+        self.plan.append(dict(op=op, **step))
 
     def check_call(self, *args, **kwargs) -> int:
         if len(args) > 0:
@@ -13,15 +55,29 @@ class mysubprocess:
         else:
             cmd = kwargs['args']
 
+        if self.plan is not None:
+            self.record('run', argv=list(cmd))
+            return 0
+
         self.c.print("{!y} Run: %s" % (subprocess.list2cmdline(cmd),))
-        try:
-            ret = subprocess.check_call(*args, **kwargs)
-        except subprocess.CalledProcessError as e:
-            self.c.error("{!r} Done, $?: %d, error: %s" % (e.returncode, e.stderr))
-            raise e
-        else:
-            self.c.print("{!g} Done, $?: %d" % (0,))
-            return ret
+        with tracer.span(os.path.basename(cmd[0]), 'command', module=self.name, argv=cmd) as span:
+            try:
+                with _Popen(*args, **kwargs) as p:
+                    try:
+                        ret = p.wait()
+                    except:
+                        p.kill()
+                        raise
+                span['returncode'] = ret
+                span['child_cpu_ms'] = p.cpu_ms()
+                if ret:
+                    raise subprocess.CalledProcessError(ret, cmd)
+            except subprocess.CalledProcessError as e:
+                self.c.error("{!r} Done, $?: %d, error: %s" % (e.returncode, e.stderr))
+                raise e
+            else:
+                self.c.print("{!g} Done, $?: %d" % (0,))
+                return ret
 
     def check_output(self, *args, **kwargs) -> str:
         if len(args) > 0:
@@ -30,15 +86,26 @@ class mysubprocess:
             cmd = kwargs['args']
 
         self.c.print("{!y} Run: %s" % (subprocess.list2cmdline(cmd),))
-        try:
-            out = subprocess.check_output(*args, **kwargs).decode()
-        except subprocess.CalledProcessError as e:
-            self.c.error(
-                "{!r} Done, $?: %d, output: %s, error: %s" % (e.returncode, e.stdout.decode().strip(), e.stderr))
-            raise e
-        else:
-            self.c.print("{!g} Done, $?: %d, output: %s" % (0, out.strip()))
-            return out
+        with tracer.span(os.path.basename(cmd[0]), 'command', module=self.name, argv=cmd) as span:
+            try:
+                with _Popen(*args, stdout=subprocess.PIPE, **kwargs) as p:
+                    try:
+                        out, err = p.communicate()
+                    except:
+                        p.kill()
+                        raise
+                span['returncode'] = p.returncode
+                span['child_cpu_ms'] = p.cpu_ms()
+                if p.returncode:
+                    raise subprocess.CalledProcessError(p.returncode, cmd, output=out, stderr=err)
+                out = out.decode()
+            except subprocess.CalledProcessError as e:
+                self.c.error(
+                    "{!r} Done, $?: %d, output: %s, error: %s" % (e.returncode, e.stdout.decode().strip(), e.stderr))
+                raise e
+            else:
+                self.c.print("{!g} Done, $?: %d, output: %s" % (0, out.strip()))
+                return out
 
     def Popen(self, *args, **kwargs):
         if len(args) > 0:
@@ -48,4 +115,189 @@ class mysubprocess:
 
         self.c.print("{!y} Run: %s" % (subprocess.list2cmdline(cmd),))
 
-        return subprocess.Popen(*args, **kwargs)
+        with tracer.span(os.path.basename(cmd[0]), 'spawn', module=self.name, argv=cmd) as span:
+            process = subprocess.Popen(*args, **kwargs)
+            span['pid'] = process.pid
+        return process
+
+    def tempfile(self, suffix, prefix) -> str:
+        """
+        Name a new temporary file. It is created right away, unless planning: then the name is only a placeholder,
+        replaced by a file created when the plan is applied, as the name is known to anyone who can read the plan.
+        """
+        if self.plan is not None:
+            path = os.path.join(tempfile.gettempdir(), prefix + secrets.token_hex(8) + suffix)
+            self.record('tempfile', path=path, suffix=suffix, prefix=prefix)
+            return path
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix=prefix)
+        os.close(fd)
+        return path
+
+    def write_file(self, path, content):
+        """
+        Write a (config) file readable only by us, without following symlinks.
+        """
+        if self.plan is not None:
+            self.record('write', path=path, content=content)
+            return
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600), 'w') as f:
+            f.write(content)
+
+    def remove_file(self, path, missing_ok=False):
+        if self.plan is not None:
+            self.record('remove', path=path, missing_ok=missing_ok)
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            if not missing_ok:
+                raise
+
+    def batch(self, prefix):
+        """
+        Create a Batch to queue commands for the tool prefix[0] (with common arguments prefix[1:]) and run them at once.
+        """
+        return Batch(self, prefix)
+
+    def communicate(self, cmd, input_text=None, **span_args):
+        """
+        Run cmd feeding it input_text, capture stdout and stderr and return (returncode, stdout, stderr).
+        Used for batches, nothing is logged and no exception is raised for a returncode.
+        """
+        with tracer.span(os.path.basename(cmd[0]), 'command', module=self.name, argv=cmd, **span_args) as span:
+            with _Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p:
+                try:
+                    out, err = p.communicate(input_text.encode() if input_text is not None else None)
+                except:
+                    p.kill()
+                    raise
+            span['returncode'] = p.returncode
+            span['child_cpu_ms'] = p.cpu_ms()
+        return p.returncode, out.decode(), err.decode()
+
+
+class Batch:
+    """
+    Commands for a single tool, queued and run at once through the tool's own batch mode:
+    'ip' and 'tc' read commands with -batch, 'nft' reads them with -f as one transaction, 'firewall-cmd' takes several
+    actions for the same zone in one call. Other tools run the commands one by one.
+    'nft' batches run in-process through libnftables when it is installed.
+    A failure raises subprocess.CalledProcessError for the first command that failed, as if it had been run alone.
+    Can be used as a context manager that flushes on success.
+    """
+
+    FAILED_LINE = {
+        'ip': re.compile(r'^Command failed -:(?P<line>\d+)$'),
+        'tc': re.compile(r'^Command failed -:(?P<line>\d+)$'),
+        'nft': re.compile(r'^(?:/dev/stdin|-|<cmdline>):(?P<line>\d+):'),
+    }
+
+    def __init__(self, runner: mysubprocess, prefix):
+        self.runner = runner
+        self.prefix = list(prefix)
+        self.tool = os.path.basename(self.prefix[0])
+        self.commands = []
+
+    def add(self, *args):
+        """
+        Queue a command, given as its arguments without the prefix.
+        """
+        self.commands.append(list(args))
+
+    def flush(self):
+        """
+        Run all queued commands.
+        """
+        commands = self.commands
+        self.commands = []
+        if not commands:
+            return
+        if self.runner.plan is not None:
+            self.runner.record('batch', prefix=self.prefix, commands=commands)
+            return
+        if self.tool in ('ip', 'tc'):
+            self._run_script(self.prefix + ['-force', '-batch', '-'], commands,
+                             [' '.join('"%s"' % (arg,) if ' ' in arg else arg for arg in cmd) for cmd in commands])
+        elif self.tool == 'nft':
+            self._run_script(self.prefix + ['-f', '-'], commands, [' '.join(cmd) for cmd in commands], Nftables.load())
+        elif self.tool == 'firewall-cmd':
+            self._run_firewall_cmd(commands)
+        else:
+            for cmd in commands:
+                self.runner.check_call(self.prefix + cmd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.commands = []
+
+    def _run_script(self, cmd, commands, lines, nftables: Nftables = None):
+        c = self.runner.c
+        c.print("{!y} Run: %s" % (subprocess.list2cmdline(cmd) if nftables is None else nftables.library,))
+        for line in lines:
+            c.print("{!y}   %s" % (line,))
+
+        script = ''.join(line + '\n' for line in lines)
+        if nftables is None:
+            returncode, out, err = self.runner.communicate(cmd, script, commands=lines)
+        else:
+            with tracer.span('libnftables', 'command', module=self.runner.name, commands=lines) as span:
+                returncode, out, err = nftables.cmd(script)
+                span['returncode'] = returncode
+        if returncode == 0:
+            c.print("{!g} Done, $?: %d" % (0,))
+            return
+
+        # Attribute the error messages to the failing lines of the script
+        failed = {}
+        messages = []
+        for message in err.splitlines():
+            match = Batch.FAILED_LINE[self.tool].match(message)
+            if match is None:
+                messages.append(message)
+            elif self.tool == 'nft':
+                failed.setdefault(int(match.group('line')), []).append(message)
+            else:
+                failed.setdefault(int(match.group('line')), []).extend(messages)
+                messages = []
+        if not failed:
+            # Nothing to attribute (e.g. the tool could not parse its arguments), blame the first command
+            failed[1] = messages
+
+        first = None
+        for line, message in sorted(failed.items()):
+            message = '\n'.join(message).strip()
+            command = self.prefix + commands[min(line, len(commands)) - 1]
+            c.error("{!r} Failed: %s, error: %s" % (subprocess.list2cmdline(command), message))
+            if first is None:
+                # ip and tc report kernel errors with returncode 2 when run alone, but always 1 in batch mode
+                code = 2 if self.tool in ('ip', 'tc') and 'RTNETLINK answers' in message else returncode
+                first = subprocess.CalledProcessError(code, command, output=out, stderr=message)
+        c.error("{!r} Done, $?: %d" % (returncode,))
+        raise first
+
+    def _run_firewall_cmd(self, commands):
+        # Consecutive commands on the same zone are merged into a single call
+        groups = []
+        for cmd in commands:
+            options = [arg for arg in cmd if arg.startswith('--zone=') or arg == '--permanent']
+            actions = [arg for arg in cmd if arg not in options]
+            if groups and groups[-1][0] == options:
+                groups[-1][1].extend(actions)
+            else:
+                groups.append((options, actions))
+
+        for options, actions in groups:
+            try:
+                self.runner.check_call(self.prefix + options + actions)
+            except subprocess.CalledProcessError:
+                if len(actions) == 1:
+                    raise
+                # Find out which action failed, running the already applied ones again only results in warnings
+                self.runner.c.error("{!r} Retrying the merged actions one by one.")
+                for action in actions:
+                    self.runner.check_call(self.prefix + options + [action])
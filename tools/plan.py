@@ -0,0 +1,43 @@
+import json
+import os
+
+# 2: temporary files are created when the plan is applied
+PLAN_VERSION = 2
+
+
+def compile_plan(modules) -> dict:
+    """
+    Record what starting and stopping each configured module would change on the system, without changing anything.
+    Queries (like the zone of an interface) still run, so the plan is a snapshot of the system at the time it was
+    compiled.
+    """
+    plan = {'version': PLAN_VERSION, 'modules': []}
+    for module in modules:
+        runner = module.subprocess
+        runner.plan = []
+        try:
+            module.start()
+            start_steps = runner.plan
+            runner.plan = []
+            module.stop()
+            stop_steps = runner.plan
+        finally:
+            runner.plan = None
+
+        if start_steps or stop_steps:
+            plan['modules'].append({
+                'name': module.name,
+                'depends': list(module.DEPENDS),
+                'start': start_steps,
+                'stop': stop_steps,
+            })
+    return plan
+
+
+def save_plan(plan: dict, path):
+    """
+    Write the plan readable only by us, it contains the config files.
+    """
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600), 'w') as f:
+        json.dump(plan, f, indent=2)
+        f.write('\n')
@@ -0,0 +1,63 @@
+import json
+import os
+import subprocess
+import tempfile
+import threading
+
+CACHE_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'localnet',
+                          'probes.json')
+
+_cache = None
+_lock = threading.Lock()
+
+
+def _load() -> dict:
+    global _cache
+    if _cache is None:
+        try:
+            with open(CACHE_FILE) as f:
+                _cache = json.load(f)
+        except (OSError, ValueError):
+            _cache = {}
+    return _cache
+
+
+def _save():
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(CACHE_FILE), prefix='.probes_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_cache, f, indent=1, sort_keys=True)
+        os.replace(tmp, CACHE_FILE)
+    except OSError:
+        # The cache is an optimization only, e.g. a read-only home is fine
+        pass
+
+
+def probe(runner, argv) -> str:
+    """
+    Run a capability probe like [binary, '--version'] with the given mysubprocess runner and return its combined
+    stdout/stderr. Results are cached on disk keyed by the binary path, inode and mtime, so a probe only runs again
+    once the binary changed. A failed probe raises subprocess.CalledProcessError just like check_output.
+    """
+    st = os.stat(argv[0])
+    key = subprocess.list2cmdline(argv)
+    stamp = [st.st_ino, st.st_mtime_ns]
+
+    with _lock:
+        entry = _load().get(key)
+    if entry is None or entry['stamp'] != stamp:
+        try:
+            output = runner.check_output(argv, stderr=subprocess.STDOUT)
+            returncode = 0
+        except subprocess.CalledProcessError as e:
+            output = e.stdout.decode()
+            returncode = e.returncode
+        entry = {'stamp': stamp, 'returncode': returncode, 'output': output}
+        with _lock:
+            _load()[key] = entry
+            _save()
+
+    if entry['returncode'] != 0:
+        raise subprocess.CalledProcessError(entry['returncode'], argv, output=entry['output'].encode())
+    return entry['output']
@@ -0,0 +1,142 @@
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import threading
+
+from tools.Tracer import tracer
+
+JOURNAL_FILE = '/run/localnet/sysctl.json'
+
+_lock = threading.Lock()
+
+
+def _path(name) -> str:
+    return os.path.join('/proc/sys', name.replace('.', '/'))
+
+
+@contextlib.contextmanager
+def _locked():
+    """
+    Hold the journal against other threads and other localnet instances.
+    """
+    with _lock:
+        os.makedirs(os.path.dirname(JOURNAL_FILE), mode=0o700, exist_ok=True)
+        with open(JOURNAL_FILE + '.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load() -> dict:
+    """
+    The journal as {name: {'original': value, 'holders': [pid, ..]}}, entries written by older versions (just the
+    original value) have no holders.
+    """
+    try:
+        with open(JOURNAL_FILE) as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {name: entry if isinstance(entry, dict) else {'original': entry, 'holders': []}
+            for name, entry in journal.items()}
+
+
+def _save(journal):
+    if not journal:
+        try:
+            os.remove(JOURNAL_FILE)
+        except FileNotFoundError:
+            pass
+        return
+    os.makedirs(os.path.dirname(JOURNAL_FILE), mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(JOURNAL_FILE), prefix='.sysctl_')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(journal, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, JOURNAL_FILE)
+
+
+def _write(runner, name, value):
+    runner.c.print("{!y} Set: %s = %s" % (name, value))
+    with tracer.span('sysctl', 'command', module=runner.name, sysctl=name, value=value):
+        with open(_path(name), 'w') as f:
+            f.write(value + '\n')
+
+
+def read_sysctl(name) -> str:
+    """
+    Read a kernel parameter like net.ipv4.ip_forward from /proc/sys.
+    """
+    with open(_path(name)) as f:
+        return f.read().strip()
+
+
+def write_sysctl(runner, name, value):
+    """
+    Set a kernel parameter, its original value is journaled first so restore_sysctl (or recover_sysctl after a crash)
+    can put it back. Setting it again, also from another localnet instance, keeps the original value in the journal and
+    adds this process to its holders.
+    """
+    value = str(value)
+    if runner.plan is not None:
+        runner.record('sysctl', sysctl=name, value=value)
+        return
+    with _locked():
+        journal = _load()
+        entry = journal.setdefault(name, {'original': read_sysctl(name), 'holders': []})
+        if os.getpid() not in entry['holders']:
+            entry['holders'].append(os.getpid())
+        _save(journal)
+        _write(runner, name, value)
+
+
+def restore_sysctl(runner, name):
+    """
+    Release a kernel parameter set by write_sysctl, it is restored to its original value once no other running
+    localnet instance holds it.
+    """
+    if runner.plan is not None:
+        runner.record('restore_sysctl', sysctl=name)
+        return
+    with _locked():
+        journal = _load()
+        entry = journal.get(name)
+        if entry is None:
+            return
+        entry['holders'] = [pid for pid in entry['holders'] if pid != os.getpid() and _alive(pid)]
+        if not entry['holders']:
+            _write(runner, name, journal.pop(name)['original'])
+        else:
+            runner.c.print('{!y} Keep: %s, still used by process %s' % (name, ', '.join(map(str, entry['holders']))))
+        _save(journal)
+
+
+def recover_sysctl(runner):
+    """
+    Restore the kernel parameters left in the journal by previous runs that did not stop cleanly, those still held by
+    a running localnet instance are kept.
+    """
+    with _locked():
+        journal = _load()
+        left = {}
+        for name, entry in sorted(journal.items()):
+            entry['holders'] = [pid for pid in entry['holders'] if _alive(pid)]
+            if entry['holders']:
+                left[name] = entry
+                continue
+            runner.c.print('{!y}Restoring %s left by a previous run.' % (name,))
+            _write(runner, name, entry['original'])
+        if journal:
+            _save(left)
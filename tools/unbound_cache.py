@@ -0,0 +1,61 @@
+import re
+from typing import List, Tuple
+
+_RR_TTL = re.compile(r'^(\S+\s+)(\d+)(\s.*)$')
+
+
+def age_cache_dump(dump: str, age: float) -> Tuple[str, int, int]:
+    """
+    Rewrite an unbound-control dump_cache output saved age seconds ago for load_cache, which takes the TTLs as they
+    were when dumped: every TTL is reduced by age, and rrsets and messages that expired meanwhile are left out (unbound
+    skips messages referring to rrsets it does not have). Returns the dump and the number of rrsets kept and dropped.
+    Raises ValueError if the dump is not understood.
+    """
+    age = int(age + 0.999)
+    lines = dump.splitlines()
+    output: List[str] = []
+    kept = dropped = 0
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if line.startswith(';rrset'):
+            # ;rrset [nsec_apex] ttl rr_count rrsig_count trust security, followed by the rr and rrsig lines
+            fields = line.split()
+            number = 2 if fields[1:2] == ['nsec_apex'] else 1
+            if len(fields) != number + 5:
+                raise ValueError('unexpected rrset line "%s"' % (line,))
+            ttl = int(fields[number]) - age
+            count = int(fields[number + 1]) + int(fields[number + 2])
+            records = lines[i:i + count]
+            i += count
+            if len(records) != count:
+                raise ValueError('rrset "%s" is cut short' % (line,))
+            if ttl <= 0:
+                dropped += 1
+                continue
+            kept += 1
+            fields[number] = str(ttl)
+            output.append(' '.join(fields))
+            for record in records:
+                match = _RR_TTL.match(record)
+                if match is None:
+                    raise ValueError('unexpected record "%s"' % (record,))
+                output.append('%s%d%s' % (match.group(1), max(int(match.group(2)) - age, 1), match.group(3)))
+        elif line.startswith('msg '):
+            # msg qname qclass qtype flags qdcount ttl security an ns ar, followed by a line per referenced rrset
+            fields = line.split()
+            if len(fields) != 11:
+                raise ValueError('unexpected message line "%s"' % (line,))
+            ttl = int(fields[6]) - age
+            count = int(fields[8]) + int(fields[9]) + int(fields[10])
+            references = lines[i:i + count]
+            i += count
+            if ttl <= 0:
+                continue
+            fields[6] = str(ttl)
+            output.append(' '.join(fields))
+            output.extend(references)
+        else:
+            output.append(line)
+    return ''.join(line + '\n' for line in output), kept, dropped
@@ -0,0 +1,67 @@
+import os
+from typing import List, Optional, Tuple
+
+PROFILES = ['small', 'default', 'large']
+MEMINFO_FILE = '/proc/meminfo'
+
+
+def host_resources() -> Tuple[int, int]:
+    """
+    The number of cores this process may run on and the total memory in bytes (0 if unknown).
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    memory = 0
+    try:
+        with open(MEMINFO_FILE) as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    return cores, memory
+
+
+def _megabytes(size: int) -> str:
+    return '%dm' % (max(size >> 20, 1),)
+
+
+def unbound_profile(profile: str, cores: Optional[int] = None, memory: Optional[int] = None,
+                    libevent: bool = False) -> List[Tuple[str, str]]:
+    """
+    unbound server options for a profile, scaled to cores and memory (those of the host if not given):
+    'small' keeps unbound to one thread and a few MB for hosts like single board computers, 'default' uses up to 4
+    threads and 1/128 of the memory for caches, 'large' uses all cores, 1/32 of the memory and prefetching, for hosts
+    dedicated to serving a busy network. Without libevent unbound can only select() on 1024 sockets for all threads.
+    """
+    if profile not in PROFILES:
+        raise ValueError('Unknown unbound profile "%s"' % (profile,))
+    host_cores, host_memory = host_resources()
+    cores = cores or host_cores
+    memory = memory or host_memory or 1 << 30
+
+    threads = {'small': 1, 'default': min(cores, 4), 'large': cores}[profile]
+    # Slabs reduce lock contention between threads, they must be a power of 2
+    slabs = 1 << (threads - 1).bit_length()
+    msg_cache = {'small': min(memory // 256, 4 << 20),
+                 'default': min(max(memory // 128, 4 << 20), 64 << 20),
+                 'large': min(max(memory // 32, 16 << 20), 1 << 30)}[profile]
+    outgoing_range = {'small': 256, 'default': 4096, 'large': 8192}[profile]
+    if not libevent:
+        outgoing_range = min(outgoing_range, max(1024 // threads - 50, 64))
+    queries = max(outgoing_range // 2, 64)
+
+    options = [('num-threads', threads)]
+    if threads > 1:
+        options.append(('so-reuseport', 'yes'))
+    options += [('msg-cache-slabs', slabs), ('rrset-cache-slabs', slabs), ('infra-cache-slabs', slabs),
+                ('key-cache-slabs', slabs),
+                # rrsets take about twice the memory of the messages referring to them
+                ('msg-cache-size', _megabytes(msg_cache)), ('rrset-cache-size', _megabytes(2 * msg_cache)),
+                ('outgoing-range', outgoing_range), ('num-queries-per-thread', queries)]
+    if profile == 'large':
+        options += [('prefetch', 'yes'), ('prefetch-key', 'yes')]
+    return [(name, str(value)) for name, value in options]